@@ -24,7 +24,7 @@ def runtests():
     print(tests)
     os.chdir(TEST_DIR)
     for file in tests:
-        if (file.endswith('.yaml')):
+        if file.endswith('.yaml') or (file.startswith('test_') and file.endswith('.py')):
             os.system('py.test ' + file)
 
 
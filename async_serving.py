@@ -0,0 +1,269 @@
+import asyncio
+import concurrent.futures
+import io
+import os
+import sys
+import threading
+
+import msg_api
+import post_api
+import serialize
+import user_api
+import vote_api
+
+######################
+# asyncio serving mode for the four services (see Procfile.async):
+#   $ uvicorn --host 127.0.0.1 --port $PORT async_serving:post    (or :vote, :user, :msg)
+#
+# Each service is the same flask app, so routes and JSON contracts don't change. The event loop owns
+# the sockets (slow clients and keep-alive connections cost no thread) and hands every request to a
+# small thread pool, where the view runs with its pooled sqlite connection and may block on a locked
+# database without stalling the loop. Response bodies, including streamed ones, are passed back
+# through a bounded queue, so a slow reader pauses the thread producing its rows.
+#
+# App config keys (read when the first request arrives):
+#   ASYNC_THREADS       threads running views; defaults to POOL_SIZE so no thread waits on the pool
+#   ASYNC_MAX_PENDING   requests that may wait for a thread; beyond that the service answers
+#                       503 + Retry-After instead of queueing without bound
+#   ASYNC_STREAM_BUFFER batches of body chunks queued per response before the producing thread waits
+
+DEFAULT_THREADS = 5
+DEFAULT_MAX_PENDING = 64
+DEFAULT_STREAM_BUFFER = 8
+# body bytes a pool thread collects before handing them to the loop
+STREAM_FLUSH_BYTES = 65536
+# how often a thread blocked on a full response queue checks whether the client went away
+DISCONNECT_POLL = 1.0
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+# WSGI environ for an ASGI http scope and its (fully read) request body
+def build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1')
+        value = value.decode('latin-1')
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+def encode_headers(headers):
+    return [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+
+# ASGI application serving one flask app from a bounded thread pool
+class AsyncService:
+    def __init__(self, app):
+        self.app = app
+        self._executors = {}
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._stats = {'requests': 0, 'rejected': 0, 'disconnects': 0, 'peak_pending': 0}
+
+    @property
+    def threads(self):
+        return self.app.config.get('ASYNC_THREADS', self.app.config.get('POOL_SIZE', DEFAULT_THREADS))
+
+    @property
+    def max_pending(self):
+        return self.app.config.get('ASYNC_MAX_PENDING', DEFAULT_MAX_PENDING)
+
+    # one executor per process; keyed by pid like the connection pools, so a forked worker starts its own
+    @property
+    def executor(self):
+        key = os.getpid()
+        executor = self._executors.get(key)
+        if executor is None:
+            with self._lock:
+                executor = self._executors.get(key)
+                if executor is None:
+                    executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=self.threads, thread_name_prefix=self.app.name)
+                    self._executors[key] = executor
+        return executor
+
+    def metrics(self):
+        stats = dict(self._stats)
+        stats.update({'pending': self._pending, 'threads': self.threads, 'max_pending': self.max_pending})
+        return stats
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                executor = self._executors.pop(os.getpid(), None)
+                if executor is not None:
+                    executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, receive, send):
+        # requests holding or waiting for a thread; past threads + max_pending, shed load right away
+        if self._pending >= self.threads + self.max_pending:
+            self._stats['rejected'] += 1
+            await self._busy(send)
+            return
+        self._pending += 1
+        self._stats['requests'] += 1
+        self._stats['peak_pending'] = max(self._stats['peak_pending'], self._pending)
+        disconnected = threading.Event()
+        try:
+            body = await self._read_body(receive)
+            if body is None:
+                return
+            loop = asyncio.get_running_loop()
+            queue = asyncio.Queue()
+            credits = threading.Semaphore(self.app.config.get('ASYNC_STREAM_BUFFER', DEFAULT_STREAM_BUFFER))
+            environ = build_environ(scope, body)
+            worker = self.executor.submit(self._run, loop, environ, queue, credits, disconnected)
+            try:
+                await self._respond(queue, credits, send)
+            except OSError:
+                self._stats['disconnects'] += 1
+                disconnected.set()
+                # the thread stops at its next batch; keep counting it as pending until then
+                await asyncio.wrap_future(worker)
+            finally:
+                disconnected.set()
+        finally:
+            self._pending -= 1
+
+    async def _read_body(self, receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                return b''.join(chunks)
+
+    async def _busy(self, send):
+        body = serialize.dumps_bytes({'status_code': '503', 'message': 'Service busy, try again'})
+        await send({'type': 'http.response.start', 'status': 503, 'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode('latin-1')),
+            (b'retry-after', b'1'),
+        ]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    # relay what the worker thread queued: batches of ('start', status, headers), ('body', bytes)..., ('end',)
+    async def _respond(self, queue, credits, send):
+        start = None
+        started = False
+        while True:
+            batch = await queue.get()
+            credits.release()
+            for item in batch:
+                if item[0] == 'start':
+                    start = item
+                    continue
+                if start is not None:
+                    status, headers = start[1], start[2]
+                    await send({'type': 'http.response.start', 'status': int(status.split(' ', 1)[0]),
+                                'headers': encode_headers(headers)})
+                    start = None
+                    started = True
+                if item[0] == 'body':
+                    await send({'type': 'http.response.body', 'body': item[1], 'more_body': True})
+                elif item[0] == 'end':
+                    await send({'type': 'http.response.body', 'body': b''})
+                    return
+                elif started:
+                    # the app raised part way through a streamed body; all that can be done is cut it short
+                    await send({'type': 'http.response.body', 'body': b''})
+                    return
+                else:
+                    # the app raised past flask's own error handling
+                    await send({'type': 'http.response.start', 'status': 500,
+                                'headers': [(b'content-type', b'text/plain')]})
+                    await send({'type': 'http.response.body', 'body': b'Internal Server Error'})
+                    return
+
+    # runs on a pool thread: call the WSGI app and feed its response into the loop's queue. Items are
+    # batched so an ordinary response crosses to the loop once; only long bodies go over in pieces
+    def _run(self, loop, environ, queue, credits, disconnected):
+        batch = []
+        buffered = 0
+
+        # a credit per queued batch bounds how far the thread runs ahead of a slow client
+        def flush():
+            nonlocal batch, buffered
+            while not credits.acquire(timeout=DISCONNECT_POLL):
+                if disconnected.is_set():
+                    raise ClientDisconnected()
+            loop.call_soon_threadsafe(queue.put_nowait, batch)
+            batch, buffered = [], 0
+
+        def write(data):
+            nonlocal buffered
+            batch.append(('body', data))
+            buffered += len(data)
+            if buffered >= STREAM_FLUSH_BYTES:
+                flush()
+
+        def start_response(status, headers, exc_info=None):
+            batch.append(('start', status, headers))
+            return write
+
+        try:
+            result = self.app(environ, start_response)
+            try:
+                for chunk in result:
+                    if chunk:
+                        write(chunk)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+            batch.append(('end',))
+            flush()
+        except ClientDisconnected:
+            pass
+        except Exception as e:
+            print(e)
+            batch.append(('error', e))
+            try:
+                flush()
+            except ClientDisconnected:
+                pass
+
+post = AsyncService(post_api.app)
+vote = AsyncService(vote_api.app)
+user = AsyncService(user_api.app)
+msg = AsyncService(msg_api.app)
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+######################
+# Small key/value caches with a size bound and a TTL, shared by the services.
+#
+# MemoryCache  per-process LRU; fastest, but each gunicorn worker has its own copy, so a delete
+#              in one worker only reaches the others when their entry expires (TTL).
+# FileCache    one file per key in a local directory that every worker (and service) on the host
+#              shares; a delete is seen by all workers at once. Values must be JSON serializable.
+#
+# Both expose get(key) / set(key, value) / delete(key) / clear() / metrics().
+
+MISSING = object()
+
+
+class MemoryCache:
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()   # key -> (expires at, value), least recently used first
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'deletes': 0}
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, MISSING)
+            if entry is not MISSING and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[1]
+            if entry is not MISSING:
+                del self._entries[key]
+            self.stats['misses'] += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def delete(self, key):
+        with self._lock:
+            if self._entries.pop(key, MISSING) is not MISSING:
+                self.stats['deletes'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats.update({'backend': 'memory', 'size': self.size, 'entries': len(self._entries), 'pid': os.getpid()})
+        return stats
+
+
+class FileCache:
+    def __init__(self, directory, size, ttl):
+        self.directory = directory
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._sets = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'deletes': 0}
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + '.json')
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            with open(path, mode='r') as f:
+                expires, value = json.load(f)
+        except (OSError, ValueError):
+            self._count('misses')
+            return default
+        if expires <= time.time():
+            self._remove(path)
+            self._count('misses')
+            return default
+        self._count('hits')
+        return value
+
+    def set(self, key, value):
+        # write then rename, so readers in other workers never see a half-written file
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, mode='w') as f:
+            json.dump([time.time() + self.ttl, value], f)
+        os.replace(tmp, self._path(key))
+        with self._lock:
+            self._sets += 1
+            prune = self._sets % 64 == 0
+        if prune:
+            self._prune()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    # drop the oldest files once the directory holds more than `size` entries
+    def _prune(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except OSError:
+                    pass
+        entries.sort()
+        for _, path in entries[:max(0, len(entries) - self.size)]:
+            if self._remove(path):
+                self._count('evictions')
+
+    def delete(self, key):
+        if self._remove(self._path(key)):
+            self._count('deletes')
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                self._remove(entry.path)
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats.update({'backend': 'file', 'size': self.size, 'directory': self.directory, 'pid': os.getpid()})
+        return stats
+
+
+# build the backend named by `backend` ('memory' or 'file'), None disables caching
+def make_cache(backend, size, ttl, directory=None):
+    if not backend:
+        return None
+    if backend == 'memory':
+        return MemoryCache(size, ttl)
+    if backend == 'file':
+        return FileCache(directory, size, ttl)
+    raise ValueError(f'unknown cache backend {backend!r}')
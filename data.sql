@@ -9,16 +9,18 @@ DROP TABLE IF EXISTS posts;
 DROP TABLE IF EXISTS users;
 DROP TABLE IF EXISTS messages;
 DROP TABLE IF EXISTS favorite;
+DROP TABLE IF EXISTS broadcast_jobs;
 
 CREATE TABLE community (
     community_id INTEGER PRIMARY KEY,
-    community_name VARCHAR NOT NULL
+    community_name VARCHAR NOT NULL UNIQUE
 );
 
 CREATE TABLE votes (
     vote_id INTEGER primary key,
     upvotes INTEGER NOT NULL,
-    downvotes INTEGER NOT NULL
+    downvotes INTEGER NOT NULL,
+    score INTEGER NOT NULL DEFAULT 0
 );
 
 CREATE TABLE posts (
@@ -36,8 +38,8 @@ CREATE TABLE posts (
 
 CREATE TABLE users (
     user_id INTEGER PRIMARY KEY,
-    username VARCHAR NOT NULL,
-    email VARCHAR NOT NULL,
+    username VARCHAR NOT NULL UNIQUE,
+    email VARCHAR NOT NULL UNIQUE,
     karma INTEGER DEFAULT 1
 );
 
@@ -48,6 +50,7 @@ CREATE TABLE messages (
     msg_time TIMESTAMP DEFAULT (DATETIME('now', 'localtime')),
     msg_content VARCHAR NOT NULl,
     msg_flag VARCHAR,
+    msg_read INTEGER NOT NULL DEFAULT 0,
     FOREIGN KEY (user_from) REFERENCES users (user_id),
     FOREIGN KEY (user_to) REFERENCES users (user_id)
 );
@@ -58,6 +61,34 @@ CREATE TABLE favorite (
     FOREIGN KEY (msg_ID) REFERENCES messages (msg_id)
 );
 
+-- background /messages/broadcast progress (migrations/004_broadcast_jobs.sql)
+CREATE TABLE broadcast_jobs (
+    job_id VARCHAR PRIMARY KEY,
+    user_from INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    sent INTEGER NOT NULL DEFAULT 0,
+    state VARCHAR NOT NULL DEFAULT 'queued',
+    error VARCHAR,
+    created TIMESTAMP DEFAULT (DATETIME('now', 'localtime')),
+    updated TIMESTAMP
+);
+
+-- secondary indexes for the lookups every service does (kept in sync with migrations/001_secondary_indexes.sql)
+CREATE INDEX idx_posts_published ON posts (published);
+CREATE INDEX idx_posts_community_published ON posts (community_id, published);
+CREATE INDEX idx_posts_username_published ON posts (username, published);
+CREATE INDEX idx_posts_vote_id ON posts (vote_id);
+CREATE INDEX idx_favorite_msg_id ON favorite (msg_ID);
+-- top-N by score is a walk of this index (migrations/002_votes_score.sql)
+CREATE INDEX idx_votes_score ON votes (abs(score), vote_id);
+-- inbox/outbox/thread pages and unread counts (migrations/003_message_reads.sql)
+CREATE INDEX idx_messages_to_time ON messages (user_to, msg_time);
+CREATE INDEX idx_messages_from_time ON messages (user_from, msg_time);
+CREATE INDEX idx_messages_unread ON messages (user_to) WHERE msg_read = 0;
+
+-- schema version, see db_migrate.py
+PRAGMA user_version = 4;
+
 INSERT INTO users(username, email) VALUES ('ilovedog', 'dogperson@ilovedog.com');
 INSERT INTO users(username, email) VALUES ('ilovecat', 'catperson@ilovecat.com');
 
@@ -65,9 +96,8 @@ INSERT INTO messages(user_from, user_to, msg_content, msg_flag)
         VALUES (1, 2, 'hey friend', 'important');
 
 INSERT INTO favorite(msg_ID) VALUES (1);
-INSERT INTO favorite(msg_ID) VALUES (2);
 
-INSERT INTO votes(upvotes, downvotes) VALUES(103, 24);
+INSERT INTO votes(upvotes, downvotes, score) VALUES(103, 24, 79);
 INSERT INTO community(community_id, community_name) VALUES(1, 'cheesecake');
 INSERT INTO posts(community_id, title, description, resource_url, username, vote_id)
 VALUES(
@@ -79,7 +109,7 @@ VALUES(
     (SELECT MAX(vote_id) from votes)
 );
 
-INSERT INTO votes(upvotes, downvotes) VALUES(64, 0);
+INSERT INTO votes(upvotes, downvotes, score) VALUES(64, 0, 64);
 INSERT INTO community(community_id, community_name) VALUES(2, 'coronavirus');
 INSERT INTO posts(community_id, title, description, username, vote_id)
 VALUES(
@@ -90,7 +120,7 @@ VALUES(
     (SELECT MAX(vote_id) from votes)
 );
 
-INSERT INTO votes(upvotes, downvotes) VALUES(78, 16);
+INSERT INTO votes(upvotes, downvotes, score) VALUES(78, 16, 62);
 INSERT INTO posts(community_id, title, description, resource_url, username, vote_id)
 VALUES(
     (SELECT community_id FROM community WHERE community_name='coronavirus'),
@@ -101,7 +131,7 @@ VALUES(
     (SELECT MAX(vote_id) from votes)
 );
 
-INSERT INTO votes(upvotes, downvotes) VALUES(37, 14);
+INSERT INTO votes(upvotes, downvotes, score) VALUES(37, 14, 23);
 INSERT INTO posts(community_id, title, description, username, vote_id)
 VALUES(
     (SELECT community_id FROM community WHERE community_name='coronavirus'),
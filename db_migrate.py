@@ -0,0 +1,61 @@
+import os
+import re
+
+######################
+# Versioned schema migrations for an existing data.db.
+# The schema version lives in PRAGMA user_version; data.sql creates a fresh database at the
+# latest version, and migrations/NNN_<name>.sql bring an older file up to it in place.
+# Each migration runs in its own transaction together with its user_version bump.
+#
+# Run from any service:
+# $FLASK_APP=post_api.py
+# $flask migrate
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_FILE = re.compile(r'^(\d+)_\w+\.sql$')
+
+
+# first column of the first row, whatever row_factory the connection uses
+def _scalar(conn, query):
+    row = conn.execute(query).fetchone()
+    if isinstance(row, dict):
+        return next(iter(row.values()))
+    return row[0]
+
+
+def schema_version(conn):
+    return _scalar(conn, 'PRAGMA user_version')
+
+
+# (version, path) of every migration file, oldest first
+def list_migrations(directory=MIGRATIONS_DIR):
+    migrations = []
+    for name in os.listdir(directory):
+        match = MIGRATION_FILE.match(name)
+        if match:
+            migrations.append((int(match.group(1)), os.path.join(directory, name)))
+    return sorted(migrations)
+
+
+def latest_version(directory=MIGRATIONS_DIR):
+    migrations = list_migrations(directory)
+    return migrations[-1][0] if migrations else 0
+
+
+# apply every migration newer than the database's user_version, returns the files applied
+def migrate(conn, directory=MIGRATIONS_DIR):
+    applied = []
+    current = schema_version(conn)
+    for version, path in list_migrations(directory):
+        if version <= current:
+            continue
+        with open(path, mode='r') as f:
+            script = f.read()
+        try:
+            conn.executescript('BEGIN;\n{}\nPRAGMA user_version = {};\nCOMMIT;'.format(script, version))
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        applied.append(os.path.basename(path))
+    return applied
@@ -0,0 +1,337 @@
+import os
+import random
+import sqlite3
+import threading
+import time
+import urllib.request
+
+import db_split
+
+######################
+# Shared SQLite connection pool used by post_api, vote_api, user_api and msg_api.
+# Each gunicorn worker keeps a small set of long-lived connections per database file
+# instead of connecting (and re-parsing the schema) on every request.
+#
+# App config keys (read by pool_for_app):
+#   DATABASE           path of the sqlite file (unless DB_SPLIT_DIR gives each service its own, see db_split)
+#   POOL_SIZE          max connections held by one worker process
+#   POOL_TIMEOUT       seconds to wait for a free connection before giving up
+#   POOL_HEALTH_CHECK  seconds a connection may sit idle before it is re-checked with SELECT 1
+#   POOL_CACHED_STATEMENTS  prepared statements each connection keeps (sqlite3's default is 128)
+#
+# Database profile, applied to every connection the pool opens (so also by each app's `flask init`):
+#   DB_JOURNAL_MODE    WAL lets readers run alongside the single writer; persistent in the file
+#   DB_SYNCHRONOUS     NORMAL is durable across app crashes in WAL mode and skips an fsync per commit
+#   DB_CACHE_SIZE      page cache per connection (negative = KiB)
+#   DB_MMAP_SIZE       bytes of the file read through mmap
+#   DB_BUSY_TIMEOUT    ms sqlite itself waits on a locked database before returning SQLITE_BUSY
+#   DB_BUSY_RETRIES    extra attempts after SQLITE_BUSY that the busy timeout can't cover
+#                      (e.g. a WAL read transaction that can't be upgraded to a write)
+#   DB_BUSY_BACKOFF    base seconds of the exponential backoff between those attempts
+#
+# Read-only pools (read_only=True, see db_router) open the file with mode=ro and set query_only, so a
+# handler on one can never take the write lock; immutable=True additionally skips all locking, for
+# files nothing writes to (the snapshots db_router makes).
+#
+# Pools for a split deployment (see db_split) ATTACH the other services' files their queries join
+# against; the profile is applied to every attached schema too, and read-only pools attach them mode=ro.
+
+DEFAULT_POOL_SIZE = 5
+DEFAULT_POOL_TIMEOUT = 5.0
+DEFAULT_HEALTH_CHECK = 30.0
+DEFAULT_CACHED_STATEMENTS = 128
+
+DEFAULT_PROFILE = (
+    ('busy_timeout', 5000),
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -16000),
+    ('mmap_size', 268435456),
+)
+# pragmas that apply to the whole connection rather than to one (attached) schema
+CONNECTION_PRAGMAS = ('busy_timeout',)
+DEFAULT_BUSY_RETRIES = 3
+DEFAULT_BUSY_BACKOFF = 0.05
+
+
+# the database stayed locked through the busy timeout and every retry
+class DatabaseBusy(Exception):
+    pass
+
+
+class PoolTimeout(DatabaseBusy):
+    pass
+
+
+def is_busy_error(e):
+    if not isinstance(e, sqlite3.OperationalError):
+        return False
+    code = getattr(e, 'sqlite_errorcode', None)
+    if code is not None:
+        return (code & 0xff) in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    message = str(e)
+    return 'locked' in message or 'busy' in message
+
+
+# set the profile pragmas on a fresh connection (or on one of its attached schemas)
+def apply_profile(conn, profile=DEFAULT_PROFILE, read_only=False, schema=None):
+    prefix = schema + '.' if schema else ''
+    for pragma, value in profile:
+        if schema and pragma in CONNECTION_PRAGMAS:
+            continue
+        if pragma == 'journal_mode':
+            if read_only:
+                continue
+            # switching modes needs the write lock, so only do it the first time a file is opened
+            current = conn.execute('PRAGMA {}journal_mode'.format(prefix)).fetchone()[0]
+            if current.lower() == str(value).lower():
+                continue
+        conn.execute('PRAGMA {}{}={}'.format(prefix, pragma, value)).fetchall()
+    if read_only and not schema:
+        conn.execute('PRAGMA query_only=1')
+
+
+def _ro_uri(path, immutable=False):
+    return 'file:{}?mode=ro{}'.format(urllib.request.pathname2url(os.path.abspath(path)),
+                                     '&immutable=1' if immutable else '')
+
+
+class ConnectionPool:
+    def __init__(self, database, size=DEFAULT_POOL_SIZE, timeout=DEFAULT_POOL_TIMEOUT,
+                 health_check=DEFAULT_HEALTH_CHECK, row_factory=None, profile=DEFAULT_PROFILE,
+                 busy_retries=DEFAULT_BUSY_RETRIES, busy_backoff=DEFAULT_BUSY_BACKOFF,
+                 cached_statements=DEFAULT_CACHED_STATEMENTS, read_only=False, immutable=False, attach=()):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.health_check = health_check
+        self.row_factory = row_factory
+        self.profile = profile
+        self.busy_retries = busy_retries
+        self.busy_backoff = busy_backoff
+        self.cached_statements = cached_statements
+        self.read_only = read_only or immutable
+        self.immutable = immutable
+        # ((schema, path), ...) attached to every connection
+        self.attach = attach
+        # connections opened before the last recycle() are closed instead of reused
+        self._generation = 0
+        self._generations = {}
+        # idle connections as (conn, time returned); used LIFO so the warmest one is reused first
+        self._idle = []
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._stats = {
+            'created': 0,
+            'closed': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'health_checks': 0,
+            'health_failures': 0,
+            'peak_in_use': 0,
+            'busy_retries': 0,
+            'busy_failures': 0,
+            'recycles': 0,
+        }
+
+    def _connect(self):
+        database, uri = self.database, False
+        if self.read_only:
+            database, uri = _ro_uri(self.database, self.immutable), True
+        # connections move between the threads of a worker, but only one request holds one at a time
+        conn = sqlite3.connect(
+            database,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+            uri=uri
+        )
+        try:
+            apply_profile(conn, self.profile, self.read_only)
+            for schema, path in self.attach:
+                conn.execute('ATTACH DATABASE ? AS {}'.format(schema), (_ro_uri(path) if self.read_only else path,))
+                apply_profile(conn, self.profile, self.read_only, schema)
+        except sqlite3.OperationalError as e:
+            conn.close()
+            if is_busy_error(e):
+                raise DatabaseBusy('could not apply profile to {}: {}'.format(self.database, e))
+            raise
+        if self.row_factory is not None:
+            conn.row_factory = self.row_factory
+        return conn
+
+    def _discard(self, conn):
+        self._generations.pop(conn, None)
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        self._stats['closed'] += 1
+
+    def _healthy(self, conn):
+        self._stats['health_checks'] += 1
+        try:
+            conn.execute('SELECT 1').fetchall()
+            return True
+        except sqlite3.Error:
+            self._stats['health_failures'] += 1
+            return False
+
+    # check a connection out of the pool, opening a new one while under POOL_SIZE
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                while self._idle:
+                    conn, returned_at = self._idle.pop()
+                    if self._generations.get(conn) != self._generation:
+                        self._discard(conn)
+                        continue
+                    if time.monotonic() - returned_at < self.health_check or self._healthy(conn):
+                        return self._checkout(conn)
+                    self._discard(conn)
+                if self._in_use < self.size:
+                    # reserve the slot, then connect outside the lock so other requests aren't held up
+                    self._checkout(None)
+                    generation = self._generation
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout('no free connection to {} after {}s'.format(self.database, self.timeout))
+                self._stats['waits'] += 1
+                self._cond.wait(remaining)
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._stats['created'] += 1
+            self._generations[conn] = generation
+        return conn
+
+    def _checkout(self, conn):
+        self._in_use += 1
+        self._stats['checkouts'] += 1
+        self._stats['peak_in_use'] = max(self._stats['peak_in_use'], self._in_use)
+        return conn
+
+    # return a connection; anything left uncommitted by the request is rolled back
+    def release(self, conn):
+        with self._cond:
+            self._in_use -= 1
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+            except sqlite3.Error:
+                self._discard(conn)
+                conn = None
+            if conn is not None:
+                stale = self._generations.get(conn) != self._generation
+                if self._closed or stale or len(self._idle) >= self.size:
+                    self._discard(conn)
+                else:
+                    self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    # run fn() on conn, rolling back and retrying with backoff while the database reports SQLITE_BUSY
+    def retry_busy(self, conn, fn):
+        attempt = 0
+        while True:
+            try:
+                return fn()
+            except sqlite3.OperationalError as e:
+                if not is_busy_error(e):
+                    raise
+                if conn.in_transaction:
+                    conn.rollback()
+                if attempt >= self.busy_retries:
+                    with self._cond:
+                        self._stats['busy_failures'] += 1
+                    raise DatabaseBusy('{} still locked after {} retries: {}'.format(self.database, attempt, e))
+                with self._cond:
+                    self._stats['busy_retries'] += 1
+                time.sleep(self.busy_backoff * (2 ** attempt) * (0.5 + random.random()))
+                attempt += 1
+
+    # stop reusing every connection opened so far: idle ones are closed now, checked out ones on release
+    def recycle(self):
+        with self._cond:
+            self._generation += 1
+            self._stats['recycles'] += 1
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+
+    def metrics(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                'database': self.database,
+                'pid': os.getpid(),
+                'size': self.size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'read_only': self.read_only,
+                'attached': [schema for schema, _ in self.attach],
+            })
+        return stats
+
+
+# one pool per (process, database, row factory, mode); keyed by pid so a forked worker never reuses its parent's
+# connections
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(database, size=DEFAULT_POOL_SIZE, timeout=DEFAULT_POOL_TIMEOUT,
+             health_check=DEFAULT_HEALTH_CHECK, row_factory=None, profile=DEFAULT_PROFILE,
+             busy_retries=DEFAULT_BUSY_RETRIES, busy_backoff=DEFAULT_BUSY_BACKOFF,
+             cached_statements=DEFAULT_CACHED_STATEMENTS, read_only=False, immutable=False, attach=()):
+    key = (os.getpid(), database, row_factory, read_only, immutable, attach)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(database, size, timeout, health_check, row_factory,
+                                      profile, busy_retries, busy_backoff, cached_statements,
+                                      read_only, immutable, attach)
+                _pools[key] = pool
+    return pool
+
+
+# database profile described by a flask app config (DB_* keys override DEFAULT_PROFILE)
+def profile_for_app(config):
+    return tuple((pragma, config.get('DB_' + pragma.upper(), value)) for pragma, value in DEFAULT_PROFILE)
+
+
+# build (or fetch) the pool described by a flask app config; read-only pools may name another database file
+def pool_for_app(config, row_factory=None, read_only=False, immutable=False, database=None):
+    own_database, attach = db_split.layout_for_app(config)
+    return get_pool(
+        database or own_database,
+        size=config.get('POOL_SIZE', DEFAULT_POOL_SIZE),
+        timeout=config.get('POOL_TIMEOUT', DEFAULT_POOL_TIMEOUT),
+        health_check=config.get('POOL_HEALTH_CHECK', DEFAULT_HEALTH_CHECK),
+        row_factory=row_factory,
+        profile=profile_for_app(config),
+        busy_retries=config.get('DB_BUSY_RETRIES', DEFAULT_BUSY_RETRIES),
+        busy_backoff=config.get('DB_BUSY_BACKOFF', DEFAULT_BUSY_BACKOFF),
+        cached_statements=config.get('POOL_CACHED_STATEMENTS', DEFAULT_CACHED_STATEMENTS),
+        read_only=read_only,
+        immutable=immutable,
+        attach=attach
+    )
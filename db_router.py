@@ -0,0 +1,104 @@
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import db_pool
+
+######################
+# Read/write connection routing shared by the four services.
+#
+# Writes (and reads that must see the latest commit, like the vote leaderboard's reload) use the
+# primary pool from db_pool.pool_for_app. Read-only handlers use read_pool_for_app: connections opened
+# with mode=ro and query_only, so nothing they run can take the write lock. In WAL mode those readers
+# never block voting, but a long analytical read still pins the WAL and keeps checkpoints from
+# finishing; pointing DB_READ_SNAPSHOT at a snapshot file moves such reads off the primary entirely.
+#
+# Snapshots are refreshed by a separate process (one per host, not one per worker), which copies the
+# primary with the backup API into a temp file and renames it over the old snapshot:
+# $ python db_router.py data.db data-snapshot.db 30
+# Workers notice the new file (a new inode) within DB_SNAPSHOT_CHECK seconds and recycle their read
+# pools; requests already reading the old snapshot finish on it. Snapshot reads lag the primary by up
+# to the refresh interval, and that includes caches filled from them (POST_CACHE_TTL).
+#
+# App config keys:
+#   DB_READ_SNAPSHOT   snapshot file for read-only handlers; None (default) reads the primary read-only.
+#                      Until the file exists reads also stay on the primary.
+#   DB_SNAPSHOT_CHECK  seconds between checks for a refreshed snapshot
+
+DEFAULT_SNAPSHOT_CHECK = 1.0
+DEFAULT_SNAPSHOT_INTERVAL = 30.0
+
+# per read pool: (time of last check, inode the pool's connections were opened on)
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def _snapshot_inode(path):
+    try:
+        return os.stat(path).st_ino
+    except OSError:
+        return None
+
+
+# recycle the pool's connections when the snapshot file has been replaced since they were opened
+def _check_snapshot(pool, path, interval):
+    now = time.monotonic()
+    checked_at, inode = _snapshots.get(pool, (None, None))
+    if checked_at is not None and now - checked_at < interval:
+        return
+    current = _snapshot_inode(path)
+    with _snapshots_lock:
+        checked_at, inode = _snapshots.get(pool, (None, inode))
+        _snapshots[pool] = (now, current)
+    if checked_at is not None and current != inode:
+        pool.recycle()
+
+
+# pool for read-only handlers described by a flask app config
+def read_pool_for_app(config, row_factory=None):
+    snapshot = config.get('DB_READ_SNAPSHOT')
+    if snapshot and os.path.exists(snapshot):
+        pool = db_pool.pool_for_app(config, row_factory, immutable=True, database=snapshot)
+        _check_snapshot(pool, snapshot, config.get('DB_SNAPSHOT_CHECK', DEFAULT_SNAPSHOT_CHECK))
+        return pool
+    return db_pool.pool_for_app(config, row_factory, read_only=True)
+
+
+# copy the primary into a fresh snapshot file and swap it in atomically
+def refresh_snapshot(primary, snapshot):
+    temp = snapshot + '.tmp'
+    if os.path.exists(temp):
+        os.unlink(temp)
+    source = sqlite3.connect(primary)
+    target = sqlite3.connect(temp)
+    try:
+        source.execute('PRAGMA busy_timeout=5000')
+        source.backup(target)
+        # the snapshot is never written again, so it doesn't need the WAL (or its -shm) to be read
+        target.execute('PRAGMA journal_mode=DELETE').fetchall()
+    finally:
+        target.close()
+        source.close()
+    os.replace(temp, snapshot)
+
+
+def refresh_forever(primary, snapshot, interval=DEFAULT_SNAPSHOT_INTERVAL):
+    while True:
+        started = time.monotonic()
+        try:
+            refresh_snapshot(primary, snapshot)
+            print(f'Refreshed {snapshot} from {primary} in {time.monotonic() - started:.2f}s')
+        except sqlite3.Error as e:
+            print(f'Snapshot of {primary} failed: {e}')
+        time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+
+if __name__ == '__main__':
+    # python db_router.py <primary> <snapshot> [interval seconds]
+    if len(sys.argv) not in (3, 4):
+        print('Invalid arguments! Usage: python db_router.py <primary> <snapshot> [interval]')
+        sys.exit(1)
+    refresh_forever(sys.argv[1], sys.argv[2],
+                    float(sys.argv[3]) if len(sys.argv) == 4 else DEFAULT_SNAPSHOT_INTERVAL)
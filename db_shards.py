@@ -0,0 +1,452 @@
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import os
+import sqlite3
+import sys
+import threading
+import zlib
+
+import db_pool
+import db_split
+
+######################
+# Horizontal sharding of posts and votes by community_id (post_api and vote_api, SHARD_DIR set;
+# msg_api reads a community's posters from it for /messages/broadcast).
+#
+#   directory.db   community (community_id, community_name, shard) and the list of shards
+#   shard_<n>.db   posts and votes of the communities the directory assigns to shard n
+#
+# A post and its votes row always live in the same shard, so creating, voting on or deleting a post
+# is a single-file transaction. New communities are placed by a hash of their name; the directory
+# is the source of truth, which is what lets the resharding tool move a community later.
+#
+# Ids stay globally unique: each shard hands out post_ids (and the matching vote_id) from its own
+# counter in steps of SHARD_SLOTS, so shard n only ever allocates ids = n (mod SHARD_SLOTS).
+# Requests that only carry a post_id try the shard that id was allocated in (or the one it was last
+# found in), then the others; hits are remembered in a per-worker LRU.
+#
+# Queries that aren't about one community run on every shard in parallel and the ordered per-shard
+# results are k-way merged (heapq.merge), so /posts/filter and /votes/getTop return the same order
+# and keyset cursors as the single-file layout. Sharded reads are not streamed, the vote leaderboard
+# cache is off (getTop always merges), and the single-file features (db_writer, snapshots, db_split)
+# don't apply to shard files.
+#
+# Build shards from a migrated data.db, and change the number of shards later:
+# $ python db_shards.py split data.db shards/ 4
+# $ python db_shards.py reshard shards/ 8
+# Resharding moves whole communities (copy to the new shard, switch the directory, delete from the
+# old one); run it with the services stopped, or accept that global reads can briefly see a moving
+# community twice. A rerun finishes an interrupted move.
+#
+# App config keys (read by router_for_app):
+#   SHARD_DIR            directory of directory.db and the shard files; None (default) = no sharding
+#   SHARD_LOCATION_CACHE post_id -> shard entries remembered per worker
+
+SHARD_SLOTS = 64
+DIRECTORY = 'directory.db'
+SHARD_TABLES = ('posts', 'votes')
+DEFAULT_LOCATION_CACHE = 65536
+
+DIRECTORY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS community (
+    community_id INTEGER PRIMARY KEY,
+    community_name VARCHAR NOT NULL UNIQUE,
+    shard INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS shards (
+    shard INTEGER PRIMARY KEY
+);
+'''
+
+# the next id a shard allocates; always = shard (mod SHARD_SLOTS)
+SHARD_META_SCHEMA = 'CREATE TABLE IF NOT EXISTS shard_meta (next_id INTEGER NOT NULL)'
+
+# statements that create one post inside a shard transaction: take an id from the shard's counter,
+# use it for the votes row and the post
+CREATE_POST_QUERIES = (
+    'UPDATE shard_meta SET next_id = next_id + {}'.format(SHARD_SLOTS),
+    'INSERT INTO votes (vote_id, upvotes, downvotes, score) '
+    'VALUES ((SELECT next_id - {} FROM shard_meta), 0, 0, 0)'.format(SHARD_SLOTS),
+    'INSERT INTO posts (post_id, community_id, title, description, resource_url, username, vote_id) '
+    'VALUES ((SELECT next_id - {} FROM shard_meta),?,?,?,?,?,last_insert_rowid()) '
+    'RETURNING post_id, community_id'.format(SHARD_SLOTS),
+)
+
+
+def shard_path(directory, shard):
+    return os.path.join(directory, 'shard_{}.db'.format(shard))
+
+
+def directory_path(directory):
+    return os.path.join(directory, DIRECTORY)
+
+
+# shard a new community is placed on
+def home_shard(community_name, shards):
+    return shards[zlib.crc32(community_name.encode('utf-8')) % len(shards)]
+
+
+# smallest id above floor that shard may allocate
+def first_id(shard, floor):
+    return floor + 1 + (shard - floor - 1) % SHARD_SLOTS
+
+
+class ShardRouter:
+    # row_factory must build dicts (serialize.make_dicts): the merges read columns by name
+    def __init__(self, config, row_factory):
+        self.config = config
+        self.directory = config['SHARD_DIR']
+        self.row_factory = row_factory
+        self.location_cache = config.get('SHARD_LOCATION_CACHE', DEFAULT_LOCATION_CACHE)
+        self._lock = threading.Lock()
+        self._communities = {}                          # community_id -> shard
+        self._locations = collections.OrderedDict()     # post_id -> shard, least recently used first
+        self.shards = [row['shard'] for row in self.directory_query('SELECT shard FROM shards ORDER BY shard')]
+        if not self.shards:
+            raise sqlite3.OperationalError('{} lists no shards'.format(directory_path(self.directory)))
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.shards),
+                                                               thread_name_prefix='shard')
+        self.stats = {'scatters': 0, 'finds': 0, 'find_misses': 0, 'communities_created': 0}
+
+    def _pool(self, path):
+        return db_pool.pool_for_app(self.config, self.row_factory, database=path)
+
+    def pool(self, shard):
+        return self._pool(shard_path(self.directory, shard))
+
+    def _run(self, pool, fn):
+        conn = pool.acquire()
+        try:
+            return pool.retry_busy(conn, lambda: fn(conn))
+        finally:
+            pool.release(conn)
+
+    def directory_query(self, query, args=(), commit=False):
+        def run(conn):
+            rows = conn.execute(query, args).fetchall()
+            if commit:
+                conn.commit()
+            return rows
+        return self._run(self._pool(directory_path(self.directory)), run)
+
+    def query(self, shard, query, args=(), commit=False):
+        def run(conn):
+            rows = conn.execute(query, args).fetchall()
+            if commit:
+                conn.commit()
+            return rows
+        return self._run(self.pool(shard), run)
+
+    # run queries in one transaction on a shard; returns the rows of each
+    def transaction(self, shard, queries, args):
+        def run(conn):
+            rows = []
+            conn.execute('BEGIN')
+            try:
+                for query, query_args in zip(queries, args):
+                    rows.append(conn.execute(query, query_args).fetchall())
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+            return rows
+        return self._run(self.pool(shard), run)
+
+    # run one read on every shard in parallel; returns the row lists in shard order
+    def scatter(self, query, args=()):
+        self.stats['scatters'] += 1
+        futures = [self._executor.submit(self.query, shard, query, args) for shard in self.shards]
+        return [future.result() for future in futures]
+
+    # k-way merge of per-shard results that are each sorted by key, descending
+    @staticmethod
+    def merge(results, key, limit=None):
+        return list(itertools.islice(heapq.merge(*results, key=key, reverse=True), limit))
+
+    def shard_for_community(self, community_id):
+        shard = self._communities.get(community_id)
+        if shard is None:
+            rows = self.directory_query('SELECT shard FROM community WHERE community_id=?', (community_id,))
+            if not rows:
+                return None
+            shard = rows[0]['shard']
+            self._communities[community_id] = shard
+        return shard
+
+    # (community_id, True if this call created it)
+    def create_community(self, community_name):
+        rows = self.directory_query('INSERT OR IGNORE INTO community (community_name, shard) VALUES (?, ?) '
+                                    'RETURNING community_id, shard',
+                                    (community_name, home_shard(community_name, self.shards)), commit=True)
+        created = bool(rows)
+        if created:
+            self.stats['communities_created'] += 1
+        else:
+            rows = self.directory_query('SELECT community_id, shard FROM community WHERE community_name=?',
+                                        (community_name,))
+        self._communities[rows[0]['community_id']] = rows[0]['shard']
+        return rows[0]['community_id'], created
+
+    def _remember(self, post_id, shard):
+        with self._lock:
+            self._locations[post_id] = shard
+            self._locations.move_to_end(post_id)
+            while len(self._locations) > self.location_cache:
+                self._locations.popitem(last=False)
+
+    def remember(self, post_id, shard):
+        self._remember(post_id, shard)
+
+    def forget(self, post_id):
+        with self._lock:
+            self._locations.pop(post_id, None)
+
+    def _candidates(self, post_id):
+        with self._lock:
+            known = self._locations.get(post_id)
+        first = known if known is not None else post_id % SHARD_SLOTS
+        if first in self.shards:
+            return [first] + [shard for shard in self.shards if shard != first]
+        return list(self.shards)
+
+    # run a query about one post on the shard that holds it: the remembered/allocating shard first,
+    # then the rest. Returns (shard, rows), (None, []) if no shard has rows for it. Safe for
+    # UPDATE/DELETE ... RETURNING, which touch nothing on the shards without the post
+    def find(self, post_id, query, args, commit=False):
+        self.stats['finds'] += 1
+        candidates = self._candidates(post_id)
+        rows = self.query(candidates[0], query, args, commit)
+        if rows:
+            self._remember(post_id, candidates[0])
+            return candidates[0], rows
+        self.stats['find_misses'] += 1
+        for shard in candidates[1:]:
+            rows = self.query(shard, query, args, commit)
+            if rows:
+                self._remember(post_id, shard)
+                return shard, rows
+        self.forget(post_id)
+        return None, []
+
+    # shard holding post_id, None if there is no such post
+    def locate(self, post_id):
+        return self.find(post_id, 'SELECT 1 AS found FROM posts WHERE post_id=?', (post_id,))[0]
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats, locations=len(self._locations))
+        stats['shards'] = list(self.shards)
+        return stats
+
+
+_routers = {}
+_routers_lock = threading.Lock()
+
+
+# router described by a flask app config, None when SHARD_DIR isn't set
+def router_for_app(config, row_factory):
+    directory = config.get('SHARD_DIR')
+    if not directory:
+        return None
+    key = (os.getpid(), directory, row_factory)
+    router = _routers.get(key)
+    if router is None:
+        with _routers_lock:
+            router = _routers.get(key)
+            if router is None:
+                router = ShardRouter(config, row_factory)
+                _routers[key] = router
+    return router
+
+
+######################
+# Building and resharding
+
+def _connect(path):
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute('PRAGMA busy_timeout=5000')
+    return conn
+
+
+def _create_shard(directory, shard, table_sql, index_sql, floor):
+    conn = _connect(shard_path(directory, shard))
+    try:
+        conn.execute('PRAGMA journal_mode=WAL').fetchall()
+        conn.execute('BEGIN')
+        for sql in table_sql:
+            conn.execute(sql.replace('CREATE TABLE', 'CREATE TABLE IF NOT EXISTS', 1))
+        for sql in index_sql:
+            conn.execute(sql.replace('CREATE INDEX', 'CREATE INDEX IF NOT EXISTS', 1)
+                         .replace('CREATE UNIQUE INDEX', 'CREATE UNIQUE INDEX IF NOT EXISTS', 1))
+        conn.execute(SHARD_META_SCHEMA)
+        if conn.execute('SELECT count(*) FROM shard_meta').fetchone()[0] == 0:
+            conn.execute('INSERT INTO shard_meta (next_id) VALUES (?)', (first_id(shard, floor),))
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+
+
+def _schema(conn, schema, kind):
+    query = 'SELECT sql FROM {}.sqlite_master WHERE type=? AND tbl_name IN (?, ?) AND sql IS NOT NULL ' \
+            'ORDER BY name'.format(schema)
+    return [row[0] for row in conn.execute(query, (kind,) + SHARD_TABLES)]
+
+
+# highest post/vote id in any shard, so new shards start allocating above it
+def _id_floor(directory, shards):
+    floor = 0
+    for shard in shards:
+        conn = _connect(shard_path(directory, shard))
+        try:
+            for table, column in (('posts', 'post_id'), ('votes', 'vote_id')):
+                floor = max(floor, conn.execute('SELECT coalesce(max({}), 0) FROM {}'.format(column, table)).fetchone()[0])
+            floor = max(floor, conn.execute('SELECT coalesce(max(next_id), 0) FROM shard_meta').fetchone()[0])
+        finally:
+            conn.close()
+    return floor
+
+
+# shard a single-file data.db (or posts.db + votes.db of a split layout attached as one) into count shards
+def split_database(source, directory, count):
+    if not 0 < count <= SHARD_SLOTS:
+        raise ValueError('between 1 and {} shards'.format(SHARD_SLOTS))
+    os.makedirs(directory, exist_ok=True)
+    shards = list(range(count))
+    conn = _connect(directory_path(directory))
+    try:
+        conn.execute('ATTACH DATABASE ? AS source', (source,))
+        table_sql = [db_split.strip_foreign_keys(sql, SHARD_TABLES) for sql in _schema(conn, 'source', 'table')]
+        index_sql = _schema(conn, 'source', 'index')
+        floor = max(conn.execute('SELECT coalesce(max(post_id), 0) FROM source.posts').fetchone()[0],
+                    conn.execute('SELECT coalesce(max(vote_id), 0) FROM source.votes').fetchone()[0])
+        conn.executescript(DIRECTORY_SCHEMA)
+        conn.execute('BEGIN')
+        conn.executemany('INSERT OR IGNORE INTO shards (shard) VALUES (?)', [(shard,) for shard in shards])
+        for community_id, community_name in conn.execute(
+                'SELECT community_id, community_name FROM source.community').fetchall():
+            conn.execute('INSERT OR IGNORE INTO community (community_id, community_name, shard) VALUES (?, ?, ?)',
+                         (community_id, community_name, home_shard(community_name, shards)))
+        conn.execute('COMMIT')
+        placement = conn.execute('SELECT community_id, shard FROM community').fetchall()
+    finally:
+        conn.close()
+
+    for shard in shards:
+        _create_shard(directory, shard, table_sql, index_sql, floor)
+        conn = _connect(shard_path(directory, shard))
+        try:
+            conn.execute('ATTACH DATABASE ? AS source', (source,))
+            communities = [community_id for community_id, home in placement if home == shard]
+            conn.execute('BEGIN')
+            for community_id in communities:
+                conn.execute('INSERT OR REPLACE INTO main.votes SELECT votes.* FROM source.votes '
+                             'INNER JOIN source.posts ON posts.vote_id = votes.vote_id WHERE posts.community_id = ?',
+                             (community_id,))
+                conn.execute('INSERT OR REPLACE INTO main.posts SELECT * FROM source.posts WHERE community_id = ?',
+                             (community_id,))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+    return shards
+
+
+def _move_community(directory, community_id, source, target):
+    conn = _connect(shard_path(directory, target))
+    try:
+        conn.execute('ATTACH DATABASE ? AS source', (shard_path(directory, source),))
+        conn.execute('BEGIN')
+        conn.execute('INSERT OR REPLACE INTO main.votes SELECT votes.* FROM source.votes '
+                     'INNER JOIN source.posts ON posts.vote_id = votes.vote_id WHERE posts.community_id = ?',
+                     (community_id,))
+        conn.execute('INSERT OR REPLACE INTO main.posts SELECT * FROM source.posts WHERE community_id = ?',
+                     (community_id,))
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    conn = _connect(directory_path(directory))
+    try:
+        conn.execute('UPDATE community SET shard = ? WHERE community_id = ?', (target, community_id))
+    finally:
+        conn.close()
+
+
+# delete the rows each shard holds for communities the directory places elsewhere
+def _clean_shard(directory, shard):
+    conn = _connect(shard_path(directory, shard))
+    try:
+        conn.execute('ATTACH DATABASE ? AS directory', (directory_path(directory),))
+        elsewhere = 'SELECT community_id FROM directory.community WHERE shard != ?'
+        conn.execute('BEGIN')
+        conn.execute('DELETE FROM main.votes WHERE vote_id IN (SELECT vote_id FROM main.posts '
+                     'WHERE community_id IN ({}))'.format(elsewhere), (shard,))
+        removed = conn.execute('DELETE FROM main.posts WHERE community_id IN ({})'.format(elsewhere),
+                               (shard,)).rowcount
+        conn.execute('COMMIT')
+        return removed
+    finally:
+        conn.close()
+
+
+# change the number of shards, moving every community whose home shard changes
+def reshard(directory, count):
+    if not 0 < count <= SHARD_SLOTS:
+        raise ValueError('between 1 and {} shards'.format(SHARD_SLOTS))
+    conn = _connect(directory_path(directory))
+    try:
+        current = [row[0] for row in conn.execute('SELECT shard FROM shards ORDER BY shard')]
+        communities = conn.execute('SELECT community_id, community_name, shard FROM community').fetchall()
+    finally:
+        conn.close()
+    shards = list(range(count))
+
+    # new shard files start allocating above every id that exists anywhere
+    template = _connect(shard_path(directory, current[0]))
+    try:
+        table_sql = _schema(template, 'main', 'table')
+        index_sql = _schema(template, 'main', 'index')
+    finally:
+        template.close()
+    floor = _id_floor(directory, current)
+    for shard in shards:
+        if shard not in current:
+            _create_shard(directory, shard, table_sql, index_sql, floor)
+
+    conn = _connect(directory_path(directory))
+    try:
+        conn.execute('BEGIN')
+        conn.executemany('INSERT OR IGNORE INTO shards (shard) VALUES (?)', [(shard,) for shard in shards])
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+
+    moved = 0
+    for community_id, community_name, shard in communities:
+        target = home_shard(community_name, shards)
+        if target != shard:
+            _move_community(directory, community_id, shard, target)
+            moved += 1
+    for shard in sorted(set(current) | set(shards)):
+        _clean_shard(directory, shard)
+
+    # retired shards are empty now; drop them from the directory (their files are left for inspection)
+    conn = _connect(directory_path(directory))
+    try:
+        conn.execute('DELETE FROM shards WHERE shard >= ?', (count,))
+    finally:
+        conn.close()
+    return moved
+
+
+if __name__ == '__main__':
+    # python db_shards.py split <data.db> <directory> <count>
+    # python db_shards.py reshard <directory> <count>
+    if len(sys.argv) == 5 and sys.argv[1] == 'split':
+        print(f'Created shards {split_database(sys.argv[2], sys.argv[3], int(sys.argv[4]))} in {sys.argv[3]}')
+    elif len(sys.argv) == 4 and sys.argv[1] == 'reshard':
+        print(f'Moved {reshard(sys.argv[2], int(sys.argv[3]))} communities')
+    else:
+        print('Invalid arguments! Usage: python db_shards.py split <data.db> <directory> <count> | '
+              'reshard <directory> <count>')
+        sys.exit(1)
@@ -0,0 +1,128 @@
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+
+######################
+# Per-service database files. By default all four services share data.db. With DB_SPLIT_DIR set, each
+# service owns one file in that directory, so karma updates, messages, posts and votes each take
+# their own write lock:
+#   users.db     users               (user_api)
+#   messages.db  messages, favorite, broadcast_jobs  (msg_api)
+#   posts.db     community, posts    (post_api)
+#   votes.db     votes               (vote_api)
+#
+# A service's connections ATTACH the files it joins against (see db_pool). SQLite resolves an
+# unqualified table name through main and then the attached files, so the services' queries don't
+# change: vote_api's joins to posts, msg_api's username -> user_id lookups and its community
+# broadcasts read the attached files, and post_api still inserts and deletes a post's votes row.
+# In WAL mode a transaction spanning two files is atomic per file only, so a crash mid-/create can
+# leave an unreferenced votes row behind (harmless; nothing reads votes without a post). Foreign
+# keys can't span files, and the split tables don't declare them.
+#
+# Split an existing (migrated) data.db:
+# $ python db_split.py data.db split/
+# then set DB_SPLIT_DIR = 'split' in each service's config. `flask init` in split mode builds only
+# that service's file from data.sql.
+#
+# App config keys (read by layout_for_app):
+#   DB_SERVICE         which service the app is: users, messages, posts or votes
+#   DB_SPLIT_DIR       directory of the per-service files; None (default) uses DATABASE for everything
+
+SERVICES = {
+    'users': {'tables': ('users',), 'attach': ()},
+    'messages': {'tables': ('messages', 'favorite', 'broadcast_jobs'), 'attach': ('users', 'posts')},
+    'posts': {'tables': ('community', 'posts'), 'attach': ('votes',)},
+    'votes': {'tables': ('votes',), 'attach': ('posts',)},
+}
+
+_foreign_key = re.compile(r',\s*FOREIGN KEY\s*\([^)]*\)\s*REFERENCES\s+(\w+)\s*\([^)]*\)', re.IGNORECASE)
+
+
+def path_for(directory, service):
+    return os.path.join(directory, service + '.db')
+
+
+# (database, ((schema, path), ...)) a service's connections open
+def layout_for_app(config):
+    directory = config.get('DB_SPLIT_DIR')
+    service = config.get('DB_SERVICE')
+    if not directory or not service:
+        return config['DATABASE'], ()
+    attach = tuple((name + '_db', path_for(directory, name)) for name in SERVICES[service]['attach'])
+    return path_for(directory, service), attach
+
+
+# CREATE TABLE statement without the foreign keys that point at another service's tables
+def strip_foreign_keys(sql, tables):
+    return _foreign_key.sub(lambda m: m.group(0) if m.group(1) in tables else '', sql)
+
+
+def _schema(conn, kind, tables):
+    marks = ','.join('?' * len(tables))
+    query = 'SELECT name, sql FROM source.sqlite_master WHERE type=? AND tbl_name IN ({}) AND sql IS NOT NULL ' \
+            'ORDER BY name'.format(marks)
+    return conn.execute(query, (kind,) + tuple(tables)).fetchall()
+
+
+# write each service's tables, rows and indexes from source into its own file in directory.
+# Every file gets the source's schema version; files are built aside and renamed into place
+def split_database(source, directory, services=tuple(SERVICES)):
+    os.makedirs(directory, exist_ok=True)
+    written = []
+    for service in services:
+        tables = SERVICES[service]['tables']
+        path = path_for(directory, service)
+        temp = path + '.tmp'
+        if os.path.exists(temp):
+            os.unlink(temp)
+        conn = sqlite3.connect(temp, isolation_level=None)
+        try:
+            conn.execute('ATTACH DATABASE ? AS source', (source,))
+            version = conn.execute('PRAGMA source.user_version').fetchone()[0]
+            table_sql = _schema(conn, 'table', tables)
+            index_sql = _schema(conn, 'index', tables)
+            missing = set(tables) - set(name for name, _ in table_sql)
+            if missing:
+                raise sqlite3.OperationalError('{} has no table {}'.format(source, ', '.join(sorted(missing))))
+            conn.execute('BEGIN')
+            for name, sql in table_sql:
+                conn.execute(strip_foreign_keys(sql, tables))
+                conn.execute('INSERT INTO main.{0} SELECT * FROM source.{0}'.format(name))
+            conn.execute('COMMIT')
+            conn.execute('DETACH DATABASE source')
+            # indexes after the rows: one sort per index instead of a b-tree insert per row
+            conn.execute('BEGIN')
+            for _, sql in index_sql:
+                conn.execute(sql)
+            conn.execute('PRAGMA user_version = {}'.format(int(version)))
+            conn.execute('COMMIT')
+            conn.execute('PRAGMA journal_mode=WAL').fetchall()
+        finally:
+            conn.close()
+        os.replace(temp, path)
+        written.append(path)
+    return written
+
+
+# `flask init` for a split service: run the schema script on a scratch file and keep this service's part
+def init_split(config, script):
+    directory = config['DB_SPLIT_DIR']
+    with tempfile.TemporaryDirectory() as scratch:
+        full = os.path.join(scratch, 'data.db')
+        conn = sqlite3.connect(full)
+        try:
+            conn.executescript(script)
+        finally:
+            conn.close()
+        return split_database(full, directory, (config['DB_SERVICE'],))
+
+
+if __name__ == '__main__':
+    # python db_split.py <data.db> <directory>
+    if len(sys.argv) != 3:
+        print('Invalid arguments! Usage: python db_split.py <data.db> <directory>')
+        sys.exit(1)
+    for path in split_database(sys.argv[1], sys.argv[2]):
+        print(f'Wrote {path}')
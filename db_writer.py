@@ -0,0 +1,335 @@
+import os
+import queue
+import socket
+import socketserver
+import sqlite3
+import struct
+import sys
+import threading
+import time
+
+import db_pool
+import serialize
+
+######################
+# Optional single-writer daemon. Every write from the four services (query_db(commit=True) and
+# transaction_db) goes over a Unix socket to this one process, which owns the only write connection
+# to the database. Writes queued while a commit is in progress are group-committed: one
+# BEGIN IMMEDIATE ... COMMIT (one WAL fsync, no lock handoff between workers) covers the whole batch.
+# Each request runs inside its own SAVEPOINT, so a failing request is rolled back alone and the rest
+# of its batch still commits; callers see the same all-or-nothing behaviour as before.
+#
+# Start it next to the services, then set DB_WRITER_SOCKET in each app's config:
+# $ python db_writer.py data.db /tmp/csuf-writer.sock
+# With per-service files (db_split) run one daemon per file, attaching what that service joins against:
+# $ python db_writer.py split/posts.db /tmp/csuf-posts-writer.sock votes_db=split/votes.db
+#
+# App config keys (read by writer_for_app):
+#   DB_WRITER_SOCKET   path of the daemon's socket; None (default) writes on the pooled connections
+#   DB_WRITER_TIMEOUT  seconds to wait for a reply before answering 503
+#
+# Daemon settings (constants below):
+#   WRITER_BATCH_MAX   requests per group commit
+#   WRITER_MAX_DELAY   seconds the writer lingers for more requests once one arrives (0 = only
+#                      batch what queued up during the previous commit)
+#
+# Wire format: each message is a 4-byte big-endian length and a JSON body.
+#   request  {"queries": [sql, ...], "args": [[...], ...]}
+#   reply    {"results": [[row, ...], ...]} or {"error": "IntegrityError", "message": "..."}
+# Rows are dicts like make_dicts builds; TIMESTAMP values come back as the HTTP date strings the
+# services would send anyway.
+
+DEFAULT_TIMEOUT = 10.0
+WRITER_BATCH_MAX = 256
+WRITER_MAX_DELAY = 0.0
+
+_header = struct.Struct('>I')
+
+
+class WriterError(Exception):
+    pass
+
+
+def send_message(sock, obj):
+    body = serialize.dumps_bytes(obj)
+    sock.sendall(_header.pack(len(body)) + body)
+
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data.extend(chunk)
+    return bytes(data)
+
+
+# next message from the socket, None when the peer closed it
+def recv_message(sock):
+    header = _recv_exactly(sock, _header.size)
+    if header is None:
+        return None
+    body = _recv_exactly(sock, _header.unpack(header)[0])
+    if body is None:
+        return None
+    return serialize.loads(body)
+
+
+######################
+# Daemon
+
+class _Job:
+    def __init__(self, queries, args):
+        self.queries = queries
+        self.args = args
+        self.reply = None
+        self.done = threading.Event()
+
+
+class Writer:
+    def __init__(self, database, batch_max=WRITER_BATCH_MAX, max_delay=WRITER_MAX_DELAY, attach=()):
+        self.batch_max = batch_max
+        self.max_delay = max_delay
+        self.pool = db_pool.ConnectionPool(database, size=1, row_factory=serialize.make_dicts, attach=attach)
+        self._jobs = queue.Queue()
+        self.stats = {'requests': 0, 'commits': 0, 'failed_requests': 0, 'failed_commits': 0,
+                      'largest_batch': 0}
+
+    def submit(self, queries, args):
+        job = _Job(queries, args)
+        self._jobs.put(job)
+        job.done.wait()
+        return job.reply
+
+    def _next_batch(self):
+        batch = [self._jobs.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.batch_max:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._jobs.get(timeout=remaining) if remaining > 0 else self._jobs.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _connect(self):
+        while True:
+            try:
+                conn = self.pool.acquire()
+                break
+            except db_pool.DatabaseBusy as e:
+                print(f'Writer waiting for the database: {e}')
+                time.sleep(1)
+        conn.isolation_level = None
+        return conn
+
+    def run(self):
+        conn = self._connect()
+        while True:
+            batch = self._next_batch()
+            try:
+                replies = self.pool.retry_busy(conn, lambda: self._commit(conn, batch))
+            except Exception as e:
+                # whatever failed, the write lock is given back and every client of the batch answered;
+                # the thread itself must never die, every service's writes depend on it
+                print(f'Group commit of {len(batch)} requests failed: {e!r}')
+                try:
+                    if conn.in_transaction:
+                        conn.rollback()
+                except sqlite3.Error as rollback_error:
+                    print(f'Writer rollback failed, reconnecting: {rollback_error}')
+                    self.pool.release(conn)     # closes it, as its rollback failed
+                    conn = self._connect()
+                busy = isinstance(e, db_pool.DatabaseBusy) or db_pool.is_busy_error(e)
+                reply = {'error': 'DatabaseBusy' if busy else type(e).__name__, 'message': str(e)}
+                replies = [reply] * len(batch)
+                self.stats['failed_commits'] += 1
+            self.stats['requests'] += len(batch)
+            self.stats['largest_batch'] = max(self.stats['largest_batch'], len(batch))
+            for job, reply in zip(batch, replies):
+                job.reply = reply
+                job.done.set()
+
+    # one transaction for the batch, a savepoint per request
+    def _commit(self, conn, batch):
+        replies = []
+        failed = 0
+        conn.execute('BEGIN IMMEDIATE')
+        for job in batch:
+            conn.execute('SAVEPOINT job')
+            try:
+                if len(job.queries) != len(job.args):
+                    raise sqlite3.ProgrammingError('arguments dont match queries')
+                results = [conn.execute(query, args).fetchall() for query, args in zip(job.queries, job.args)]
+            except Exception as e:
+                # anything a request's own statements raise (an IntegrityError, an int too large for
+                # sqlite's OverflowError) fails that request alone
+                if db_pool.is_busy_error(e):
+                    raise
+                conn.execute('ROLLBACK TO job')
+                conn.execute('RELEASE job')
+                replies.append({'error': type(e).__name__, 'message': str(e)})
+                failed += 1
+                continue
+            conn.execute('RELEASE job')
+            replies.append({'results': results})
+        conn.execute('COMMIT')
+        self.stats['commits'] += 1
+        self.stats['failed_requests'] += failed
+        return replies
+
+
+# None if a request message is well formed, else why not: queries a list of SQL strings, args a list
+# of the same length holding a list of scalar parameters per query
+def check_request(message):
+    queries = message.get('queries')
+    args = message.get('args')
+    if not isinstance(queries, list) or not isinstance(args, list):
+        return 'queries and args must be lists'
+    if len(queries) != len(args):
+        return 'arguments dont match queries'
+    if not all(isinstance(query, str) for query in queries):
+        return 'queries must be SQL strings'
+    for query_args in args:
+        if not isinstance(query_args, list):
+            return 'args must hold one list of parameters per query'
+        if not all(arg is None or isinstance(arg, (int, float, str)) for arg in query_args):
+            return 'parameters must be scalars'
+    return None
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                message = recv_message(self.request)
+            except (OSError, ValueError) as e:
+                print(f'Dropping writer client: {e}')
+                return
+            if not isinstance(message, dict):
+                return
+            if message.get('stats'):
+                reply = dict(self.server.writer.stats)
+            else:
+                # a malformed request is refused here instead of reaching the shared transaction
+                problem = check_request(message)
+                if problem is None:
+                    reply = self.server.writer.submit(message['queries'], message['args'])
+                else:
+                    reply = {'error': 'ProgrammingError', 'message': problem}
+            try:
+                send_message(self.request, reply)
+            except OSError:
+                return
+
+
+class WriterServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, writer):
+        self.writer = writer
+        if os.path.exists(path):
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, _Handler)
+
+
+def serve(database, path, attach=()):
+    writer = Writer(database, attach=attach)
+    threading.Thread(target=writer.run, name='writer', daemon=True).start()
+    with WriterServer(path, writer) as server:
+        print(f'Writing to {database} for clients of {path}')
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(path)
+
+
+######################
+# Client, used by the services
+
+class WriterClient:
+    def __init__(self, path, timeout=DEFAULT_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        # one socket per thread: a request owns its socket for the whole round trip
+        self._local = threading.local()
+
+    def _socket(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            self._local.sock = sock
+        return sock
+
+    def _close(self):
+        sock = getattr(self._local, 'sock', None)
+        self._local.sock = None
+        if sock is not None:
+            sock.close()
+
+    def _call(self, message):
+        # a socket left over from a restarted daemon fails on first use; reconnect once
+        for attempt in range(2):
+            try:
+                sock = self._socket()
+                send_message(sock, message)
+                reply = recv_message(sock)
+            except socket.timeout as e:
+                self._close()
+                raise db_pool.DatabaseBusy('no reply from writer at {}: {}'.format(self.path, e))
+            except OSError as e:
+                self._close()
+                if attempt:
+                    raise db_pool.DatabaseBusy('writer at {} unavailable: {}'.format(self.path, e))
+                continue
+            if reply is not None:
+                return reply
+            self._close()
+        raise db_pool.DatabaseBusy('writer at {} closed the connection'.format(self.path))
+
+    # run queries in one transaction on the writer; returns the rows of each query. Errors are raised
+    # as the sqlite3 exception the writer hit, so callers handle them as if they ran the queries
+    def execute(self, queries, args):
+        reply = self._call({'queries': list(queries), 'args': [list(a) for a in args]})
+        if 'error' in reply:
+            if reply['error'] == 'DatabaseBusy':
+                raise db_pool.DatabaseBusy(reply['message'])
+            error = getattr(sqlite3, reply['error'], None)
+            if not (isinstance(error, type) and issubclass(error, sqlite3.Error)):
+                error = WriterError
+            raise error(reply['message'])
+        return reply['results']
+
+    def metrics(self):
+        return self._call({'stats': True})
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+# client for the writer described by a flask app config, None when writes stay local
+def writer_for_app(config):
+    path = config.get('DB_WRITER_SOCKET')
+    if not path:
+        return None
+    key = (os.getpid(), path)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = WriterClient(path, config.get('DB_WRITER_TIMEOUT', DEFAULT_TIMEOUT))
+                _clients[key] = client
+    return client
+
+
+if __name__ == '__main__':
+    # python db_writer.py <database> <socket> [schema=path ...]
+    if len(sys.argv) < 3 or not all('=' in arg for arg in sys.argv[3:]):
+        print('Invalid arguments! Usage: python db_writer.py <database> <socket> [schema=path ...]')
+        sys.exit(1)
+    serve(sys.argv[1], sys.argv[2], tuple(tuple(arg.split('=', 1)) for arg in sys.argv[3:]))
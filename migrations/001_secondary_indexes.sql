@@ -0,0 +1,14 @@
+-- 001: UNIQUE usernames/emails/community names and secondary indexes for the hot lookups
+-- (fresh databases get the same thing from data.sql)
+
+CREATE UNIQUE INDEX IF NOT EXISTS uq_users_username ON users (username);
+CREATE UNIQUE INDEX IF NOT EXISTS uq_users_email ON users (email);
+CREATE UNIQUE INDEX IF NOT EXISTS uq_community_name ON community (community_name);
+
+CREATE INDEX IF NOT EXISTS idx_posts_published ON posts (published);
+CREATE INDEX IF NOT EXISTS idx_posts_community_published ON posts (community_id, published);
+CREATE INDEX IF NOT EXISTS idx_posts_username_published ON posts (username, published);
+CREATE INDEX IF NOT EXISTS idx_posts_vote_id ON posts (vote_id);
+CREATE INDEX IF NOT EXISTS idx_messages_user_to ON messages (user_to);
+CREATE INDEX IF NOT EXISTS idx_messages_user_from ON messages (user_from);
+CREATE INDEX IF NOT EXISTS idx_favorite_msg_id ON favorite (msg_ID);
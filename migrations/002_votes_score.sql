@@ -0,0 +1,6 @@
+-- 002: denormalized score (upvotes - downvotes) on votes, indexed for /votes/getTop
+-- kept up to date by vote_api's upvote/downvote updates; `flask rebuild_scores` re-derives it
+
+ALTER TABLE votes ADD COLUMN score INTEGER NOT NULL DEFAULT 0;
+UPDATE votes SET score = upvotes - downvotes;
+CREATE INDEX IF NOT EXISTS idx_votes_score ON votes (abs(score), vote_id);
@@ -0,0 +1,10 @@
+-- 003: inbox/outbox/thread reads in msg_api: per-user (recipient or sender, time) indexes for
+-- keyset pages, and a read flag with a partial index so unread counts only touch unread rows.
+-- The single-column user_to/user_from indexes are prefixes of the new ones and go away.
+
+ALTER TABLE messages ADD COLUMN msg_read INTEGER NOT NULL DEFAULT 0;
+DROP INDEX IF EXISTS idx_messages_user_to;
+DROP INDEX IF EXISTS idx_messages_user_from;
+CREATE INDEX IF NOT EXISTS idx_messages_to_time ON messages (user_to, msg_time);
+CREATE INDEX IF NOT EXISTS idx_messages_from_time ON messages (user_from, msg_time);
+CREATE INDEX IF NOT EXISTS idx_messages_unread ON messages (user_to) WHERE msg_read = 0;
@@ -0,0 +1,12 @@
+-- 004: progress of msg_api /broadcast fan-outs that run in the background, readable from any worker
+
+CREATE TABLE IF NOT EXISTS broadcast_jobs (
+    job_id VARCHAR PRIMARY KEY,
+    user_from INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    sent INTEGER NOT NULL DEFAULT 0,
+    state VARCHAR NOT NULL DEFAULT 'queued',
+    error VARCHAR,
+    created TIMESTAMP DEFAULT (DATETIME('now', 'localtime')),
+    updated TIMESTAMP
+);
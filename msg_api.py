@@ -1,6 +1,20 @@
 import flask
 from flask import request, jsonify, g, current_app
+import concurrent.futures
+import json
+import os
 import sqlite3
+import threading
+import uuid
+
+import db_migrate
+import db_pool
+import db_shards
+import db_split
+import db_writer
+import pagination
+import serialize
+import user_ids
 
 ######################
 # API USAGE
@@ -20,15 +34,68 @@ import sqlite3
 # Favorite a message: Send a POST request to route of favorite() fn
 # Example request:
 # curl -i -X POST -H 'Content-Type:application/json' http://localhost:2015/messages/favorite?msg_id=1;
+# --------------------
+# Read messages, newest first, a page at a time: GET inbox (received), outbox (sent) or thread (both
+# directions between username and other). Each returns {"results": [...], "next_cursor": ...}; send
+# next_cursor back as cursor for the following page.
+# Example requests:
+# curl -i 'http://localhost:2015/messages/inbox?username=ilovecat&n=20';
+# curl -i 'http://localhost:2015/messages/outbox?username=ilovedog&n=20&cursor=WyIyMDIwLTA0LTAxIDEwOjAwOjAwIiwzXQ';
+# curl -i 'http://localhost:2015/messages/thread?username=ilovedog&other=ilovecat';
+# --------------------
+# Count a user's unread messages, and mark a message read:
+# curl -i 'http://localhost:2015/messages/unread?username=ilovecat';
+# curl -i -X POST http://localhost:2015/messages/read?msg_id=1;
+# --------------------
+# Send one message to many users (a list of usernames, or everyone who has posted in a community):
+# Example requests:
+#   curl -i -X POST -H 'Content-Type:application/json' -d
+#   '{"user_from":"ilovedog", "recipients":["ilovecat", "tex"], "msg_content":"Meetup on friday", "msg_flag":"announcement"}'
+#   http://localhost:2015/messages/broadcast;
+#   curl -i -X POST -H 'Content-Type:application/json' -d
+#   '{"user_from":"ilovedog", "community_name":"coronavirus", "msg_content":"Stay home", "msg_flag":"announcement"}'
+#   http://localhost:2015/messages/broadcast;
+# Fan-outs over BROADCAST_SYNC_MAX recipients answer 202 with a job_id; follow their progress with
+# curl -i 'http://localhost:2015/messages/broadcast_status?job_id=...';
 
 
 # config variables
 DATABASE = 'data.db'
+DB_SERVICE = 'messages'
+DB_SPLIT_DIR = None
 DEBUG = True
+POOL_SIZE = 5
+POOL_TIMEOUT = 5.0
+POOL_HEALTH_CHECK = 30.0
+DB_WRITER_SOCKET = None
+# directory of a sharded posts/votes layout (see db_shards); set it like post_api's so community
+# broadcasts find the community's posters in the shard files
+SHARD_DIR = None
+# messages per inbox/outbox/thread page: when n isn't given, and the most n may ask for
+MESSAGE_PAGE_SIZE = 20
+MESSAGE_PAGE_MAX = 500
+# /broadcast: messages inserted per transaction, the most recipients answered inline (larger fan-outs
+# run on BROADCAST_WORKERS background threads per worker and answer 202 with a job id), and the most
+# recipients one broadcast may have
+BROADCAST_CHUNK_SIZE = 500
+BROADCAST_SYNC_MAX = 1000
+BROADCAST_WORKERS = 1
+BROADCAST_MAX_RECIPIENTS = 100000
+# jobs live only in the worker that queued them: a restart loses its queued and running jobs. Their
+# rows stop moving, so /broadcast_status flags a job queued or running with no progress for this
+# many seconds as stale
+BROADCAST_STALE_AFTER = 600
+# username -> user_id cache shared with the other service (see user_ids); 'file' so user_api's
+# invalidations on /register and /delete reach every msg_api worker
+USER_ID_CACHE_BACKEND = 'file'
+USER_ID_CACHE_SIZE = 10000
+USER_ID_CACHE_TTL = 300.0
+USER_ID_CACHE_DIR = 'user_id_cache'
 
 ######################
 app = flask.Flask(__name__)
 app.config.from_object(__name__)
+serialize.install(app)
 
 ######################
 # Database
@@ -48,11 +115,11 @@ app.config.from_object(__name__)
 # msg_time
 # msg_content
 # msg_flag
+# msg_read
 
 ######################
-# helper function used to convert each query result row into dictionary
-def make_dicts(cursor, row):
-    return dict((cursor.description[idx][0], value) for idx, value in enumerate(row))
+# helper function used to convert each query result row into dictionary (see serialize)
+make_dicts = serialize.make_dicts
 
 
 # helper function to generate a response with status code and message
@@ -60,14 +127,30 @@ def get_response(status_code, message):
     return {"status_code": str(status_code), "message": str(message)}
 
 
-# get db from flask g namespace
+# pool of long-lived connections for this worker
+def get_db_pool():
+    return db_pool.pool_for_app(current_app.config, row_factory=make_dicts)
+
+
+# client of the single-writer daemon when DB_WRITER_SOCKET is set (see db_writer), else None
+def get_writer():
+    return db_writer.writer_for_app(current_app.config)
+
+
+# router over the shard files when SHARD_DIR is set (see db_shards), else None
+def get_shards():
+    return db_shards.router_for_app(current_app.config, row_factory=make_dicts)
+
+
+# this worker's username -> user_id cache (None when USER_ID_CACHE_BACKEND is off)
+def get_user_ids():
+    return user_ids.cache_for_app(current_app.config, current_app.root_path)
+
+
+# get db from flask g namespace (checked out of the worker's pool, returned on teardown)
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = make_dicts
+        g.db = get_db_pool().acquire()
     return g.db
 
 
@@ -77,12 +160,27 @@ def get_db():
 @app.cli.command('init')
 def init_db():
     with app.app_context():
+        if app.config['DB_SPLIT_DIR']:
+            # split mode: build only this service's file (see db_split)
+            with app.open_resource('data.sql', mode='r') as f:
+                db_split.init_split(app.config, f.read())
+            return
         db = get_db()
+        # the pooled connection has already applied the WAL/pragma profile (see db_pool)
         with app.open_resource('data.sql', mode='r') as f:
             db.cursor().executescript(f.read())
         db.commit()
 
 
+# bring an existing db up to the current schema version in place
+# $flask migrate
+@app.cli.command('migrate')
+def migrate_db():
+    with app.app_context():
+        for name in db_migrate.migrate(get_db()):
+            print(f'Applied migration {name}')
+
+
 # close db connection
 @app.teardown_appcontext
 def close_db(e=None):
@@ -90,7 +188,7 @@ def close_db(e=None):
         print(f'Closing db: {e}')
     db = g.pop('db', None)
     if db is not None:
-        db.close()
+        get_db_pool().release(db)
 
 
 # home page
@@ -106,19 +204,52 @@ def page_not_found(status_code=404):
     return jsonify(error_json), status_code
 
 
+# database stayed locked past DB_BUSY_RETRIES (or no pooled connection freed up within POOL_TIMEOUT)
+@app.errorhandler(db_pool.DatabaseBusy)
+def database_busy(e):
+    print(e)
+    response = jsonify(get_response(status_code=503, message="Database busy, try again"))
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+# connection pool usage for this worker
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    stats = {'pool': get_db_pool().metrics()}
+    if get_user_ids() is not None:
+        stats['user_ids'] = get_user_ids().metrics()
+    if get_writer() is not None:
+        stats['writer'] = get_writer().metrics()
+    return jsonify(stats), 200
+
+
 # function to execute a single query at once
 def query_db(query, args=(), one=False, commit=False):
     # one=True means return single record
     # commit = True for post and delete query (return boolean)
+    writer = get_writer() if commit else None
+    if writer is not None:
+        try:
+            writer.execute([query], [args])
+        except sqlite3.OperationalError as e:
+            print(e)
+            return False
+        return True
     conn = get_db()
-    try:
+
+    def run():
         rv = conn.execute(query, args).fetchall()
         if commit:
             conn.commit()
+        return rv
+
+    try:
+        rv = get_db_pool().retry_busy(conn, run)
     except sqlite3.OperationalError as e:
         print(e)
         return False
-    close_db()
     if not commit:
         return (rv[0] if rv else None) if one else rv
     return True
@@ -127,21 +258,35 @@ def query_db(query, args=(), one=False, commit=False):
 # function to execute multiple queries at once (also fn commits the transaction)
 def transaction_db(query, args, return_=False):
     # return_=True if the transaction needs returns a result
-    conn = get_db()
     if len(query) != len(args):
         raise ValueError('arguments dont match queries')
-    try:
+    writer = get_writer()
+    if writer is not None:
+        try:
+            rv = writer.execute(query, args)
+        except (sqlite3.OperationalError, sqlite3.ProgrammingError) as e:
+            print('Transaction failed. Rolled back')
+            print(e)
+            return False
+        return True if not return_ else rv
+    conn = get_db()
+
+    def run():
         rv = []
         conn.execute('BEGIN')
         for i in range(len(query)):
             rv.append(conn.execute(query[i], args[i]).fetchall())
         conn.commit()
+        return rv
+
+    try:
+        rv = get_db_pool().retry_busy(conn, run)
     except (sqlite3.OperationalError, sqlite3.ProgrammingError) as e:
-        conn.execute('rollback')
+        if conn.in_transaction:
+            conn.execute('rollback')
         print('Transaction failed. Rolled back')
         print(e)
         return False
-    close_db()
     return True if not return_ else rv
 
 ### WHAT TO DO ###
@@ -149,6 +294,12 @@ def transaction_db(query, args, return_=False):
 # 2. Delete message
 # 3. Favorite message
 
+# one statement per message: ids come resolved from the user_ids cache, and the primary key checks
+# make sure each id still belongs to the username it was resolved from
+SEND_QUERY = 'INSERT INTO messages (user_from, user_to, msg_content, msg_flag) SELECT ?, ?, ?, ? ' \
+             'WHERE EXISTS (SELECT 1 FROM users WHERE user_id = ? AND username = ?) ' \
+             'AND EXISTS (SELECT 1 FROM users WHERE user_id = ? AND username = ?) RETURNING msg_id'
+
 @app.route('/send', methods=['POST'])
 def send():
     params = request.get_json()
@@ -160,24 +311,27 @@ def send():
     if not user_from or not user_to:
         return jsonify(get_response(status_code=409, message="Sender / Recipient is not provided")), 409
 
-    query1 = 'SELECT username FROM users WHERE username = ?'
-    args1 = (user_from,)
-    q_sender = query_db(query1, args1)
-
-    query2 = "SELECT username FROM users WHERE username = ?"
-    args2 = (user_to,)
-    q_receiver = query_db(query2, args2)
-
-    if not q_sender:
-        return jsonify(get_response(status_code=404, message="Sender not existed")), 404
-    if not q_receiver:
-        return jsonify(get_response(status_code=404, message="Receiver not existed")), 404
-
-    query = 'INSERT INTO messages (user_from, user_to, msg_content, msg_flag) VALUES ((SELECT user_id FROM users WHERE username=?), (SELECT user_id FROM users WHERE username=?), ?, ?)'
-    args = (user_from, user_to, msg_content, msg_flag)
-    q = transaction_db(query=[query], args=[args], return_=True)
-
-    if not q:
+    cache = get_user_ids()
+    # a cached id may be stale (user deleted or re-registered through another worker): the insert
+    # then adds nothing, and the ids are looked up again once
+    for attempt in range(2):
+        ids = user_ids.resolve(cache, (user_from, user_to), query_db)
+        if ids is False:
+            return page_not_found(404)
+        if user_from not in ids:
+            return jsonify(get_response(status_code=404, message="Sender not existed")), 404
+        if user_to not in ids:
+            return jsonify(get_response(status_code=404, message="Receiver not existed")), 404
+
+        args = (ids[user_from], ids[user_to], msg_content, msg_flag, ids[user_from], user_from, ids[user_to], user_to)
+        q = transaction_db(query=[SEND_QUERY], args=[args], return_=True)
+
+        if not q:
+            return page_not_found(404)
+        if q[0]:
+            break
+        user_ids.invalidate(cache, user_from, user_to)
+    else:
         return page_not_found(404)
 
     return jsonify(get_response(status_code=201, message="Message sent")), 201
@@ -236,6 +390,363 @@ def favorite():
 
     return jsonify(get_response(status_code=201, message="Message favorited")), 201
 
+# Message reads. Every page is a range scan of (user_to, msg_time) or (user_from, msg_time) that starts
+# after the (msg_time, msg_id) of the previous page's last message; usernames are resolved inside the
+# statement, so a page is one query however deep the client goes.
+MESSAGE_COLUMNS = 'messages.msg_id, messages.msg_time, messages.msg_content, messages.msg_flag, messages.msg_read'
+USER_ID_OF = '(SELECT user_id FROM users WHERE username = ?)'
+MESSAGE_KEYSET = ' AND (messages.msg_time, messages.msg_id) < (?, ?)'
+MESSAGE_ORDER = ' ORDER BY msg_time DESC, msg_id DESC LIMIT ?'
+
+
+# received (column user_to) or sent (user_from) messages of a user, with the other side's username
+def mailbox_query(column, other, keyset):
+    query = 'SELECT {}, users.username AS {} FROM messages LEFT JOIN users ON users.user_id = messages.{} ' \
+            'WHERE messages.{} = {}'.format(MESSAGE_COLUMNS, other, other, column, USER_ID_OF)
+    return query + (MESSAGE_KEYSET if keyset else '') + MESSAGE_ORDER
+
+
+# both directions between two users: two index walks merged in order (no sort of the whole thread)
+def thread_query(keyset):
+    arm = 'SELECT {}, ? AS user_from, ? AS user_to FROM messages WHERE messages.user_from = {} ' \
+          'AND messages.user_to = {}'.format(MESSAGE_COLUMNS, USER_ID_OF, USER_ID_OF)
+    if keyset:
+        arm += MESSAGE_KEYSET
+    return arm + ' UNION ALL ' + arm + MESSAGE_ORDER
+
+
+# counts entries of the partial unread index only
+UNREAD_QUERY = 'SELECT count(*) AS unread FROM messages WHERE user_to = {} AND msg_read = 0'.format(USER_ID_OF)
+
+
+# (n, cursor values or None) of a page request; raises ValueError / pagination.InvalidCursor
+def message_page_params(params):
+    n = int(params.get('n') or current_app.config['MESSAGE_PAGE_SIZE'])
+    if not 0 < n <= current_app.config['MESSAGE_PAGE_MAX']:
+        raise ValueError(n)
+    cursor = params.get('cursor')
+    return n, (pagination.decode_cursor(cursor, str, int) if cursor else None)
+
+
+def message_page(rows, n):
+    next_cursor = None
+    if len(rows) == n:
+        next_cursor = pagination.encode_cursor(str(rows[-1]['msg_time']), rows[-1]['msg_id'])
+    return jsonify(pagination.page(rows, next_cursor)), 200
+
+
+# usernames (of those given) that have no user; only asked when a page comes back empty
+def missing_users(*usernames):
+    ids = user_ids.resolve(get_user_ids(), usernames, query_db)
+    if ids is False:
+        return False
+    return [username for username in usernames if username not in ids]
+
+
+def get_mailbox(column, other):
+    params = request.args
+    username = params.get('username')
+    if not username:
+        return jsonify(get_response(status_code=409, message="Username is not provided")), 409
+    try:
+        n, cursor = message_page_params(params)
+    except pagination.InvalidCursor:
+        return jsonify(get_response(status_code=400, message="Invalid cursor")), 400
+    except ValueError:
+        return jsonify(get_response(status_code=400, message="Invalid n")), 400
+
+    args = [username] + (cursor or []) + [n]
+    rows = query_db(mailbox_query(column, other, cursor is not None), tuple(args))
+    if rows is False:
+        return page_not_found(404)
+    if not rows:
+        missing = missing_users(username)
+        if missing is False:
+            return page_not_found(404)
+        if missing:
+            return jsonify(get_response(status_code=404, message="User not existed")), 404
+    for row in rows:
+        row[column] = username
+    return message_page(rows, n)
+
+
+# messages received by username, newest first
+@app.route('/inbox', methods=['GET'])
+def inbox():
+    return get_mailbox('user_to', 'user_from')
+
+
+# messages sent by username, newest first
+@app.route('/outbox', methods=['GET'])
+def outbox():
+    return get_mailbox('user_from', 'user_to')
+
+
+# messages between username and other, both directions, newest first
+@app.route('/thread', methods=['GET'])
+def thread():
+    params = request.args
+    username = params.get('username')
+    other = params.get('other')
+    if not username or not other:
+        return jsonify(get_response(status_code=409, message="Username / Other user is not provided")), 409
+    try:
+        n, cursor = message_page_params(params)
+    except pagination.InvalidCursor:
+        return jsonify(get_response(status_code=400, message="Invalid cursor")), 400
+    except ValueError:
+        return jsonify(get_response(status_code=400, message="Invalid n")), 400
+
+    keyset = cursor or []
+    args = [username, other, username, other] + keyset + [other, username, other, username] + keyset + [n]
+    rows = query_db(thread_query(cursor is not None), tuple(args))
+    if rows is False:
+        return page_not_found(404)
+    if not rows:
+        missing = missing_users(username, other)
+        if missing is False:
+            return page_not_found(404)
+        if missing:
+            return jsonify(get_response(status_code=404, message="User not existed")), 404
+    return message_page(rows, n)
+
+
+# number of unread messages for username; counts entries of the partial unread index only
+@app.route('/unread', methods=['GET'])
+def unread():
+    params = request.args
+    username = params.get('username')
+    if not username:
+        return jsonify(get_response(status_code=409, message="Username is not provided")), 409
+    q = query_db(UNREAD_QUERY, (username,), one=True)
+    if q is False:
+        return page_not_found(404)
+    if not q['unread']:
+        missing = missing_users(username)
+        if missing is False:
+            return page_not_found(404)
+        if missing:
+            return jsonify(get_response(status_code=404, message="User not existed")), 404
+    return jsonify({'username': username, 'unread': q['unread']}), 200
+
+
+# mark a message read
+@app.route('/read', methods=['POST'])
+def mark_read():
+    params = request.args
+    msg_id = params.get('msg_id')
+    if not msg_id:
+        return jsonify(get_response(status_code=409, message="Message ID is not provided")), 409
+    query = 'UPDATE messages SET msg_read = 1 WHERE msg_id = ? RETURNING msg_id'
+    q = transaction_db(query=[query], args=[(msg_id,)], return_=True)
+    if not q:
+        return page_not_found(404)
+    if not q[0]:
+        return jsonify(get_response(status_code=404, message="Message not existed")), 404
+    return jsonify(get_response(status_code=200, message="Message read")), 200
+
+# Broadcasts. Recipients are resolved with one query, then the messages go in with executemany.
+# Inline broadcasts (up to BROADCAST_SYNC_MAX recipients) are one transaction, so they are sent
+# completely or not at all; background jobs commit BROADCAST_CHUNK_SIZE per transaction, so a big
+# fan-out never holds the write lock for long. A job records its progress in broadcast_jobs in the
+# same transaction as each chunk, so the status any worker reports matches what is committed.
+BROADCAST_INSERT = 'INSERT INTO messages (user_from, user_to, msg_content, msg_flag) VALUES (?, ?, ?, ?)'
+BROADCAST_PROGRESS = "UPDATE broadcast_jobs SET sent = sent + ?, state = ?, updated = DATETIME('now', 'localtime') " \
+                     "WHERE job_id = ?"
+# everyone who has posted in the community, except the sender (single-file and db_split layouts)
+COMMUNITY_RECIPIENTS_QUERY = 'SELECT DISTINCT users.user_id FROM posts INNER JOIN users ON users.username = posts.username ' \
+                             'WHERE posts.community_id = (SELECT community_id FROM community WHERE community_name = ?) ' \
+                             'AND users.user_id != ?'
+
+
+# user_ids of a community's posters except the sender, False on error. With SHARD_DIR the posts
+# live in the community's shard: read the posters' names there, then resolve them here
+def community_recipients(community_name, sender_id):
+    shards = get_shards()
+    if shards is None:
+        rows = query_db(COMMUNITY_RECIPIENTS_QUERY, (community_name, sender_id))
+        return rows if rows is False else [row['user_id'] for row in rows]
+    try:
+        rows = shards.directory_query('SELECT community_id FROM community WHERE community_name = ?',
+                                      (community_name,))
+        if not rows:
+            return []
+        community_id = rows[0]['community_id']
+        posters = shards.query(shards.shard_for_community(community_id),
+                               'SELECT DISTINCT username FROM posts WHERE community_id = ?', (community_id,))
+    except sqlite3.OperationalError as e:
+        print(e)
+        return False
+    if not posters:
+        return []
+    rows = query_db(user_ids.RESOLVE_QUERY, (json.dumps([row['username'] for row in posters]),))
+    return rows if rows is False else sorted(row['user_id'] for row in rows if row['user_id'] != sender_id)
+
+
+_broadcast_executors = {}
+_broadcast_lock = threading.Lock()
+
+
+# background threads for large broadcasts, one pool per worker process; interpreter exit waits for
+# running jobs, so a graceful shutdown finishes them
+def get_broadcast_executor():
+    key = os.getpid()
+    executor = _broadcast_executors.get(key)
+    if executor is None:
+        with _broadcast_lock:
+            executor = _broadcast_executors.get(key)
+            if executor is None:
+                executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=current_app.config['BROADCAST_WORKERS'], thread_name_prefix='broadcast')
+                _broadcast_executors[key] = executor
+    return executor
+
+
+# insert one chunk of messages in one transaction, with the job's progress when there is a job
+def insert_broadcast_chunk(rows, job_id=None, state='running'):
+    progress = (len(rows), state, job_id)
+    writer = get_writer()
+    if writer is not None:
+        queries = [BROADCAST_INSERT] * len(rows)
+        args = list(rows)
+        if job_id is not None:
+            queries.append(BROADCAST_PROGRESS)
+            args.append(progress)
+        writer.execute(queries, args)
+        return
+    conn = get_db()
+
+    def run():
+        conn.execute('BEGIN')
+        conn.executemany(BROADCAST_INSERT, rows)
+        if job_id is not None:
+            conn.execute(BROADCAST_PROGRESS, progress)
+        conn.commit()
+
+    try:
+        get_db_pool().retry_busy(conn, run)
+    except sqlite3.Error:
+        if conn.in_transaction:
+            conn.execute('rollback')
+        raise
+
+
+# send the message to every recipient of a job, chunk by chunk; returns how many were sent
+def send_broadcast(sender_id, recipient_ids, msg_content, msg_flag, job_id):
+    chunk_size = current_app.config['BROADCAST_CHUNK_SIZE']
+    for start in range(0, len(recipient_ids), chunk_size):
+        chunk = recipient_ids[start:start + chunk_size]
+        last = start + chunk_size >= len(recipient_ids)
+        rows = [(sender_id, user_id, msg_content, msg_flag) for user_id in chunk]
+        insert_broadcast_chunk(rows, job_id, 'done' if last else 'running')
+    return len(recipient_ids)
+
+
+# runs on the executor, whose future nobody reads: every error has to end up in the job's row
+def run_broadcast_job(job_id, sender_id, recipient_ids, msg_content, msg_flag):
+    with app.app_context():
+        try:
+            send_broadcast(sender_id, recipient_ids, msg_content, msg_flag, job_id)
+        except Exception as e:
+            print(f'Broadcast {job_id} failed: {e!r}')
+            query = "UPDATE broadcast_jobs SET state = 'failed', error = ?, updated = DATETIME('now', 'localtime') " \
+                    "WHERE job_id = ?"
+            try:
+                query_db(query, (repr(e), job_id), commit=True)
+            except Exception as e:
+                # the status stops moving, so /broadcast_status reports the job as stale
+                print(f'Could not mark broadcast {job_id} failed: {e!r}')
+
+
+@app.route('/broadcast', methods=['POST'])
+def broadcast():
+    params = request.get_json()
+    user_from = params.get('user_from')
+    msg_content = params.get('msg_content')
+    msg_flag = params.get('msg_flag')
+    recipients = params.get('recipients')
+    community_name = params.get('community_name')
+
+    if not user_from or not msg_content or (not recipients and not community_name):
+        return jsonify(get_response(status_code=409, message="Sender / Message / Recipients is not provided")), 409
+    if recipients and not (isinstance(recipients, list) and all(isinstance(name, str) for name in recipients)):
+        return jsonify(get_response(status_code=400, message="recipients must be a list of usernames")), 400
+    max_recipients = current_app.config['BROADCAST_MAX_RECIPIENTS']
+    if recipients and len(recipients) > max_recipients:
+        return jsonify(get_response(status_code=413, message=f"At most {max_recipients} recipients per broadcast")), 413
+
+    # the sender is looked up directly: their id is written into every message, so no cached id
+    sender = user_ids.resolve(None, (user_from,), query_db)
+    if sender is False:
+        return page_not_found(404)
+    if user_from not in sender:
+        return jsonify(get_response(status_code=404, message="Sender not existed")), 404
+    sender_id = sender[user_from]
+
+    unknown = []
+    if recipients:
+        rows = query_db(user_ids.RESOLVE_QUERY, (json.dumps(sorted(set(recipients))),))
+        if rows is False:
+            return page_not_found(404)
+        found = dict((row['username'], row['user_id']) for row in rows)
+        unknown = sorted(set(recipients) - set(found))
+        recipient_ids = sorted(set(found.values()))
+    else:
+        recipient_ids = community_recipients(community_name, sender_id)
+        if recipient_ids is False:
+            return page_not_found(404)
+    if not recipient_ids:
+        return jsonify(get_response(status_code=404, message="Receiver not existed")), 404
+    if len(recipient_ids) > max_recipients:
+        return jsonify(get_response(status_code=413, message=f"At most {max_recipients} recipients per broadcast")), 413
+
+    if len(recipient_ids) <= current_app.config['BROADCAST_SYNC_MAX']:
+        # one transaction: when it fails nothing was sent, so the client can simply retry
+        # (DatabaseBusy answers 503 through database_busy)
+        rows = [(sender_id, user_id, msg_content, msg_flag) for user_id in recipient_ids]
+        try:
+            insert_broadcast_chunk(rows)
+        except sqlite3.Error as e:
+            print('Transaction failed. Rolled back')
+            print(e)
+            return page_not_found(404)
+        response = get_response(status_code=201, message=f"Message sent to {len(rows)} users")
+        response.update({'sent': len(rows), 'unknown': unknown})
+        return jsonify(response), 201
+
+    job_id = uuid.uuid4().hex
+    query = 'INSERT INTO broadcast_jobs (job_id, user_from, total) VALUES (?, ?, ?)'
+    if not query_db(query, (job_id, sender_id, len(recipient_ids)), commit=True):
+        return page_not_found(404)
+    get_broadcast_executor().submit(run_broadcast_job, job_id, sender_id, recipient_ids, msg_content, msg_flag)
+    response = jsonify(dict(get_response(status_code=202, message="Broadcast queued"),
+                            job_id=job_id, total=len(recipient_ids), unknown=unknown))
+    response.status_code = 202
+    response.headers['location'] = "http://localhost:2015/messages/broadcast_status?job_id=" + job_id
+    response.autocorrect_location_header = False
+    return response
+
+
+# progress of a background broadcast: state is queued, running, done or failed; stale is true when
+# a queued or running job made no progress for BROADCAST_STALE_AFTER seconds (its worker is gone)
+@app.route('/broadcast_status', methods=['GET'])
+def broadcast_status():
+    params = request.args
+    job_id = params.get('job_id')
+    if not job_id:
+        return jsonify(get_response(status_code=409, message="Job ID is not provided")), 409
+    query = "SELECT job_id, total, sent, state, error, created, updated, state IN ('queued', 'running') " \
+            "AND COALESCE(updated, created) < DATETIME('now', 'localtime', ?) AS stale " \
+            "FROM broadcast_jobs WHERE job_id = ?"
+    stale_after = '-{} seconds'.format(int(current_app.config['BROADCAST_STALE_AFTER']))
+    q = query_db(query, (stale_after, job_id), one=True)
+    if q is False:
+        return page_not_found(404)
+    if q is None:
+        return jsonify(get_response(status_code=404, message="Broadcast not existed")), 404
+    q['stale'] = bool(q['stale'])
+    return jsonify(q), 200
+
 def main():
     app.run()
 
@@ -0,0 +1,46 @@
+import base64
+import binascii
+import json
+
+######################
+# Opaque keyset-pagination cursors shared by post_api (/filter) and vote_api (/getTop).
+# A cursor is the sort key of the last row of a page, JSON encoded and base64'd so clients
+# treat it as a token; the next page is then a range scan that starts right after that key,
+# however deep the client goes.
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(*values):
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+# decode a cursor into a list of values, one per type given
+def decode_cursor(token, *types):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(raw.decode('utf-8'))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor(token)
+    if not isinstance(values, list) or len(values) != len(types):
+        raise InvalidCursor(token)
+    if not all(isinstance(value, type_) for value, type_ in zip(values, types)):
+        raise InvalidCursor(token)
+    return values
+
+
+# whether rows filled a page of n, so another may follow; n is the request's value, as given
+# (sqlite reads a LIMIT of '020' as 20, so compare numbers, not strings)
+def is_full(rows, n):
+    try:
+        return bool(rows) and len(rows) == int(n)
+    except (TypeError, ValueError):
+        return False
+
+
+# response body for a paginated request: the page plus the cursor of the next one (None on the last page)
+def page(results, next_cursor):
+    return {'results': results, 'next_cursor': next_cursor}
@@ -1,6 +1,22 @@
 import flask
 from flask import request, jsonify, g, current_app
+import calendar
+import datetime
+import hashlib
+import os
 import sqlite3
+import threading
+import time
+
+import cache_backends
+import db_migrate
+import db_pool
+import db_router
+import db_shards
+import db_split
+import db_writer
+import pagination
+import serialize
 
 ######################
 # API USAGE
@@ -30,14 +46,53 @@ import sqlite3
 #   Send a GET request to route of get_posts_filter() fn with args (n)
 # Example request:
 # curl -i http://localhost:2015/posts/filter?n=2
+# Large results (n over STREAM_MIN_ROWS) are streamed; ask for one post per line with
+#   curl -i -H 'Accept: application/x-ndjson' 'http://localhost:2015/posts/filter?n=5000'
+# --------------------
+# Create many posts in one request (and one commit): Send a POST request to route of create_posts_batch() fn
+# Example request:
+#   curl -i -X POST -H 'Content-Type:application/json' -d
+#   '{"posts": [{"title":"First", "username":"some_guy_or_gal", "community_name":"449"},
+#               {"title":"Second", "username":"some_guy_or_gal", "community_name":"algebra"}]}'
+#   http://localhost:2015/posts/create_batch;
+# --------------------
+# Page through posts: pass cursor (empty for the first page) to get {"results": [...], "next_cursor": ...}
+#   and send next_cursor back for the following page (works with any of the filters above)
+# Example request:
+# curl -i 'http://localhost:2015/posts/filter?n=20&community_name=algebra&cursor='
 
 # config variables
 DATABASE = 'data.db'
+DB_SERVICE = 'posts'
+DB_SPLIT_DIR = None
 DEBUG = True
+POOL_SIZE = 5
+POOL_TIMEOUT = 5.0
+POOL_HEALTH_CHECK = 30.0
+DB_WRITER_SOCKET = None
+DB_READ_SNAPSHOT = None
+# directory of a sharded layout (see db_shards); posts and votes then live in per-community shards
+SHARD_DIR = None
+SHARD_LOCATION_CACHE = 65536
+POOL_CACHED_STATEMENTS = 256
+# /filter results asking for more than STREAM_MIN_ROWS posts (or for NDJSON) are streamed
+# STREAM_CHUNK_SIZE rows at a time instead of being built in memory
+STREAM_MIN_ROWS = 1000
+STREAM_CHUNK_SIZE = 500
+# read-through cache of rendered /get responses: 'file' (one directory shared by every worker on the
+# host, so a /delete is seen by all of them at once), 'memory' (per worker LRU; only for a single
+# worker, since the other workers would keep serving a deleted post until its TTL) or None to disable
+POST_CACHE_BACKEND = 'file'
+POST_CACHE_SIZE = 4096
+POST_CACHE_TTL = 300.0
+POST_CACHE_DIR = 'post_cache'
+# most posts accepted by one /create_batch request
+POST_BATCH_MAX = 1000
 
 ######################
 app = flask.Flask(__name__)
 app.config.from_object(__name__)
+serialize.install(app)
 
 ######################
 # Database
@@ -58,6 +113,7 @@ app.config.from_object(__name__)
 # vote_id
 # upvotes
 # downvotes
+# score
 
 # table3: community
 # community_id
@@ -65,9 +121,8 @@ app.config.from_object(__name__)
 
 
 ######################
-# helper function used to convert each query result row into dictionary
-def make_dicts(cursor, row):
-    return dict((cursor.description[idx][0], value) for idx, value in enumerate(row))
+# helper function used to convert each query result row into dictionary (see serialize)
+make_dicts = serialize.make_dicts
 
 
 # helper function to generate a response with status code and message
@@ -75,29 +130,68 @@ def get_response(status_code, message):
     return {"status_code": str(status_code), "message": str(message)}
 
 
-# get db from flask g namespace
+# pool of long-lived connections for this worker
+def get_db_pool():
+    return db_pool.pool_for_app(current_app.config, row_factory=make_dicts)
+
+
+# client of the single-writer daemon when DB_WRITER_SOCKET is set (see db_writer), else None
+def get_writer():
+    return db_writer.writer_for_app(current_app.config)
+
+
+# router over the shard files when SHARD_DIR is set (see db_shards), else None
+def get_shards():
+    return db_shards.router_for_app(current_app.config, row_factory=make_dicts)
+
+
+# get db from flask g namespace (checked out of the worker's pool, returned on teardown)
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = make_dicts
+        g.db = get_db_pool().acquire()
     return g.db
 
 
+# pool for read-only handlers: query_only connections, on the snapshot when one is configured (see db_router)
+def get_read_pool():
+    return db_router.read_pool_for_app(current_app.config, row_factory=make_dicts)
+
+
+# read-only connection from flask g; returned to the pool it came from on teardown
+def get_read_db():
+    if 'read_db' not in g:
+        g.read_pool = get_read_pool()
+        g.read_db = g.read_pool.acquire()
+    return g.read_db
+
+
 # initiate db with
 # $FLASK_APP=post_api.py
 # $flask init
 @app.cli.command('init')
 def init_db():
     with app.app_context():
+        if app.config['DB_SPLIT_DIR']:
+            # split mode: build only this service's file (see db_split)
+            with app.open_resource('data.sql', mode='r') as f:
+                db_split.init_split(app.config, f.read())
+            return
         db = get_db()
+        # the pooled connection has already applied the WAL/pragma profile (see db_pool)
         with app.open_resource('data.sql', mode='r') as f:
             db.cursor().executescript(f.read())
         db.commit()
 
 
+# bring an existing db up to the current schema version in place
+# $flask migrate
+@app.cli.command('migrate')
+def migrate_db():
+    with app.app_context():
+        for name in db_migrate.migrate(get_db()):
+            print(f'Applied migration {name}')
+
+
 # close db connection
 @app.teardown_appcontext
 def close_db(e=None):
@@ -105,7 +199,10 @@ def close_db(e=None):
         print(f'Closing db: {e}')
     db = g.pop('db', None)
     if db is not None:
-        db.close()
+        get_db_pool().release(db)
+    read_db = g.pop('read_db', None)
+    if read_db is not None:
+        g.pop('read_pool').release(read_db)
 
 
 # home page
@@ -121,122 +218,434 @@ def page_not_found(status_code=404):
     return jsonify(error_json), status_code
 
 
+# database stayed locked past DB_BUSY_RETRIES (or no pooled connection freed up within POOL_TIMEOUT)
+@app.errorhandler(db_pool.DatabaseBusy)
+def database_busy(e):
+    print(e)
+    response = jsonify(get_response(status_code=503, message="Database busy, try again"))
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+# connection pool usage for this worker
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    stats = {'pool': get_db_pool().metrics(), 'read_pool': get_read_pool().metrics(),
+             'filter_shapes': filter_shape_metrics(),
+             'communities': get_communities().stats}
+    cache = get_post_cache()
+    if cache is not None:
+        stats['post_cache'] = cache.metrics()
+    if get_writer() is not None:
+        stats['writer'] = get_writer().metrics()
+    if get_shards() is not None:
+        stats['shards'] = get_shards().metrics()
+    return jsonify(stats), 200
+
+
 # function to execute a single query at once
-def query_db(query, args=(), one=False, commit=False):
+def query_db(query, args=(), one=False, commit=False, read_only=False):
     # one=True means return single record
     # commit = True for post and delete query (return boolean)
-    conn = get_db()
-    try:
+    # read_only = True for read-only handlers (read connection, possibly a snapshot)
+    writer = get_writer() if commit else None
+    if writer is not None:
+        try:
+            writer.execute([query], [args])
+        except sqlite3.OperationalError as e:
+            print(e)
+            return False
+        return True
+    if read_only and not commit:
+        conn = get_read_db()
+        pool = g.read_pool
+    else:
+        pool, conn = get_db_pool(), get_db()
+
+    def run():
         rv = conn.execute(query, args).fetchall()
         if commit:
             conn.commit()
+        return rv
+
+    try:
+        rv = pool.retry_busy(conn, run)
     except sqlite3.OperationalError as e:
         print(e)
         return False
-    close_db()
     if not commit:
         return (rv[0] if rv else None) if one else rv
     return True
 
 
+# function to run a read query for streaming on the read connection: returns (cursor, first chunk of rows), or False on error
+def query_db_stream(query, args=()):
+    conn = get_read_db()
+    chunk_size = current_app.config['STREAM_CHUNK_SIZE']
+
+    def run():
+        cursor = conn.execute(query, args)
+        return cursor, cursor.fetchmany(chunk_size)
+
+    try:
+        return g.read_pool.retry_busy(conn, run)
+    except sqlite3.OperationalError as e:
+        print(e)
+        return False
+
+
 # function to execute multiple queries at once (also fn commits the transaction)
 def transaction_db(query, args, return_=False):
     # return_=True if the transaction needs returns a result
-    conn = get_db()
     if len(query) != len(args):
         raise ValueError('arguments dont match queries')
-    try:
+    writer = get_writer()
+    if writer is not None:
+        try:
+            rv = writer.execute(query, args)
+        except (sqlite3.OperationalError, sqlite3.ProgrammingError) as e:
+            print('Transaction failed. Rolled back')
+            print(e)
+            return False
+        return True if not return_ else rv
+    conn = get_db()
+
+    def run():
         rv = []
         conn.execute('BEGIN')
         for i in range(len(query)):
             rv.append(conn.execute(query[i], args[i]).fetchall())
         conn.commit()
+        return rv
+
+    try:
+        rv = get_db_pool().retry_busy(conn, run)
     except (sqlite3.OperationalError, sqlite3.ProgrammingError) as e:
-        conn.execute('rollback')
+        if conn.in_transaction:
+            conn.execute('rollback')
         print('Transaction failed. Rolled back')
         print(e)
         return False
-    close_db()
     return True if not return_ else rv
 
 
+# community table query: the shard directory in shard mode, else the service's database
+def query_communities(query, args=()):
+    shards = get_shards()
+    if shards is None:
+        return query_db(query, args)
+    try:
+        return shards.directory_query(query, args)
+    except sqlite3.OperationalError as e:
+        print(e)
+        return False
+
+
+# Both directions of community_name <-> community_id for this worker. There are few communities and
+# they are never renamed or deleted, so the map is loaded once per worker, extended whenever this
+# worker creates a community, and only goes to the database for one created by another worker.
+class CommunityMap:
+    def __init__(self):
+        self._ids = {}
+        self._names = {}
+        self._lock = threading.Lock()
+        self.stats = {'size': 0, 'lookups': 0}
+
+    def add(self, community_id, community_name):
+        with self._lock:
+            self._ids[community_name] = community_id
+            self._names[community_id] = community_name
+            self.stats['size'] = len(self._ids)
+
+    def load(self):
+        rows = query_communities('SELECT community_id, community_name FROM community')
+        for row in rows or ():
+            self.add(row['community_id'], row['community_name'])
+
+    def _lookup(self, query, arg):
+        self.stats['lookups'] += 1
+        rows = query_communities(query, (arg,))
+        row = rows[0] if rows else None
+        if row:
+            self.add(row['community_id'], row['community_name'])
+        return row
+
+    # community_id for a name, None if there is no such community
+    def id_for(self, community_name):
+        community_id = self._ids.get(community_name)
+        if community_id is None:
+            row = self._lookup('SELECT community_id, community_name FROM community WHERE community_name=?',
+                               community_name)
+            community_id = row['community_id'] if row else None
+        return community_id
+
+    def name_for(self, community_id):
+        community_name = self._names.get(community_id)
+        if community_name is None:
+            row = self._lookup('SELECT community_id, community_name FROM community WHERE community_id=?',
+                               community_id)
+            community_name = row['community_name'] if row else None
+        return community_name
+
+    # replace a row's community_id with its community_name, the shape clients get
+    def name_row(self, row):
+        row['community_name'] = self.name_for(row.pop('community_id'))
+        return row
+
+
+_communities = {}
+
+
+def get_communities():
+    key = os.getpid()
+    if key not in _communities:
+        communities = CommunityMap()
+        communities.load()
+        _communities[key] = communities
+    return _communities[key]
+
+
+_post_caches = {}
+
+
+# this worker's /get cache (None when POST_CACHE_BACKEND is off)
+def get_post_cache():
+    key = os.getpid()
+    if key not in _post_caches:
+        config = current_app.config
+        _post_caches[key] = cache_backends.make_cache(
+            config['POST_CACHE_BACKEND'],
+            config['POST_CACHE_SIZE'],
+            config['POST_CACHE_TTL'],
+            os.path.join(current_app.root_path, config['POST_CACHE_DIR'])
+        )
+    return _post_caches[key]
+
+
+# rendered post plus its validators; posts never change once created, so published is Last-Modified
+def render_post(row):
+    body = serialize.dumps(row)
+    published = row.get('published')
+    last_modified = None
+    if isinstance(published, datetime.datetime):
+        last_modified = calendar.timegm(published.timetuple())
+    return {'body': body, 'etag': hashlib.sha1(body.encode('utf-8')).hexdigest(), 'last_modified': last_modified}
+
+
+GET_QUERY = 'SELECT post_id, title, description, resource_url, published, username, community_id FROM posts ' \
+            'WHERE post_id=?'
+
+
 # function to retrieve a single post with post_id
+# served from the post cache when possible; answers 304 to a matching If-None-Match / If-Modified-Since
 @app.route('/get', methods=['GET'])
 def get_post():
     params = request.args
     post_id = params.get('post_id')
     if not post_id:
         return page_not_found(404)
-    query = 'SELECT post_id, title, description, resource_url, published, username, community_name FROM posts ' \
-            'INNER JOIN community ON posts.community_id=community.community_id WHERE post_id=?'
-    args = (post_id,)
-    q = query_db(query, args, one=True)
-    if q:
-        return jsonify(q), 200
-    return page_not_found(404)
-
+    try:
+        post_id = int(post_id)
+    except ValueError:
+        return page_not_found(404)
 
-# function to retrieve posts with filters for a number of posts n (default value of n is 100)
-@app.route('/filter', methods=['GET'])
-def get_posts_filter():
-    params = request.args
-    query = 'SELECT post_id, title, published, username, community_name FROM posts ' \
-             'INNER JOIN community ON posts.community_id=community.community_id WHERE'
-    args = []
+    cache = get_post_cache()
+    entry = cache.get(post_id) if cache is not None else None
+    if entry is None:
+        query = GET_QUERY
+        args = (post_id,)
+        shards = get_shards()
+        if shards is not None:
+            q = query_post_shard(shards, post_id, query, args)
+            q = q[0] if q else None
+        else:
+            q = query_db(query, args, one=True, read_only=True)
+        if not q:
+            return page_not_found(404)
+        entry = render_post(get_communities().name_row(q))
+        if cache is not None:
+            cache.set(post_id, entry)
+
+    response = app.response_class(entry['body'], mimetype='application/json')
+    response.set_etag(entry['etag'])
+    if entry['last_modified'] is not None:
+        response.last_modified = datetime.datetime.fromtimestamp(entry['last_modified'], datetime.timezone.utc)
+    return response.make_conditional(request)
+
+
+# shard mode: run a query about one post on the shard holding it; rows ([] if there's no such post),
+# or False on error
+def query_post_shard(shards, post_id, query, args):
+    try:
+        return shards.find(post_id, query, args)[1]
+    except sqlite3.OperationalError as e:
+        print(e)
+        return False
 
-    post_id = params.get('post_id')
-    filters = 0
-    if post_id:
-        query += ' post_id=? AND'
-        args.append(post_id)
-        filters += 1
 
-    username = params.get('username')
-    if username:
-        query += ' username=? AND'
-        args.append(username)
-        filters += 1
+# filters accepted by /filter, in the order they appear in the generated WHERE clause
+FILTER_CLAUSES = (
+    ('post_id', 'post_id=?'),
+    ('username', 'username=?'),
+    ('published', 'published=?'),
+    ('title', 'title=?'),
+    # community_name is resolved to its id through the community map, so no join is needed
+    ('community_name', 'community_id=?'),
+    # keyset pagination: continue after the (published, post_id) of the previous page's last post
+    ('cursor', '(published, post_id) < (?, ?)'),
+)
+
+# every combination of filters ("shape") maps to one canonical statement, so the same shape always
+# produces the same SQL text and stays prepared in each connection's statement cache
+_filter_statements = {}
+_filter_stats = {}
+_filter_lock = threading.Lock()
+
+
+def filter_statement(shape):
+    query = _filter_statements.get(shape)
+    if query is None:
+        clauses = dict(FILTER_CLAUSES)
+        query = 'SELECT post_id, title, published, username, community_id FROM posts'
+        if shape:
+            query += ' WHERE ' + ' AND '.join(clauses[name] for name in shape)
+        query += ' ORDER BY published DESC, post_id DESC LIMIT ?'
+        _filter_statements[shape] = query
+    return query
+
+
+def record_filter_shape(shape, elapsed):
+    name = '+'.join(shape) or 'none'
+    with _filter_lock:
+        stats = _filter_stats.setdefault(name, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        stats['count'] += 1
+        stats['total_ms'] += elapsed * 1000
+        stats['max_ms'] = max(stats['max_ms'], elapsed * 1000)
+
+
+# executions and latency of each /filter shape in this worker, busiest first
+def filter_shape_metrics():
+    with _filter_lock:
+        shapes = [dict(stats, shape=name, avg_ms=stats['total_ms'] / stats['count'])
+                  for name, stats in _filter_stats.items()]
+    return sorted(shapes, key=lambda stats: stats['total_ms'], reverse=True)
+
+
+# stream when the client asks for NDJSON or for more than STREAM_MIN_ROWS posts
+def wants_stream(number):
+    if serialize.wants_ndjson(request):
+        return True
+    try:
+        return int(number) > current_app.config['STREAM_MIN_ROWS']
+    except ValueError:
+        return False
 
-    published = params.get('published')
-    if published:
-        query += ' published=? AND'
-        args.append(published)
-        filters += 1
 
-    title = params.get('title')
-    if title:
-        query += ' title=? AND'
-        args.append(title)
-        filters += 1
+# shard mode /filter: a community's posts come from its shard; anything else runs on every shard in
+# parallel and the per-shard pages are merged newest first
+def query_shards_filter(shards, shape, args, community_id, number):
+    query = filter_statement(shape)
+    try:
+        limit = int(number)
+        if community_id is not None:
+            return shards.query(shards.shard_for_community(community_id), query, args)
+        return shards.merge(shards.scatter(query, args), key=lambda row: (row['published'], row['post_id']),
+                            limit=limit if limit >= 0 else None)
+    except (ValueError, sqlite3.OperationalError) as e:
+        print(e)
+        return False
 
-    community_name = params.get('community_name')
-    if community_name:
-        query += ' community_name=? AND'
-        args.append(community_name)
-        filters += 1
 
-    if filters > 0:
-        query = query[:-4]
-    else:
-        query = query[:-6]
+# function to retrieve posts with filters for a number of posts n (default value of n is 100)
+@app.route('/filter', methods=['GET'])
+def get_posts_filter():
+    params = request.args
+    shape = []
+    args = []
+    community_id = None
+    for name, _ in FILTER_CLAUSES:
+        value = params.get(name)
+        if not value:
+            continue
+        if name == 'cursor':
+            try:
+                args.extend(pagination.decode_cursor(value, str, int))
+            except pagination.InvalidCursor:
+                return jsonify(get_response(status_code=400, message="Invalid cursor")), 400
+        elif name == 'community_name':
+            community_id = get_communities().id_for(value)
+            if community_id is None:
+                # no such community, so no posts
+                if params.get('cursor') is not None:
+                    return jsonify(pagination.page([], None)), 200
+                return page_not_found(404)
+            args.append(community_id)
+        else:
+            args.append(value)
+        shape.append(name)
+    shape = tuple(shape)
 
     number = params.get('n')
     if not number:
         number = 100
-    count_query = 'SELECT COUNT(post_id) FROM '
-    query += ' ORDER BY published DESC LIMIT ?;'
     args.append(number)
 
-    q = query_db(query, tuple(args))
+    started = time.perf_counter()
+    shards = get_shards()
+    if shards is not None:
+        # sharded results are merged in memory, so they aren't streamed
+        q = query_shards_filter(shards, shape, tuple(args), community_id, number)
+    elif params.get('cursor') is None and wants_stream(number):
+        q = query_db_stream(filter_statement(shape), tuple(args))
+        record_filter_shape(shape, time.perf_counter() - started)
+        if not q or not q[1]:
+            return page_not_found(404)
+        return serialize.stream_response(app, q[0], q[1], serialize.wants_ndjson(request),
+                                         current_app.config['STREAM_CHUNK_SIZE'],
+                                         transform=get_communities().name_row)
+    else:
+        q = query_db(filter_statement(shape), tuple(args), read_only=True)
+    record_filter_shape(shape, time.perf_counter() - started)
+    if q:
+        communities = get_communities()
+        q = [communities.name_row(row) for row in q]
+
+    if params.get('cursor') is not None:
+        if q is False:
+            return page_not_found(404)
+        next_cursor = None
+        if pagination.is_full(q, number):
+            last = q[-1]
+            next_cursor = pagination.encode_cursor(str(last['published']), last['post_id'])
+        return jsonify(pagination.page(q, next_cursor)), 200
     if q:
         return jsonify(q), 200
     return page_not_found(404)
 
 
-# function to add a new post to db
-@app.route('/create', methods=['POST'])
-def create_post():
-    params = request.get_json()
+# statements that create one post inside a transaction: make sure the community exists
+# (community_name is UNIQUE), add its votes row, then insert the post pointing at that row via
+# last_insert_rowid(), which is per-connection and so can't pick up another request's vote
+CREATE_POST_QUERIES = (
+    'INSERT OR IGNORE INTO community (community_name) VALUES (?)',
+    'INSERT INTO votes (upvotes, downvotes, score) VALUES (0, 0, 0)',
+    'INSERT INTO posts (community_id, title, description, resource_url, username, vote_id) '
+    'VALUES ((SELECT community_id FROM community WHERE community_name=?),?,?,?,?,last_insert_rowid()) '
+    'RETURNING post_id, community_id'
+)
+
+# the same for a community already in the community map: no community statement, id bound directly
+CREATE_POST_KNOWN_COMMUNITY_QUERIES = (
+    'INSERT INTO votes (upvotes, downvotes, score) VALUES (0, 0, 0)',
+    'INSERT INTO posts (community_id, title, description, resource_url, username, vote_id) '
+    'VALUES (?,?,?,?,?,last_insert_rowid()) '
+    'RETURNING post_id, community_id'
+)
+
+
+# queries/args to create the post described by params, or None if a required field is missing
+def create_post_statements(params):
     community_name = params.get('community_name')
     title = params.get('title')
     username = params.get('username')
@@ -244,36 +653,106 @@ def create_post():
     resource_url = params.get('resource_url')
 
     if not title or not username or not community_name:
-        return jsonify(get_response(status_code=409, message="username / title / community_name is not in request")), 409
-    query1 = 'INSERT INTO votes (upvotes, downvotes) VALUES (?, ?)'
-    args1 = (0, 0)
-    
-
-    query_community = 'SELECT community_id FROM community WHERE community_name=?'
-    args_community = (community_name,)
-    community_id = query_db(query_community, args_community, one=True, commit=False)
-    query4 = 'SELECT last_insert_rowid();'
-    args4 = ()
+        return None
+    community_id = get_communities().id_for(community_name)
     if community_id is not None:
-        if type(community_id) == list:
-            id_ = community_id[0]['community_id']
-        else:
-            id_ = community_id['community_id']
+        args = [
+            (),
+            (community_id, title, description, resource_url, username)
+        ]
+        return list(CREATE_POST_KNOWN_COMMUNITY_QUERIES), args
+    args = [
+        (community_name,),
+        (),
+        (community_name, title, description, resource_url, username)
+    ]
+    return list(CREATE_POST_QUERIES), args
+
+
+# post_ids from the (flat) transaction results of a list of create_post_statements(); communities
+# the statements created are added to the community map
+def created_posts(statements, results):
+    communities = get_communities()
+    post_ids = []
+    end = 0
+    for queries, args in statements:
+        end += len(queries)
+        row = results[end - 1][0]
+        if queries[0] == CREATE_POST_QUERIES[0]:
+            communities.add(row['community_id'], args[0][0])
+        post_ids.append(row['post_id'])
+    return post_ids
+
+
+# shard mode: (community_name, title, description, resource_url, username) of the post described by
+# params, or None if a required field is missing
+def shard_post_values(params):
+    values = tuple(params.get(name) for name in
+                   ('community_name', 'title', 'description', 'resource_url', 'username'))
+    if not values[0] or not values[1] or not values[4]:
+        return None
+    return values
+
+
+# shard mode: create posts on the shards of their communities, one transaction per shard. Returns the
+# post_ids in request order, or False if a shard's transaction failed (posts on shards that already
+# committed are kept)
+def create_shard_posts(shards, posts):
+    communities = get_communities()
+    by_shard = {}
+    for i, (community_name, title, description, resource_url, username) in enumerate(posts):
+        community_id = communities.id_for(community_name)
+        if community_id is None:
+            try:
+                community_id = shards.create_community(community_name)[0]
+            except sqlite3.OperationalError as e:
+                print(e)
+                return False
+            communities.add(community_id, community_name)
+        values = (community_id, title, description, resource_url, username)
+        by_shard.setdefault(shards.shard_for_community(community_id), []).append((i, values))
+
+    post_ids = [None] * len(posts)
+    per_post = len(db_shards.CREATE_POST_QUERIES)
+    for shard, items in by_shard.items():
+        queries, args = [], []
+        for _, values in items:
+            queries.extend(db_shards.CREATE_POST_QUERIES)
+            args.extend([(), (), values])
+        try:
+            q = shards.transaction(shard, queries, args)
+        except (sqlite3.OperationalError, sqlite3.ProgrammingError) as e:
+            print('Transaction failed. Rolled back')
+            print(e)
+            return False
+        for n, (i, _) in enumerate(items):
+            post_ids[i] = q[(n + 1) * per_post - 1][0]['post_id']
+            shards.remember(post_ids[i], shard)
+    return post_ids
+
 
-        query3 = 'INSERT INTO posts (community_id, title, description, resource_url, username, vote_id) ' \
-                 'VALUES (?,?,?,?,?,(SELECT MAX(vote_id) FROM votes))'
-        args3 = (id_, title, description, resource_url, username)
-        q = transaction_db(query=[query1, query3, query4], args=[args1, args3, args4], return_=True)
+# function to add a new post to db
+@app.route('/create', methods=['POST'])
+def create_post():
+    params = request.get_json()
+    shards = get_shards()
+    if shards is not None:
+        values = shard_post_values(params)
+        if values is None:
+            return jsonify(get_response(status_code=409, message="username / title / community_name is not in request")), 409
+        q = create_shard_posts(shards, [values])
+        if not q:
+            return page_not_found(404)
+        rowid = q[0]
     else:
-        query2 = 'INSERT INTO community (community_name) VALUES (?)'
-        args2 = (community_name,)
-        query3 = 'INSERT INTO posts (community_id, title, description, resource_url, username, vote_id) ' \
-                 'VALUES ((SELECT community_id FROM community WHERE community_name=?),?,?,?,?,(SELECT MAX(vote_id) FROM votes))'
-        args3 = (community_name, title, description, resource_url, username)
-        q = transaction_db(query=[query1, query2, query3, query4], args=[args1, args2, args3, args4], return_=True)
-    if not q:
-        return page_not_found(404)
-    rowid = q[-1][0]["last_insert_rowid()"]
+        statements = create_post_statements(params)
+        if statements is None:
+            return jsonify(get_response(status_code=409, message="username / title / community_name is not in request")), 409
+
+        q = transaction_db(query=statements[0], args=statements[1], return_=True)
+        if not q:
+            return page_not_found(404)
+        rowid = created_posts([statements], q)[0]
     response = jsonify(get_response(status_code=201, message="Post created"))
     response.status_code = 201
     response.headers['location'] = "http://localhost:2015/posts/get?post_id=" + str(rowid)
@@ -281,6 +760,49 @@ def create_post():
     return response
 
 
+# function to add many posts to db in a single transaction (one per shard in shard mode)
+# body: {"posts": [{"title": ..., "username": ..., "community_name": ..., ...}, ...]}
+@app.route('/create_batch', methods=['POST'])
+def create_posts_batch():
+    params = request.get_json()
+    posts = params.get('posts') if isinstance(params, dict) else None
+    if not posts or not isinstance(posts, list):
+        return jsonify(get_response(status_code=409, message="posts is not in request")), 409
+    batch_max = current_app.config['POST_BATCH_MAX']
+    if len(posts) > batch_max:
+        return jsonify(get_response(status_code=413, message=f"At most {batch_max} posts per batch")), 413
+
+    shards = get_shards()
+    batch, queries, args = [], [], []
+    for i, post in enumerate(posts):
+        if not isinstance(post, dict):
+            statements = None
+        elif shards is not None:
+            statements = shard_post_values(post)
+        else:
+            statements = create_post_statements(post)
+        if statements is None:
+            message = f"username / title / community_name is not in posts[{i}]"
+            return jsonify(get_response(status_code=409, message=message)), 409
+        batch.append(statements)
+        if shards is None:
+            queries.extend(statements[0])
+            args.extend(statements[1])
+
+    if shards is not None:
+        post_ids = create_shard_posts(shards, batch)
+        if not post_ids:
+            return page_not_found(404)
+    else:
+        q = transaction_db(query=queries, args=args, return_=True)
+        if not q:
+            return page_not_found(404)
+        post_ids = created_posts(batch, q)
+    response = get_response(status_code=201, message=f"{len(post_ids)} posts created")
+    response['post_ids'] = post_ids
+    return jsonify(response), 201
+
+
 # function to delete an existing post from db
 @app.route('/delete', methods=['DELETE'])
 def delete_post():
@@ -289,10 +811,23 @@ def delete_post():
     post_id = params.get('post_id')
     if not post_id:
         return page_not_found(404)
+    try:
+        post_id = int(post_id)
+    except ValueError:
+        return jsonify(get_response(status_code=404, message="Post does not exist")), 404
 
     query1 = 'SELECT * FROM posts WHERE post_id=?'
     args1 = (post_id,)
-    if not query_db(query1, args1):
+    shards = get_shards()
+    if shards is not None:
+        try:
+            shard = shards.locate(post_id)
+        except sqlite3.OperationalError as e:
+            print(e)
+            return page_not_found(404)
+        if shard is None:
+            return jsonify(get_response(status_code=404, message="Post does not exist")), 404
+    elif not query_db(query1, args1):
         return jsonify(get_response(status_code=404, message="Post does not exist")), 404
 
     query2 = 'DELETE FROM votes WHERE vote_id=(SELECT vote_id FROM posts WHERE post_id=?)'
@@ -301,9 +836,21 @@ def delete_post():
     query3 = 'DELETE FROM posts WHERE post_id=?'
     args3 = (post_id,)
 
-    q = transaction_db([query2, query3], [args2, args3])
-    if not q:
-        return page_not_found(404)
+    if shards is not None:
+        try:
+            shards.transaction(shard, [query2, query3], [args2, args3])
+        except (sqlite3.OperationalError, sqlite3.ProgrammingError) as e:
+            print('Transaction failed. Rolled back')
+            print(e)
+            return page_not_found(404)
+        shards.forget(post_id)
+    else:
+        q = transaction_db([query2, query3], [args2, args3])
+        if not q:
+            return page_not_found(404)
+    cache = get_post_cache()
+    if cache is not None:
+        cache.delete(post_id)
     return jsonify(get_response(status_code=200, message="Post deleted")), 200
 
 
@@ -0,0 +1,134 @@
+import datetime
+import decimal
+import json
+import threading
+import uuid
+
+from flask import stream_with_context
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+######################
+# Shared row building and JSON encoding for the four services.
+#
+# make_dicts is the sqlite row_factory: it looks the column names up once per executed statement
+# instead of walking cursor.description for every row.
+# install(app) swaps flask's JSON provider for one that encodes with orjson when it is installed
+# (stdlib json otherwise); jsonify() keeps working unchanged in the services. Keys are sorted and
+# datetimes rendered as HTTP dates like flask's default provider, so the fields and their order
+# don't change. The bytes do: output is always compact (flask indents responses when DEBUG is on,
+# which every service's config sets), non-ASCII text is sent as UTF-8 rather than \u escapes, and
+# there is no trailing newline.
+#
+# stream_response() sends a large result as it is read with fetchmany, either as one JSON array
+# (same bytes as jsonify) or as NDJSON when the client asks for application/x-ndjson.
+#
+# Compare the backends with:
+# $ python tests/benchSerialize.py
+
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+_columns = threading.local()
+
+
+def column_names(cursor):
+    # cursor.description is one tuple per executed statement, so identity is enough to reuse the names;
+    # holding on to it also keeps its id from being recycled
+    description = cursor.description
+    cached = getattr(_columns, 'last', None)
+    if cached is None or cached[0] is not description:
+        cached = (description, tuple(column[0] for column in description))
+        _columns.last = cached
+    return cached[1]
+
+
+# helper function used to convert each query result row into dictionary
+def make_dicts(cursor, row):
+    return dict(zip(column_names(cursor), row))
+
+
+def _default(o):
+    if isinstance(o, datetime.date):
+        return http_date(o)
+    if isinstance(o, (decimal.Decimal, uuid.UUID)):
+        return str(o)
+    if isinstance(o, (bytes, bytearray)):
+        return o.decode('utf-8')
+    raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS
+
+    def dumps_bytes(obj):
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS)
+else:
+    _encoder = json.JSONEncoder(default=_default, separators=(',', ':'), ensure_ascii=False, sort_keys=True)
+
+    def dumps_bytes(obj):
+        return _encoder.encode(obj).encode('utf-8')
+
+
+def dumps(obj):
+    return dumps_bytes(obj).decode('utf-8')
+
+
+loads = orjson.loads if orjson is not None else json.loads
+
+
+def install(app):
+    # flask < 2.2 has no JSON providers; those apps keep flask's own encoder
+    try:
+        from flask.json.provider import DefaultJSONProvider
+    except ImportError:
+        return
+
+    class FastJSONProvider(DefaultJSONProvider):
+        def dumps(self, obj, **kwargs):
+            return dumps(obj)
+
+        def response(self, *args, **kwargs):
+            obj = self._prepare_response_obj(args, kwargs)
+            return self._app.response_class(dumps_bytes(obj), mimetype=self.mimetype)
+
+    app.json = FastJSONProvider(app)
+
+
+NDJSON = 'application/x-ndjson'
+
+
+# True when the Accept header prefers NDJSON over a JSON array
+def wants_ndjson(request):
+    return request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON
+
+
+# encoded chunks of rows: the rows already fetched, then the rest of the cursor chunk_size at a time
+def iter_rows(cursor, first_rows, ndjson, chunk_size, transform=None):
+    separator = b'\n' if ndjson else b','
+    rows = first_rows
+    started = False
+    if not ndjson:
+        yield b'['
+    while rows:
+        if transform is not None:
+            rows = [transform(row) for row in rows]
+        chunk = separator.join(dumps_bytes(row) for row in rows)
+        if ndjson:
+            yield chunk + b'\n'
+        else:
+            yield (separator + chunk) if started else chunk
+        started = True
+        rows = cursor.fetchmany(chunk_size)
+    if not ndjson:
+        yield b']'
+
+
+# response that streams the cursor; the app context (and its pooled connection) lives until the last chunk.
+# transform, if given, is applied to every row before it is encoded
+def stream_response(app, cursor, first_rows, ndjson, chunk_size, transform=None):
+    body = stream_with_context(iter_rows(cursor, first_rows, ndjson, chunk_size, transform))
+    return app.response_class(body, mimetype=NDJSON if ndjson else 'application/json')
@@ -0,0 +1,74 @@
+# Microbenchmark for the shared serialization path (serialize.py) against what the services used before:
+# the per-row cursor.description walk in make_dicts, and stdlib json vs orjson for encoding.
+# Rows are shaped like /posts/filter?n=100 and /votes/all results.
+# $ python tests/benchSerialize.py
+
+import datetime
+import json
+import os
+import sqlite3
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serialize
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def old_make_dicts(cursor, row):
+    return dict((cursor.description[idx][0], value) for idx, value in enumerate(row))
+
+
+def build_db(posts, votes):
+    conn = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES)
+    conn.execute('CREATE TABLE posts (post_id INTEGER PRIMARY KEY, title VARCHAR, published TIMESTAMP, '
+                 'username VARCHAR, community_name VARCHAR)')
+    conn.execute('CREATE TABLE votes (vote_id INTEGER PRIMARY KEY, upvotes INTEGER, downvotes INTEGER, score INTEGER)')
+    now = datetime.datetime(2020, 4, 1, 12, 0, 0)
+    conn.executemany('INSERT INTO posts (title, published, username, community_name) VALUES (?, ?, ?, ?)',
+                     [('Post number %d' % i, now, 'user%d' % i, 'community%d' % (i % 10)) for i in range(posts)])
+    conn.executemany('INSERT INTO votes (upvotes, downvotes, score) VALUES (?, ?, ?)',
+                     [(i, i // 2, i - i // 2) for i in range(votes)])
+    return conn
+
+
+def fetch(conn, row_factory, query):
+    conn.row_factory = row_factory
+    return conn.execute(query).fetchall()
+
+
+def stdlib_dumps(obj):
+    return json.dumps(obj, default=serialize._default, separators=(',', ':')).encode('utf-8')
+
+
+def bench(label, fn, number):
+    seconds = min(timeit.repeat(fn, number=number, repeat=5)) / number
+    print(f'  {label:<32} {seconds * 1e6:10.1f} us')
+
+
+def main():
+    conn = build_db(posts=100, votes=10000)
+    cases = [
+        ('/posts/filter?n=100', 'SELECT * FROM posts', 200),
+        ('/votes/all (10k rows)', 'SELECT * FROM votes', 10),
+    ]
+    for name, query, number in cases:
+        print(name)
+        bench('rows: old make_dicts', lambda: fetch(conn, old_make_dicts, query), number)
+        bench('rows: serialize.make_dicts', lambda: fetch(conn, serialize.make_dicts, query), number)
+        rows = fetch(conn, serialize.make_dicts, query)
+        bench('encode: stdlib json', lambda: stdlib_dumps(rows), number)
+        if orjson is not None:
+            bench('encode: orjson', lambda: serialize.dumps_bytes(rows), number)
+        else:
+            print('  encode: orjson                   (not installed)')
+    print(f'serialize.BACKEND = {serialize.BACKEND}')
+
+
+if __name__ == '__main__':
+    main()
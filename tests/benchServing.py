@@ -0,0 +1,168 @@
+# Side-by-side throughput of the two serving modes, in one process against a scratch copy of data.db:
+#   sync   the Procfile setup: SYNC_WORKERS sync workers, each serving one request start to finish
+#   async  async_serving: one event loop, views on ASYNC_THREADS threads, 503 past ASYNC_MAX_PENDING
+# Both call the same flask apps with the same WSGI environ, so the difference is only in how requests
+# are scheduled. A "locked" run adds a writer holding the write lock in bursts, the case where sync
+# workers sit blocked in sqlite. Worker processes share one GIL here, so treat the numbers as relative.
+# $ python tests/benchServing.py [seconds] [clients]
+
+import asyncio
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import async_serving
+import post_api
+import vote_api
+
+SYNC_WORKERS = 3
+ASYNC_THREADS = 5
+
+
+def scratch_database():
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'data.db')
+    shutil.copy(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data.db'), path)
+    return directory, path
+
+
+def requests_mix(post_ids):
+    post_id = random.choice(post_ids)
+    return random.choice([
+        (post_api.app, 'GET', '/get', 'post_id={}'.format(post_id), b''),
+        (post_api.app, 'GET', '/filter', 'n=25', b''),
+        (vote_api.app, 'GET', '/get', 'vote_id={}'.format(post_id), b''),
+        (vote_api.app, 'POST', '/upvotes', '', '{{"vote_id": {}}}'.format(post_id).encode()),
+    ])
+
+
+def scope_for(method, path, query, body):
+    headers = [(b'host', b'localhost')]
+    if body:
+        headers += [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+    return {'type': 'http', 'method': method, 'path': path, 'query_string': query.encode(),
+            'headers': headers, 'http_version': '1.1', 'scheme': 'http'}
+
+
+def call_wsgi(app, method, path, query, body):
+    status = []
+    result = app(async_serving.build_environ(scope_for(method, path, query, body), body),
+                 lambda s, headers, exc_info=None: status.append(s))
+    b''.join(result)
+    if hasattr(result, 'close'):
+        result.close()
+    return int(status[0].split(' ', 1)[0])
+
+
+def run_sync(post_ids, seconds, clients):
+    workers = threading.Semaphore(SYNC_WORKERS)
+    latencies, statuses = [], []
+    deadline = time.monotonic() + seconds
+
+    def client():
+        while time.monotonic() < deadline:
+            request = requests_mix(post_ids)
+            started = time.monotonic()
+            with workers:
+                statuses.append(call_wsgi(*request))
+            latencies.append(time.monotonic() - started)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses
+
+
+def run_async(post_ids, seconds, clients):
+    services = {post_api.app: async_serving.post, vote_api.app: async_serving.vote}
+    latencies, statuses = [], []
+
+    async def call(app, method, path, query, body):
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            sent.append(message)
+
+        await services[app](scope_for(method, path, query, body), receive, send)
+        return sent[0]['status']
+
+    async def client(deadline):
+        while time.monotonic() < deadline:
+            request = requests_mix(post_ids)
+            started = time.monotonic()
+            statuses.append(await call(*request))
+            latencies.append(time.monotonic() - started)
+
+    async def main():
+        deadline = time.monotonic() + seconds
+        await asyncio.gather(*(client(deadline) for _ in range(clients)))
+
+    asyncio.run(main())
+    return latencies, statuses
+
+
+# hold the write lock for 50ms out of every 200ms until stopped
+def lock_bursts(path, stop):
+    conn = sqlite3.connect(path, isolation_level=None)
+    while not stop.is_set():
+        conn.execute('BEGIN IMMEDIATE')
+        time.sleep(0.05)
+        conn.execute('COMMIT')
+        time.sleep(0.15)
+    conn.close()
+
+
+def report(label, latencies, statuses, seconds):
+    latencies = sorted(latencies)
+    ok = sum(1 for status in statuses if status < 500)
+    p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0
+    print(f'  {label:<8} {ok / seconds:9.1f} req/s  p50 {p50:7.1f} ms  p99 {p99:7.1f} ms  '
+          f'5xx {len(statuses) - ok}')
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    directory, path = scratch_database()
+    try:
+        for app in (post_api.app, vote_api.app):
+            app.config.update(DATABASE=path, DEBUG=False, ASYNC_THREADS=ASYNC_THREADS)
+        conn = sqlite3.connect(path)
+        post_ids = [row[0] for row in conn.execute('SELECT post_id FROM posts')]
+        conn.close()
+
+        print(f'{clients} clients, {seconds:.0f}s per run, {SYNC_WORKERS} sync workers, '
+              f'{ASYNC_THREADS} async threads')
+        for locked in (False, True):
+            print('write lock held in bursts' if locked else 'unlocked')
+            for label, run in (('sync', run_sync), ('async', run_async)):
+                stop = threading.Event()
+                locker = threading.Thread(target=lock_bursts, args=(path, stop))
+                if locked:
+                    locker.start()
+                try:
+                    latencies, statuses = run(post_ids, seconds, clients)
+                finally:
+                    stop.set()
+                    if locked:
+                        locker.join()
+                report(label, latencies, statuses, seconds)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+-- data.sql as it was before versioned migrations (user_version 0): tables and primary keys only.
+-- Used by test_query_plans.py to check that db_migrate brings such a file up to date.
+
+CREATE TABLE community (
+    community_id INTEGER PRIMARY KEY,
+    community_name VARCHAR NOT NULL
+);
+
+CREATE TABLE votes (
+    vote_id INTEGER primary key,
+    upvotes INTEGER NOT NULL,
+    downvotes INTEGER NOT NULL
+);
+
+CREATE TABLE posts (
+    post_id INTEGER PRIMARY KEY,
+    community_id INTEGER NOT NULL,
+    title VARCHAR NOT NULL,
+    description VARCHAR,
+    resource_url VARCHAR,
+    published TIMESTAMP DEFAULT (DATETIME('now', 'localtime')),
+    username VARCHAR NOT NULL,
+    vote_id INTEGER NOT NULL,
+    FOREIGN KEY (vote_id) REFERENCES votes (vote_id),
+    FOREIGN KEY (community_id) REFERENCES community (community_id)
+);
+
+CREATE TABLE users (
+    user_id INTEGER PRIMARY KEY,
+    username VARCHAR NOT NULL,
+    email VARCHAR NOT NULL,
+    karma INTEGER DEFAULT 1
+);
+
+CREATE TABLE messages (
+    msg_id INTEGER PRIMARY KEY,
+    user_from INTEGER NOT NULL,
+    user_to INTEGER NOT NULL,
+    msg_time TIMESTAMP DEFAULT (DATETIME('now', 'localtime')),
+    msg_content VARCHAR NOT NULl,
+    msg_flag VARCHAR,
+    FOREIGN KEY (user_from) REFERENCES users (user_id),
+    FOREIGN KEY (user_to) REFERENCES users (user_id)
+);
+
+CREATE TABLE favorite (
+    fav_id INTEGER PRIMARY KEY,
+    msg_ID INTEGER NOT NULL,
+    FOREIGN KEY (msg_ID) REFERENCES messages (msg_id)
+);
+
+INSERT INTO users(username, email) VALUES ('ilovedog', 'dogperson@ilovedog.com');
+INSERT INTO community(community_id, community_name) VALUES(1, 'cheesecake');
+INSERT INTO votes(upvotes, downvotes) VALUES(103, 24);
+INSERT INTO posts(community_id, title, username, vote_id) VALUES(1, 'The Best Cheesecake Recipe', 'cakeLvr', 1);
@@ -0,0 +1,61 @@
+# asyncio serving bridge: requests past the thread pool and ASYNC_MAX_PENDING are shed with 503.
+# $ python -m pytest tests/test_async_serving.py
+
+import asyncio
+import os
+import sys
+import threading
+
+import flask
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import async_serving
+
+
+def blocking_app(release):
+    app = flask.Flask(__name__)
+    app.config.update({'ASYNC_THREADS': 1, 'ASYNC_MAX_PENDING': 1})
+
+    @app.route('/slow')
+    def slow():
+        release.wait(5.0)
+        return flask.jsonify(True)
+
+    return app
+
+
+async def call(service, path):
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'headers': []}
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    await service(scope, receive, send)
+    start = next(message for message in sent if message['type'] == 'http.response.start')
+    return start['status'], dict(start['headers'])
+
+
+def test_requests_past_max_pending_get_503():
+    release = threading.Event()
+    service = async_serving.AsyncService(blocking_app(release))
+
+    async def main():
+        # one request holds the only thread, one waits for it: the service is at its limit
+        running = [asyncio.ensure_future(call(service, '/slow')) for _ in range(2)]
+        while service.metrics()['pending'] < 2:
+            await asyncio.sleep(0.01)
+        status, headers = await call(service, '/slow')
+        release.set()
+        return status, headers, [result[0] for result in await asyncio.gather(*running)]
+
+    status, headers, statuses = asyncio.run(main())
+    assert status == 503 and headers[b'retry-after'] == b'1'
+    assert statuses == [200, 200]
+    stats = service.metrics()
+    assert stats['rejected'] == 1 and stats['requests'] == 2 and stats['pending'] == 0
@@ -0,0 +1,108 @@
+# Connection pool: checkout limits and timeouts, and retrying SQLITE_BUSY.
+# $ python -m pytest tests/test_db_pool.py
+
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import db_pool
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / 'data.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE votes (vote_id INTEGER PRIMARY KEY, upvotes INTEGER)')
+    conn.execute('INSERT INTO votes (upvotes) VALUES (0)')
+    conn.commit()
+    conn.close()
+    return path
+
+
+def test_exhausted_pool_times_out(database):
+    pool = db_pool.ConnectionPool(database, size=2, timeout=0.05)
+    held = [pool.acquire(), pool.acquire()]
+    with pytest.raises(db_pool.PoolTimeout):
+        pool.acquire()
+    stats = pool.metrics()
+    assert stats['in_use'] == 2 and stats['timeouts'] == 1 and stats['created'] == 2
+
+    # a released connection is reused, not reopened
+    pool.release(held.pop())
+    conn = pool.acquire()
+    assert conn.execute('SELECT upvotes FROM votes').fetchone() == (0,)
+    assert pool.metrics()['created'] == 2
+    for conn in held + [conn]:
+        pool.release(conn)
+    assert pool.metrics()['in_use'] == 0
+
+
+def test_waiting_checkout_gets_the_next_released_connection(database):
+    pool = db_pool.ConnectionPool(database, size=1, timeout=5.0)
+    held = pool.acquire()
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(pool.acquire()))
+    waiter.start()
+    deadline = time.monotonic() + 5.0
+    while pool.metrics()['waits'] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    pool.release(held)
+    waiter.join(5.0)
+    assert acquired == [held]
+    pool.release(held)
+
+
+def test_release_rolls_back_uncommitted_work(database):
+    pool = db_pool.ConnectionPool(database, size=1)
+    conn = pool.acquire()
+    conn.execute('UPDATE votes SET upvotes = 1')
+    assert conn.in_transaction
+    pool.release(conn)
+    conn = pool.acquire()
+    assert conn.execute('SELECT upvotes FROM votes').fetchone() == (0,)
+    pool.release(conn)
+
+
+# no busy_timeout, so a held write lock fails every attempt straight away
+NO_WAIT_PROFILE = tuple((pragma, 0 if pragma == 'busy_timeout' else value)
+                        for pragma, value in db_pool.DEFAULT_PROFILE)
+
+
+def test_busy_retry_gives_up_with_database_busy(database):
+    pool = db_pool.ConnectionPool(database, size=1, profile=NO_WAIT_PROFILE, busy_retries=2, busy_backoff=0.001)
+    # opened first: switching the file to WAL needs the write lock too
+    conn = pool.acquire()
+    locker = sqlite3.connect(database, isolation_level=None)
+    locker.execute('BEGIN IMMEDIATE')
+    try:
+        with pytest.raises(db_pool.DatabaseBusy):
+            pool.retry_busy(conn, lambda: conn.execute('UPDATE votes SET upvotes = upvotes + 1'))
+        assert not conn.in_transaction
+        stats = pool.metrics()
+        assert stats['busy_retries'] == 2 and stats['busy_failures'] == 1
+
+        # once the lock is gone the same call goes through
+        locker.execute('COMMIT')
+        pool.retry_busy(conn, lambda: (conn.execute('UPDATE votes SET upvotes = upvotes + 1'), conn.commit()))
+        assert conn.execute('SELECT upvotes FROM votes').fetchone() == (1,)
+    finally:
+        pool.release(conn)
+        locker.close()
+
+
+def test_non_busy_errors_are_not_retried(database):
+    pool = db_pool.ConnectionPool(database, size=1, busy_retries=2)
+    conn = pool.acquire()
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            pool.retry_busy(conn, lambda: conn.execute('SELECT missing FROM votes'))
+        assert pool.metrics()['busy_retries'] == 0
+    finally:
+        pool.release(conn)
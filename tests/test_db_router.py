@@ -0,0 +1,78 @@
+# Read/write routing: read pools can't write, and readers on a snapshot move to a refreshed one.
+# $ python -m pytest tests/test_db_router.py
+
+import os
+import sqlite3
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import db_pool
+import db_router
+
+
+@pytest.fixture
+def primary(tmp_path):
+    path = str(tmp_path / 'data.db')
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('CREATE TABLE votes (vote_id INTEGER PRIMARY KEY, upvotes INTEGER)')
+    conn.execute('INSERT INTO votes (upvotes) VALUES (1)')
+    conn.commit()
+    conn.close()
+    return path
+
+
+def config_for(path, snapshot=None):
+    return {'DATABASE': path, 'DB_READ_SNAPSHOT': snapshot, 'DB_SNAPSHOT_CHECK': 0.0}
+
+
+def upvotes(pool):
+    conn = pool.acquire()
+    try:
+        return conn.execute('SELECT upvotes FROM votes').fetchone()[0]
+    finally:
+        pool.release(conn)
+
+
+def test_read_pool_rejects_writes(primary):
+    pool = db_router.read_pool_for_app(config_for(primary))
+    assert pool.read_only and pool.database == primary
+    conn = pool.acquire()
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute('UPDATE votes SET upvotes = upvotes + 1')
+    finally:
+        pool.release(conn)
+
+
+def test_reads_stay_on_primary_until_snapshot_exists(primary, tmp_path):
+    snapshot = str(tmp_path / 'snapshot.db')
+    assert db_router.read_pool_for_app(config_for(primary, snapshot)).database == primary
+    db_router.refresh_snapshot(primary, snapshot)
+    pool = db_router.read_pool_for_app(config_for(primary, snapshot))
+    assert pool.database == snapshot and pool.immutable
+    assert upvotes(pool) == 1
+
+
+def test_refreshed_snapshot_recycles_readers(primary, tmp_path):
+    snapshot = str(tmp_path / 'snapshot.db')
+    config = config_for(primary, snapshot)
+    db_router.refresh_snapshot(primary, snapshot)
+    pool = db_router.read_pool_for_app(config)
+    assert upvotes(pool) == 1
+
+    writer = db_pool.pool_for_app(config)
+    conn = writer.acquire()
+    conn.execute('UPDATE votes SET upvotes = 5')
+    conn.commit()
+    writer.release(conn)
+    # the snapshot only moves when it is refreshed
+    assert upvotes(db_router.read_pool_for_app(config)) == 1
+
+    db_router.refresh_snapshot(primary, snapshot)
+    assert upvotes(db_router.read_pool_for_app(config)) == 5
+    assert pool.metrics()['recycles'] == 1
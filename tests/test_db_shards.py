@@ -0,0 +1,85 @@
+# Sharding posts/votes by community, locating posts by id, merged global reads, and resharding.
+# $ python -m pytest tests/test_db_shards.py
+
+import os
+import sqlite3
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import db_shards
+import serialize
+
+
+@pytest.fixture
+def shard_dir(tmp_path):
+    source = str(tmp_path / 'data.db')
+    conn = sqlite3.connect(source)
+    with open(os.path.join(ROOT, 'data.sql'), mode='r') as f:
+        conn.executescript(f.read())
+    conn.close()
+    directory = str(tmp_path / 'shards')
+    db_shards.split_database(source, directory, 3)
+    return source, directory
+
+
+def router(directory):
+    return db_shards.ShardRouter({'SHARD_DIR': directory, 'DATABASE': None}, serialize.make_dicts)
+
+
+def shard_counts(directory, shards):
+    counts = []
+    for shard in shards:
+        conn = sqlite3.connect(db_shards.shard_path(directory, shard))
+        counts.append(conn.execute('SELECT count(*) FROM posts').fetchone()[0])
+        orphans = 'SELECT count(*) FROM posts LEFT JOIN votes ON votes.vote_id = posts.vote_id ' \
+                  'WHERE votes.vote_id IS NULL'
+        assert conn.execute(orphans).fetchone()[0] == 0
+        conn.close()
+    return counts
+
+
+def test_split_keeps_every_post_with_its_votes(shard_dir):
+    source, directory = shard_dir
+    total = sqlite3.connect(source).execute('SELECT count(*) FROM posts').fetchone()[0]
+    assert sum(shard_counts(directory, range(3))) == total
+
+
+def test_new_posts_get_ids_of_their_shard(shard_dir):
+    source, directory = shard_dir
+    shards = router(directory)
+    community_id, created = shards.create_community('new community')
+    assert created
+    shard = shards.shard_for_community(community_id)
+    values = (community_id, 'title', None, None, 'someone')
+    rows = shards.transaction(shard, list(db_shards.CREATE_POST_QUERIES) * 2, [(), (), values] * 2)
+    post_ids = [rows[2][0]['post_id'], rows[5][0]['post_id']]
+    assert [post_id % db_shards.SHARD_SLOTS for post_id in post_ids] == [shard, shard]
+    assert post_ids[1] - post_ids[0] == db_shards.SHARD_SLOTS
+    assert shards.locate(post_ids[0]) == shard
+    assert shards.find(post_ids[0], 'SELECT * FROM votes WHERE vote_id=?', (post_ids[0],))[0] == shard
+
+
+def test_scatter_merge_matches_single_file_order(shard_dir):
+    source, directory = shard_dir
+    query = 'SELECT post_id, published FROM posts ORDER BY published DESC, post_id DESC LIMIT ?'
+    conn = sqlite3.connect(source, detect_types=sqlite3.PARSE_DECLTYPES)
+    expected = [row[0] for row in conn.execute(query, (20,))]
+    shards = router(directory)
+    merged = shards.merge(shards.scatter(query, (20,)), key=lambda row: (row['published'], row['post_id']), limit=20)
+    assert [row['post_id'] for row in merged] == expected
+
+
+def test_reshard_moves_communities_and_keeps_rows(shard_dir):
+    source, directory = shard_dir
+    total = sum(shard_counts(directory, range(3)))
+    db_shards.reshard(directory, 5)
+    assert sum(shard_counts(directory, range(5))) == total
+    assert db_shards.reshard(directory, 5) == 0
+    db_shards.reshard(directory, 2)
+    assert sum(shard_counts(directory, range(2))) == total
+    assert shard_counts(directory, range(2, 5)) == [0, 0, 0]
+    assert router(directory).shards == [0, 1]
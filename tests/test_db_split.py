@@ -0,0 +1,73 @@
+# Splitting data.db into per-service files, and the services' cross-file queries over ATTACH.
+# $ python -m pytest tests/test_db_split.py
+
+import os
+import sqlite3
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import db_pool
+import db_split
+
+
+@pytest.fixture
+def split_dir(tmp_path):
+    source = str(tmp_path / 'data.db')
+    conn = sqlite3.connect(source)
+    with open(os.path.join(ROOT, 'data.sql'), mode='r') as f:
+        conn.executescript(f.read())
+    conn.close()
+    directory = str(tmp_path / 'split')
+    db_split.split_database(source, directory)
+    return source, directory
+
+
+def tables(path):
+    conn = sqlite3.connect(path)
+    try:
+        return set(row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'"))
+    finally:
+        conn.close()
+
+
+def test_each_service_gets_only_its_tables(split_dir):
+    source, directory = split_dir
+    for service, layout in db_split.SERVICES.items():
+        assert tables(db_split.path_for(directory, service)) == set(layout['tables'])
+
+
+def test_rows_and_schema_version_are_copied(split_dir):
+    source, directory = split_dir
+    original = sqlite3.connect(source)
+    for service, layout in db_split.SERVICES.items():
+        conn = sqlite3.connect(db_split.path_for(directory, service))
+        for table in layout['tables']:
+            count = 'SELECT count(*) FROM {}'.format(table)
+            assert conn.execute(count).fetchone() == original.execute(count).fetchone()
+        assert conn.execute('PRAGMA user_version').fetchone() == original.execute('PRAGMA user_version').fetchone()
+
+
+def test_foreign_keys_only_within_a_file(split_dir):
+    source, directory = split_dir
+    posts = sqlite3.connect(db_split.path_for(directory, 'posts'))
+    assert [row[2] for row in posts.execute('PRAGMA foreign_key_list(posts)')] == ['community']
+    messages = sqlite3.connect(db_split.path_for(directory, 'messages'))
+    assert [row[2] for row in messages.execute('PRAGMA foreign_key_list(favorite)')] == ['messages']
+
+
+def test_vote_queries_join_the_attached_posts(split_dir):
+    source, directory = split_dir
+    config = {'DATABASE': source, 'DB_SERVICE': 'votes', 'DB_SPLIT_DIR': directory}
+    pool = db_pool.pool_for_app(config)
+    conn = pool.acquire()
+    try:
+        query = 'SELECT upvotes, downvotes FROM votes INNER JOIN posts ON posts.vote_id = votes.vote_id ' \
+                'WHERE post_id = ?'
+        assert conn.execute(query, (1,)).fetchone() is not None
+        assert conn.execute('PRAGMA database_list').fetchall()[-1][1] == 'posts_db'
+    finally:
+        pool.release(conn)
@@ -0,0 +1,141 @@
+# Single-writer daemon: group commit with a savepoint per request, errors raised to clients, and
+# surviving requests or batches that fail in ways sqlite itself does not report.
+# $ python -m pytest tests/test_db_writer.py
+
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import db_writer
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / 'data.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE users (user_id INTEGER PRIMARY KEY, username VARCHAR UNIQUE)')
+    conn.execute("INSERT INTO users (username) VALUES ('ilovedog')")
+    conn.commit()
+    conn.close()
+    return path
+
+
+def usernames(database):
+    conn = sqlite3.connect(database)
+    try:
+        return [row[0] for row in conn.execute('SELECT username FROM users ORDER BY user_id')]
+    finally:
+        conn.close()
+
+
+INSERT = 'INSERT INTO users (username) VALUES (?) RETURNING username'
+
+
+def test_failing_request_rolls_back_alone_in_its_batch(database):
+    writer = db_writer.Writer(database)
+    requests = [
+        ([INSERT], [('a',)]),
+        # the first insert succeeds, the second breaks the UNIQUE constraint: neither may stay
+        ([INSERT, INSERT], [('b',), ('ilovedog',)]),
+        ([INSERT], [('c',)]),
+    ]
+    replies = [None] * len(requests)
+
+    def submit(i):
+        replies[i] = writer.submit(*requests[i])
+
+    # queue every request before the writer starts, so they share one group commit
+    threads = []
+    for i in range(len(requests)):
+        threads.append(threading.Thread(target=submit, args=(i,)))
+        threads[-1].start()
+        while writer._jobs.qsize() < i + 1:
+            time.sleep(0.01)
+    threading.Thread(target=writer.run, daemon=True).start()
+    for thread in threads:
+        thread.join(5.0)
+
+    assert replies[0] == {'results': [[{'username': 'a'}]]}
+    assert replies[1]['error'] == 'IntegrityError'
+    assert replies[2] == {'results': [[{'username': 'c'}]]}
+    assert usernames(database) == ['ilovedog', 'a', 'c']
+    assert writer.stats['commits'] == 1 and writer.stats['largest_batch'] == 3
+    assert writer.stats['failed_requests'] == 1
+
+
+def test_client_raises_the_writers_sqlite_error(database, tmp_path):
+    path = str(tmp_path / 'writer.sock')
+    writer = db_writer.Writer(database)
+    threading.Thread(target=writer.run, daemon=True).start()
+    server = db_writer.WriterServer(path, writer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = db_writer.WriterClient(path)
+        assert client.execute([INSERT], [('a',)]) == [[{'username': 'a'}]]
+        with pytest.raises(sqlite3.IntegrityError):
+            client.execute([INSERT], [('a',)])
+        assert usernames(database) == ['ilovedog', 'a']
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_non_sqlite_error_fails_one_request_and_keeps_the_writer(database):
+    writer = db_writer.Writer(database)
+    threading.Thread(target=writer.run, daemon=True).start()
+    # too large for a sqlite integer: OverflowError, raised by the sqlite3 module, not by sqlite
+    reply = writer.submit([INSERT], [(2 ** 63,)])
+    assert reply['error'] == 'OverflowError'
+    # the transaction was closed and the thread is still serving
+    assert writer.submit([INSERT], [('a',)]) == {'results': [[{'username': 'a'}]]}
+    assert usernames(database) == ['ilovedog', 'a']
+
+
+def test_commit_failure_rolls_back_and_keeps_the_writer(database):
+    writer = db_writer.Writer(database)
+    commit = writer._commit
+    calls = []
+
+    # the first batch fails after BEGIN, outside any request's savepoint
+    def failing_commit(conn, batch):
+        if not calls:
+            calls.append(batch)
+            conn.execute('BEGIN IMMEDIATE')
+            raise RuntimeError('boom')
+        return commit(conn, batch)
+
+    writer._commit = failing_commit
+    threading.Thread(target=writer.run, daemon=True).start()
+    assert writer.submit([INSERT], [('a',)]) == {'error': 'RuntimeError', 'message': 'boom'}
+    assert writer.submit([INSERT], [('b',)]) == {'results': [[{'username': 'b'}]]}
+    assert usernames(database) == ['ilovedog', 'b']
+
+
+@pytest.mark.parametrize('message', [
+    {'queries': [INSERT], 'args': []},
+    {'queries': INSERT, 'args': [['a']]},
+    {'queries': [INSERT], 'args': [[['a']]]},
+    {'queries': [INSERT], 'args': ['a']},
+])
+def test_server_refuses_malformed_requests(database, tmp_path, message):
+    path = str(tmp_path / 'writer.sock')
+    writer = db_writer.Writer(database)
+    threading.Thread(target=writer.run, daemon=True).start()
+    server = db_writer.WriterServer(path, writer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = db_writer.WriterClient(path)
+        reply = client._call(message)
+        assert reply['error'] == 'ProgrammingError'
+        assert writer.stats['requests'] == 0
+        assert client.execute([INSERT], [('a',)]) == [[{'username': 'a'}]]
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,105 @@
+# msg_api handlers run in-process against a copy of data.sql, no services needed.
+# $ python -m pytest tests/test_msg_api.py
+
+import os
+import sqlite3
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import db_shards
+import msg_api
+
+# 'healthLvr' and 'DrAlone' posted in 'coronavirus'
+USERS = ('tex', 'rex', 'healthLvr', 'DrAlone')
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / 'data.db')
+    conn = sqlite3.connect(path)
+    with open(os.path.join(ROOT, 'data.sql'), mode='r') as f:
+        conn.executescript(f.read())
+    conn.executemany('INSERT INTO users (username, email) VALUES (?, ?)',
+                     [(username, username + '@example.com') for username in USERS])
+    conn.commit()
+    conn.close()
+    return path
+
+
+@pytest.fixture
+def client(database):
+    config = dict(msg_api.app.config)
+    msg_api.app.config.update({'DATABASE': database, 'USER_ID_CACHE_BACKEND': None})
+    yield msg_api.app.test_client()
+    msg_api.app.config.update(config)
+
+
+def count_messages(database, msg_content):
+    conn = sqlite3.connect(database)
+    try:
+        return conn.execute('SELECT count(*) FROM messages WHERE msg_content = ?', (msg_content,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def broadcast(client, msg_content, recipients):
+    return client.post('/broadcast', json={'user_from': 'ilovedog', 'recipients': recipients,
+                                           'msg_content': msg_content})
+
+
+def test_inline_broadcast_is_all_or_nothing(client, database):
+    msg_api.app.config['BROADCAST_CHUNK_SIZE'] = 1
+    conn = sqlite3.connect(database)
+    conn.execute("CREATE TRIGGER reject_rex BEFORE INSERT ON messages "
+                 "WHEN NEW.user_to = (SELECT user_id FROM users WHERE username = 'rex') "
+                 "BEGIN SELECT RAISE(ABORT, 'rejected'); END")
+    conn.commit()
+    conn.close()
+
+    response = broadcast(client, 'failing', ['ilovecat', 'tex', 'rex'])
+    assert response.status_code == 404
+    assert count_messages(database, 'failing') == 0
+
+    response = broadcast(client, 'hello', ['ilovecat', 'tex', 'ghost'])
+    assert response.status_code == 201
+    assert response.get_json()['unknown'] == ['ghost']
+    assert count_messages(database, 'hello') == 2
+
+
+def test_background_broadcast_records_any_failure(client, database):
+    conn = sqlite3.connect(database)
+    conn.execute("INSERT INTO broadcast_jobs (job_id, user_from, total) VALUES ('broken', 1, 2)")
+    conn.execute("INSERT INTO broadcast_jobs (job_id, user_from, total, created) "
+                 "VALUES ('abandoned', 1, 2, DATETIME('now', 'localtime', '-1 day'))")
+    conn.commit()
+    conn.close()
+
+    # not a database error: recipient_ids isn't a list
+    msg_api.run_broadcast_job('broken', 1, None, 'hello', None)
+    status = client.get('/broadcast_status?job_id=broken').get_json()
+    assert status['state'] == 'failed' and 'TypeError' in status['error']
+    assert status['stale'] is False
+
+    assert client.get('/broadcast_status?job_id=abandoned').get_json()['stale'] is True
+
+
+@pytest.mark.parametrize('sharded', [False, True])
+def test_community_broadcast_reaches_its_posters(client, database, tmp_path, sharded):
+    if sharded:
+        directory = str(tmp_path / 'shards')
+        db_shards.split_database(database, directory, 2)
+        # posts now only live in the shards
+        conn = sqlite3.connect(database)
+        conn.execute('DELETE FROM posts')
+        conn.commit()
+        conn.close()
+        msg_api.app.config['SHARD_DIR'] = directory
+    response = client.post('/broadcast', json={'user_from': 'healthLvr', 'community_name': 'coronavirus',
+                                               'msg_content': 'stay home'})
+    assert response.status_code == 201
+    assert response.get_json()['sent'] == 1
+    assert count_messages(database, 'stay home') == 1
@@ -0,0 +1,46 @@
+# post_api handlers run in-process against a copy of data.sql, no services needed.
+# $ python -m pytest tests/test_post_api.py
+
+import os
+import sqlite3
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import post_api
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / 'data.db')
+    conn = sqlite3.connect(path)
+    with open(os.path.join(ROOT, 'data.sql'), mode='r') as f:
+        conn.executescript(f.read())
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.close()
+    config = dict(post_api.app.config)
+    post_api.app.config.update({'DATABASE': path, 'POST_CACHE_DIR': str(tmp_path / 'post_cache')})
+    yield path
+    post_api.app.config.update(config)
+
+
+def test_batch_limit_comes_from_app_config(database):
+    post_api.app.config['POST_BATCH_MAX'] = 2
+    client = post_api.app.test_client()
+    posts = [{'title': 'Batched', 'username': 'some_random_guy', 'community_name': 'RandomPeople'}] * 3
+    assert client.post('/create_batch', json={'posts': posts}).status_code == 413
+    response = client.post('/create_batch', json={'posts': posts[:2]})
+    assert response.status_code == 201
+    assert len(response.get_json()['post_ids']) == 2
+
+
+def test_zero_padded_page_size_still_gets_a_cursor(database):
+    client = post_api.app.test_client()
+    first = client.get('/filter?n=02&cursor=').get_json()
+    assert len(first['results']) == 2
+    assert first['next_cursor'] is not None
+    second = client.get('/filter?n=2&cursor=' + first['next_cursor']).get_json()
+    assert not {row['post_id'] for row in first['results']} & {row['post_id'] for row in second['results']}
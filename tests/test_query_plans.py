@@ -0,0 +1,132 @@
+# EXPLAIN QUERY PLAN checks for the hot lookups of every service, so a schema change that
+# drops an index (or a query rewrite that can't use one) shows up as a failing test.
+# Runs against an in-memory copy of data.sql, no services needed:
+# $ python -m pytest tests/test_query_plans.py
+
+import os
+import sqlite3
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import db_migrate
+import msg_api
+import post_api
+import user_ids
+import vote_api
+
+
+def load_schema(path=os.path.join(ROOT, 'data.sql')):
+    conn = sqlite3.connect(':memory:')
+    with open(path, mode='r') as f:
+        conn.executescript(f.read())
+    return conn
+
+
+def load_migrated_schema():
+    conn = load_schema(os.path.join(ROOT, 'tests', 'schema_v0.sql'))
+    db_migrate.migrate(conn)
+    return conn
+
+
+def query_plan(conn, query, args):
+    return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + query, args).fetchall()]
+
+
+def assert_no_scan(conn, query, args=(), allow_sort=False):
+    plan = query_plan(conn, query, args)
+    for detail in plan:
+        # a bare "SCAN table" is a full table scan; walking an index in order (or the single row of
+        # an INSERT ... SELECT without FROM) is fine
+        assert not (detail.startswith('SCAN') and 'INDEX' not in detail and detail != 'SCAN CONSTANT ROW'), plan
+        if not allow_sort:
+            assert 'TEMP B-TREE' not in detail, plan
+
+
+HOT_QUERIES = [
+    # msg_api: the statements the handlers run, first and later pages
+    (msg_api.SEND_QUERY, (1, 2, 'hey', None, 1, 'ilovedog', 2, 'ilovecat')),
+    (msg_api.mailbox_query('user_to', 'user_from', False), ('ilovecat', 20)),
+    (msg_api.mailbox_query('user_to', 'user_from', True), ('ilovecat', '2020-04-13 16:11:38', 4, 20)),
+    (msg_api.mailbox_query('user_from', 'user_to', False), ('ilovedog', 20)),
+    (msg_api.mailbox_query('user_from', 'user_to', True), ('ilovedog', '2020-04-13 16:11:38', 4, 20)),
+    (msg_api.thread_query(False), ('ilovedog', 'ilovecat', 'ilovedog', 'ilovecat',
+                                   'ilovecat', 'ilovedog', 'ilovecat', 'ilovedog', 20)),
+    (msg_api.thread_query(True), ('ilovedog', 'ilovecat', 'ilovedog', 'ilovecat', '2020-04-13 16:11:38', 4,
+                                  'ilovecat', 'ilovedog', 'ilovecat', 'ilovedog', '2020-04-13 16:11:38', 4, 20)),
+    (msg_api.UNREAD_QUERY, ('ilovecat',)),
+    # post_api: /get and the /filter shapes that have an index (first and later pages)
+    (post_api.GET_QUERY, (2,)),
+    (post_api.filter_statement(()), (10,)),
+    (post_api.filter_statement(('community_name',)), (2, 10)),
+    (post_api.filter_statement(('username',)), ('healthLvr', 10)),
+    (post_api.filter_statement(('cursor',)), ('2020-04-01 10:00:00', 3, 10)),
+    (post_api.filter_statement(('community_name', 'cursor')), (2, '2020-04-01 10:00:00', 3, 10)),
+    # vote_api: /get, /getTop (plain, leaderboard reload, first and later pages)
+    (vote_api.GET_VOTES_QUERY, (2,)),
+    (vote_api.TOP_QUERY, (10,)),
+    (vote_api.Leaderboard.LOAD_QUERY, (100,)),
+    (vote_api.TOP_PAGE_QUERY + vote_api.TOP_PAGE_ORDER, (10,)),
+    (vote_api.TOP_PAGE_QUERY + vote_api.TOP_PAGE_KEYSET + vote_api.TOP_PAGE_ORDER, (50, 50, 3, 10)),
+]
+
+
+# lookups of a caller-supplied id list: every row is found by key, only the (small) result is sorted
+SORTED_LOOKUPS = [
+    (vote_api.GET_LIST_QUERY, ('[1, 2, 3]',)),
+    # usernames -> user_ids (msg_api /send and /broadcast), and a community's posters (/broadcast)
+    (user_ids.RESOLVE_QUERY, ('["ilovecat", "tex"]',)),
+    (msg_api.COMMUNITY_RECIPIENTS_QUERY, ('coronavirus', 1)),
+]
+
+
+@pytest.mark.parametrize('query,args', HOT_QUERIES)
+def test_fresh_schema_uses_indexes(query, args):
+    assert_no_scan(load_schema(), query, args)
+
+
+@pytest.mark.parametrize('query,args', HOT_QUERIES)
+def test_migrated_schema_uses_indexes(query, args):
+    assert_no_scan(load_migrated_schema(), query, args)
+
+
+@pytest.mark.parametrize('query,args', SORTED_LOOKUPS)
+@pytest.mark.parametrize('load', [load_schema, load_migrated_schema])
+def test_id_list_lookups_use_keys(load, query, args):
+    assert_no_scan(load(), query, args, allow_sort=True)
+
+
+def test_migration_reaches_latest_version():
+    conn = load_migrated_schema()
+    assert db_migrate.schema_version(conn) == db_migrate.latest_version()
+    # running it again is a no-op
+    assert db_migrate.migrate(conn) == []
+
+
+def test_fresh_schema_is_latest_version():
+    assert db_migrate.schema_version(load_schema()) == db_migrate.latest_version()
+
+
+@pytest.mark.parametrize('load', [load_schema, load_migrated_schema])
+def test_unique_constraints(load):
+    conn = load()
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute("INSERT INTO users (username, email) VALUES ('ilovedog', 'new@x.com')")
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute("INSERT INTO users (username, email) VALUES ('new', 'dogperson@ilovedog.com')")
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute("INSERT INTO community (community_name) VALUES ('cheesecake')")
+
+
+def test_migration_backfills_score():
+    conn = load_migrated_schema()
+    assert conn.execute('SELECT upvotes - downvotes, score FROM votes').fetchall() == [(79, 79)]
+
+
+def test_unread_count_uses_partial_index():
+    for conn in (load_schema(), load_migrated_schema()):
+        plan = query_plan(conn, msg_api.UNREAD_QUERY, ('ilovecat',))
+        assert any('idx_messages_unread' in detail for detail in plan), plan
@@ -0,0 +1,49 @@
+# user_api handlers run in-process against a copy of data.sql, no services needed.
+# $ python -m pytest tests/test_user_api.py
+
+import os
+import sqlite3
+import sys
+import threading
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import db_writer
+import user_api
+
+
+# writes either on the pooled connections or through an in-process writer daemon
+@pytest.fixture(params=['direct', 'writer'])
+def client(request, tmp_path):
+    path = str(tmp_path / 'data.db')
+    conn = sqlite3.connect(path)
+    with open(os.path.join(ROOT, 'data.sql'), mode='r') as f:
+        conn.executescript(f.read())
+    conn.close()
+    server = None
+    socket_path = None
+    if request.param == 'writer':
+        socket_path = str(tmp_path / 'writer.sock')
+        writer = db_writer.Writer(path)
+        threading.Thread(target=writer.run, daemon=True).start()
+        server = db_writer.WriterServer(socket_path, writer)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    config = dict(user_api.app.config)
+    user_api.app.config.update({'DATABASE': path, 'DB_WRITER_SOCKET': socket_path})
+    yield user_api.app.test_client()
+    user_api.app.config.update(config)
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+
+
+def test_update_email_to_a_taken_one_conflicts(client):
+    taken = {'username': 'ilovecat', 'email': 'dogperson@ilovedog.com'}
+    assert client.put('/update_email', json=taken).status_code == 409
+    free = {'username': 'ilovecat', 'email': 'cat@ilovecat.com'}
+    assert client.put('/update_email', json=free).status_code == 200
+    missing = {'username': 'nobody', 'email': 'nobody@ilovecat.com'}
+    assert client.put('/update_email', json=missing).status_code == 404
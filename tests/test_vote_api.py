@@ -0,0 +1,76 @@
+# vote_api pieces run in-process against a copy of data.sql, no services needed.
+# $ python -m pytest tests/test_vote_api.py
+
+import os
+import sqlite3
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import vote_api
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / 'data.db')
+    conn = sqlite3.connect(path)
+    with open(os.path.join(ROOT, 'data.sql'), mode='r') as f:
+        conn.executescript(f.read())
+    # like data.db: already WAL, so the pool's first connection doesn't change the file
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.close()
+    config = dict(vote_api.app.config)
+    vote_api.app.config['DATABASE'] = path
+    yield path
+    vote_api.app.config.update(config)
+
+
+def top(leaderboard, n):
+    with vote_api.app.app_context():
+        return [row['post_id'] for row in leaderboard.top(n)]
+
+
+def test_leaderboard_reloads_after_an_external_write(database):
+    # poll on every call, never expire by age
+    leaderboard = vote_api.Leaderboard(database, size=3, poll=0.0, ttl=3600.0)
+    assert top(leaderboard, 2) == [1, 2]
+    assert top(leaderboard, 2) == [1, 2]
+    assert leaderboard.metrics()['reloads'] == 1
+
+    # another worker (or service) commits: PRAGMA data_version moves and the cache reloads
+    conn = sqlite3.connect(database)
+    conn.execute('UPDATE votes SET upvotes = upvotes + 100, score = score + 100 WHERE vote_id = 4')
+    conn.commit()
+    conn.close()
+    assert top(leaderboard, 2) == [4, 1]
+    stats = leaderboard.metrics()
+    assert stats['reloads'] == 2 and stats['invalidations'] == 1
+
+
+def test_leaderboard_applies_local_votes_without_reloading(database):
+    leaderboard = vote_api.Leaderboard(database, size=3, poll=3600.0, ttl=3600.0)
+    assert top(leaderboard, 3) == [1, 2, 3]
+    # post 4 was left out; a vote this worker committed moves it in and pushes post 3 out
+    leaderboard.record_vote(4, 4, 70)
+    assert top(leaderboard, 3) == [1, 4, 2]
+    assert leaderboard.metrics()['reloads'] == 1
+
+
+def test_batch_limit_comes_from_app_config(database):
+    vote_api.app.config['VOTE_BATCH_MAX'] = 2
+    client = vote_api.app.test_client()
+    votes = [{'post_id': 2, 'direction': 'up'}] * 3
+    assert client.post('/batch', json={'votes': votes}).status_code == 413
+    assert client.post('/batch', json={'votes': votes[:2]}).status_code == 200
+
+
+def test_zero_padded_page_size_still_gets_a_cursor(database):
+    client = vote_api.app.test_client()
+    first = client.get('/getTop?n=02&cursor=').get_json()
+    assert len(first['results']) == 2
+    assert first['next_cursor'] is not None
+    second = client.get('/getTop?n=2&cursor=' + first['next_cursor']).get_json()
+    assert not {row['post_id'] for row in first['results']} & {row['post_id'] for row in second['results']}
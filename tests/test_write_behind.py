@@ -0,0 +1,158 @@
+# Write-behind buffers (votes and karma): a failed flush keeps its batch and the next flush still commits it.
+# read() never counts a change both in the row and as pending while a flush commits.
+# $ python -m pytest tests/test_write_behind.py
+
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import db_pool
+import serialize
+import user_api
+import vote_api
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / 'data.db')
+    conn = sqlite3.connect(path)
+    with open(os.path.join(ROOT, 'data.sql'), mode='r') as f:
+        conn.executescript(f.read())
+    conn.close()
+    return path
+
+
+# a one-connection pool that times out at once, so holding its connection makes every flush fail
+def config_for(app, database):
+    config = dict(app.config)
+    config.update({'DATABASE': database, 'POOL_SIZE': 1, 'POOL_TIMEOUT': 0.01,
+                   'VOTE_BUFFER_MAX_DELAY': 0.02, 'KARMA_BUFFER_MAX_DELAY': 0.02})
+    return config
+
+
+def wait_for(buffer, stat, at_least=1, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while buffer.metrics()[stat] < at_least:
+        assert time.monotonic() < deadline, buffer.metrics()
+        time.sleep(0.01)
+
+
+def fetch_one(database, query, args):
+    conn = sqlite3.connect(database)
+    try:
+        return conn.execute(query, args).fetchone()
+    finally:
+        conn.close()
+
+
+def test_vote_flush_failure_keeps_votes_for_next_flush(database):
+    config = config_for(vote_api.app, database)
+    query = 'SELECT upvotes, downvotes FROM votes INNER JOIN posts ON posts.vote_id = votes.vote_id ' \
+            'WHERE post_id = ?'
+    before = fetch_one(database, query, (1,))
+    buffer = vote_api.VoteBuffer(config, vote_api.Leaderboard(database, 10, 1.0, 60.0))
+
+    # the background flusher fails while the pool's only connection is held...
+    pool = db_pool.pool_for_app(config, row_factory=serialize.make_dicts)
+    held = pool.acquire()
+    try:
+        buffer.add(1, 2, 1)
+        wait_for(buffer, 'flush_failures')
+        assert buffer.pending(1) == (2, 1)
+    finally:
+        pool.release(held)
+
+    # ...and keeps running, so the kept votes go out with the next ones
+    buffer.add(1, 1, 0)
+    wait_for(buffer, 'flushed_votes', 4)
+    assert buffer.pending(1) == (0, 0)
+    assert fetch_one(database, query, (1,)) == (before[0] + 3, before[1] + 1)
+
+
+def test_karma_flush_failure_keeps_changes_for_next_flush(database):
+    config = config_for(user_api.app, database)
+    query = 'SELECT karma FROM users WHERE username = ?'
+    before = fetch_one(database, query, ('ilovedog',))[0]
+    buffer = user_api.KarmaBuffer(config)
+
+    pool = db_pool.pool_for_app(config, row_factory=serialize.make_dicts)
+    held = pool.acquire()
+    try:
+        buffer.add('ilovedog', 5)
+        wait_for(buffer, 'flush_failures')
+        assert buffer.pending('ilovedog') == 5
+    finally:
+        pool.release(held)
+
+    buffer.add('ilovedog', -2)
+    wait_for(buffer, 'flushed_changes', 2)
+    assert buffer.pending('ilovedog') == 0
+    assert fetch_one(database, query, ('ilovedog',))[0] == before + 3
+
+
+# a karma buffer whose flush commits and then blocks until released
+class BlockingKarmaBuffer(user_api.KarmaBuffer):
+    def __init__(self, config):
+        super().__init__(config)
+        self.committed = threading.Event()
+        self.release = threading.Event()
+
+    def write(self, batch):
+        result = super().write(batch)
+        self.committed.set()
+        self.release.wait(5.0)
+        return result
+
+
+def test_read_during_a_committed_flush_counts_changes_once(database):
+    config = config_for(user_api.app, database)
+    config['KARMA_BUFFER_MAX_DELAY'] = 60.0
+    query = 'SELECT karma FROM users WHERE username = ?'
+    before = fetch_one(database, query, ('ilovedog',))[0]
+    buffer = BlockingKarmaBuffer(config)
+    buffer.add('ilovedog', 5)
+    flusher = threading.Thread(target=buffer.flush)
+    flusher.start()
+    assert buffer.committed.wait(5.0)
+
+    # the row already holds the +5 while the batch is still in flight
+    results = []
+    reader = threading.Thread(target=lambda: results.append(
+        buffer.read('ilovedog', lambda: fetch_one(database, query, ('ilovedog',))[0])))
+    reader.start()
+    reader.join(0.1)
+    assert reader.is_alive()
+    buffer.add('ilovedog', 1)
+    buffer.release.set()
+    flusher.join(5.0)
+    reader.join(5.0)
+    karma, pending = results[0]
+    assert karma + pending == before + 6
+
+
+def test_read_retries_when_a_flush_commits_under_it(database):
+    config = config_for(user_api.app, database)
+    config['KARMA_BUFFER_MAX_DELAY'] = 60.0
+    query = 'SELECT karma FROM users WHERE username = ?'
+    before = fetch_one(database, query, ('ilovedog',))[0]
+    buffer = user_api.KarmaBuffer(config)
+    buffer.add('ilovedog', 5)
+    reads = []
+
+    # the first read sees the row before the flush, which then commits before pending is taken
+    def fetch():
+        reads.append(fetch_one(database, query, ('ilovedog',))[0])
+        if len(reads) == 1:
+            assert buffer.flush()
+        return reads[-1]
+
+    karma, pending = buffer.read('ilovedog', fetch)
+    assert len(reads) == 2
+    assert karma + pending == before + 5
@@ -1,7 +1,17 @@
 import flask
 from flask import request, jsonify, g, current_app
+import atexit
+import os
 import sqlite3
 
+import db_migrate
+import db_pool
+import db_split
+import db_writer
+import serialize
+import user_ids
+import write_behind
+
 ######################
 # API USAGE
 # Caddy Web server route for this API: localhost:$PORT/users/
@@ -28,6 +38,10 @@ import sqlite3
 #   curl -i -X PUT -H 'Content-Type:application/json' -d '{"username":"axel"}'
 #   http://localhost:2015/users/remove_karma
 # --------------------
+# Report a user's karma (including changes still buffered by KARMA_WRITE_BEHIND):
+# Example request:
+#   curl -i http://localhost:2015/users/karma?username=axel;
+# --------------------
 # Delete a user: Send a DELETE request to route of delete() fn
 # Example request:
 #   curl -i -X DELETE http://localhost:2015/users/delete?username=axel;
@@ -35,11 +49,31 @@ import sqlite3
 
 # config variables
 DATABASE = 'data.db'
+DB_SERVICE = 'users'
+DB_SPLIT_DIR = None
 DEBUG = True
+POOL_SIZE = 5
+POOL_TIMEOUT = 5.0
+POOL_HEALTH_CHECK = 30.0
+DB_WRITER_SOCKET = None
+# username -> user_id cache shared with the other service (see user_ids); 'file' so user_api's
+# invalidations on /register and /delete reach every msg_api worker
+USER_ID_CACHE_BACKEND = 'file'
+USER_ID_CACHE_SIZE = 10000
+USER_ID_CACHE_TTL = 300.0
+USER_ID_CACHE_DIR = 'user_id_cache'
+# optional write-behind mode for /add_karma and /remove_karma: changes are summed per user in memory
+# and flushed in one executemany every KARMA_BUFFER_MAX_DELAY seconds (how stale karma in the
+# database may be, and the most a crashed worker can lose) or as soon as KARMA_BUFFER_MAX_CHANGES
+# are pending; graceful shutdown flushes what is left
+KARMA_WRITE_BEHIND = False
+KARMA_BUFFER_MAX_DELAY = 0.5
+KARMA_BUFFER_MAX_CHANGES = 1000
 
 ######################
 app = flask.Flask(__name__)
 app.config.from_object(__name__)
+serialize.install(app)
 
 ######################
 # Database
@@ -62,9 +96,8 @@ app.config.from_object(__name__)
 
 
 ######################
-# helper function used to convert each query result row into dictionary
-def make_dicts(cursor, row):
-    return dict((cursor.description[idx][0], value) for idx, value in enumerate(row))
+# helper function used to convert each query result row into dictionary (see serialize)
+make_dicts = serialize.make_dicts
 
 
 # helper function to generate a response with status code and message
@@ -72,14 +105,25 @@ def get_response(status_code, message):
     return {"status_code": str(status_code), "message": str(message)}
 
 
-# get db from flask g namespace
+# pool of long-lived connections for this worker
+def get_db_pool():
+    return db_pool.pool_for_app(current_app.config, row_factory=make_dicts)
+
+
+# client of the single-writer daemon when DB_WRITER_SOCKET is set (see db_writer), else None
+def get_writer():
+    return db_writer.writer_for_app(current_app.config)
+
+
+# this worker's username -> user_id cache (None when USER_ID_CACHE_BACKEND is off)
+def get_user_ids():
+    return user_ids.cache_for_app(current_app.config, current_app.root_path)
+
+
+# get db from flask g namespace (checked out of the worker's pool, returned on teardown)
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = make_dicts
+        g.db = get_db_pool().acquire()
     return g.db
 
 
@@ -89,12 +133,27 @@ def get_db():
 @app.cli.command('init')
 def init_db():
     with app.app_context():
+        if app.config['DB_SPLIT_DIR']:
+            # split mode: build only this service's file (see db_split)
+            with app.open_resource('data.sql', mode='r') as f:
+                db_split.init_split(app.config, f.read())
+            return
         db = get_db()
+        # the pooled connection has already applied the WAL/pragma profile (see db_pool)
         with app.open_resource('data.sql', mode='r') as f:
             db.cursor().executescript(f.read())
         db.commit()
 
 
+# bring an existing db up to the current schema version in place
+# $flask migrate
+@app.cli.command('migrate')
+def migrate_db():
+    with app.app_context():
+        for name in db_migrate.migrate(get_db()):
+            print(f'Applied migration {name}')
+
+
 # close db connection
 @app.teardown_appcontext
 def close_db(e=None):
@@ -102,7 +161,7 @@ def close_db(e=None):
         print(f'Closing db: {e}')
     db = g.pop('db', None)
     if db is not None:
-        db.close()
+        get_db_pool().release(db)
 
 
 # home page
@@ -118,20 +177,59 @@ def page_not_found(status_code=404):
     return jsonify(error_json), status_code
 
 
+# database stayed locked past DB_BUSY_RETRIES (or no pooled connection freed up within POOL_TIMEOUT)
+@app.errorhandler(db_pool.DatabaseBusy)
+def database_busy(e):
+    print(e)
+    response = jsonify(get_response(status_code=503, message="Database busy, try again"))
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+# connection pool usage for this worker
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    stats = {'pool': get_db_pool().metrics()}
+    if get_user_ids() is not None:
+        stats['user_ids'] = get_user_ids().metrics()
+    if current_app.config['KARMA_WRITE_BEHIND']:
+        stats['karma_buffer'] = get_karma_buffer().metrics()
+    if get_writer() is not None:
+        stats['writer'] = get_writer().metrics()
+    return jsonify(stats), 200
+
+
 # function to execute a single query at once
-def query_db(query, args=(), one=False, commit=False):
+def query_db(query, args=(), one=False, commit=False, return_=False):
     # one=True means return single record
     # commit = True for post and delete query (return boolean)
+    # return_=True returns the rows of a committed query too (... RETURNING), so a write can tell
+    # "no such user" (no rows) from success without a separate existence check
+    writer = get_writer() if commit else None
+    if writer is not None:
+        try:
+            rv = writer.execute([query], [args])[0]
+        except sqlite3.OperationalError as e:
+            print(e)
+            return False
+        if not return_:
+            return True
+        return (rv[0] if rv else None) if one else rv
     conn = get_db()
-    try:
+
+    def run():
         rv = conn.execute(query, args).fetchall()
         if commit:
             conn.commit()
+        return rv
+
+    try:
+        rv = get_db_pool().retry_busy(conn, run)
     except sqlite3.OperationalError as e:
         print(e)
         return False
-    close_db()
-    if not commit:
+    if not commit or return_:
         return (rv[0] if rv else None) if one else rv
     return True
 
@@ -139,23 +237,103 @@ def query_db(query, args=(), one=False, commit=False):
 # function to execute multiple queries at once (also fn commits the transaction)
 def transaction_db(query, args, return_=False):
     # return_=True if the transaction needs returns a result
-    conn = get_db()
     if len(query) != len(args):
         raise ValueError('arguments dont match queries')
-    try:
+    writer = get_writer()
+    if writer is not None:
+        try:
+            rv = writer.execute(query, args)
+        except (sqlite3.OperationalError, sqlite3.ProgrammingError) as e:
+            print('Transaction failed. Rolled back')
+            print(e)
+            return False
+        return True if not return_ else rv
+    conn = get_db()
+
+    def run():
         rv = []
         conn.execute('BEGIN')
         for i in range(len(query)):
             rv.append(conn.execute(query[i], args[i]).fetchall())
         conn.commit()
+        return rv
+
+    try:
+        rv = get_db_pool().retry_busy(conn, run)
     except (sqlite3.OperationalError, sqlite3.ProgrammingError) as e:
-        conn.execute('rollback')
+        if conn.in_transaction:
+            conn.execute('rollback')
         print('Transaction failed. Rolled back')
         print(e)
         return False
-    close_db()
     return True if not return_ else rv
 
+# Per-worker write-behind buffer of karma changes, only used when KARMA_WRITE_BEHIND is set.
+# Popular users get many karma changes a second; coalescing them turns each user's burst into one
+# UPDATE, and each flush into one transaction. /karma adds the unflushed changes, so it reports the
+# merged value.
+class KarmaBuffer(write_behind.WriteBehindBuffer):
+    thread_name = 'karma-buffer'
+    unit = 'changes'
+    item = 'users'
+    FLUSH_QUERY = 'UPDATE users SET karma = karma + ? WHERE username = ?'
+
+    def __init__(self, config):
+        super().__init__(config['KARMA_BUFFER_MAX_DELAY'], config['KARMA_BUFFER_MAX_CHANGES'])
+        self.config = config
+        self.stats['flushed_users'] = 0
+
+    # commit a batch; returns how many users were written
+    def write(self, batch):
+        # changes that cancelled out need no write
+        args = [(delta, username) for username, delta in batch.items() if delta]
+        if not args:
+            return 0
+        writer = db_writer.writer_for_app(self.config)
+        if writer is not None:
+            writer.execute([self.FLUSH_QUERY] * len(args), args)
+            return len(args)
+        pool = db_pool.pool_for_app(self.config, row_factory=make_dicts)
+        conn = pool.acquire()
+
+        def run():
+            conn.execute('BEGIN')
+            conn.executemany(self.FLUSH_QUERY, args)
+            conn.commit()
+
+        try:
+            pool.retry_busy(conn, run)
+        finally:
+            pool.release(conn)
+        return len(args)
+
+    def flushed(self, batch, users):
+        with self._lock:
+            self.stats['flushed_users'] += users
+
+
+_karma_buffers = {}
+
+
+# one buffer per worker process; flushed at interpreter exit (gunicorn's graceful worker shutdown)
+def get_karma_buffer():
+    key = (os.getpid(), current_app.config['DATABASE'])
+    if key not in _karma_buffers:
+        buffer = KarmaBuffer(current_app.config)
+        atexit.register(buffer.flush)
+        _karma_buffers[key] = buffer
+    return _karma_buffers[key]
+
+
+# accept a karma change into the write-behind buffer: True, None if there is no such user, False on error.
+# Existence is a read, which doesn't wait on the write lock; a user deleted before the flush is skipped
+def buffer_karma(username, delta):
+    q = query_db('SELECT user_id FROM users WHERE username = ?', (username,), one=True)
+    if not q:
+        return q
+    get_karma_buffer().add(username, delta)
+    return True
+
 ### WHAT TO DO ###
 # 1. Create user
 # 2. Update Email
@@ -176,20 +354,17 @@ def register():
     if not username or not email:
         return jsonify(get_response(status_code=409, message="Username / Email is not provided")), 409
 
-    query = 'SELECT username, email FROM users WHERE username = ? OR email = ?'
-    args = (username, email)
-
-    q = query_db(query, args)
-
-    if q:
-        return jsonify(get_response(status_code=404, message="Username / Email has been taken")), 404
-
-    query = 'INSERT INTO users (username, email) VALUES (?, ?)'
+    # username and email are both UNIQUE: a taken one makes the insert a no-op that returns no row
+    query = 'INSERT INTO users (username, email) VALUES (?, ?) ON CONFLICT DO NOTHING RETURNING user_id'
     args = (username, email)
-    q = query_db(query, args, commit=True)
+    q = query_db(query, args, one=True, commit=True, return_=True)
 
-    if not q:
+    if q is False:
         return page_not_found(404)
+    if q is None:
+        return jsonify(get_response(status_code=404, message="Username / Email has been taken")), 404
+    # replaces whatever an earlier user of this name left in the cache
+    user_ids.remember(get_user_ids(), username, q['user_id'])
 
     return jsonify(get_response(status_code=201, message="User created")), 201
 
@@ -202,20 +377,18 @@ def updateEmail():
     if not username or not email:
         return jsonify(get_response(status_code=409, message="Username / Email is not provided")), 409
 
-    query = 'SELECT username FROM users WHERE username = ?'
-    args = (username,)
-
-    q = query_db(query, args)
-
-    if not q:
-        return jsonify(get_response(status_code=404, message="Username not found")), 404
-
-    query = 'UPDATE users SET email = ? WHERE username = ?'
+    query = 'UPDATE users SET email = ? WHERE username = ? RETURNING user_id'
     args = (email, username)
 
-    q = query_db(query, args, commit=True)
-    if not q:
+    # email is UNIQUE: another user's address fails the update (directly or through the writer)
+    try:
+        q = query_db(query, args, one=True, commit=True, return_=True)
+    except sqlite3.IntegrityError:
+        return jsonify(get_response(status_code=409, message="Email has been taken")), 409
+    if q is False:
         return page_not_found(404)
+    if q is None:
+        return jsonify(get_response(status_code=404, message="Username not found")), 404
 
     return jsonify(get_response(status_code=200, message="Email updated")), 200
 
@@ -227,20 +400,17 @@ def add_karma():
     if not username:
         return jsonify(get_response(status_code=409, message="Username is not provided")), 409
 
-    query = 'SELECT username FROM users WHERE username = ?'
-    args = (username,)
-
-    q = query_db(query, args)
-
-    if not q:
-        return jsonify(get_response(status_code=404, message="Username not found")), 404
+    if current_app.config['KARMA_WRITE_BEHIND']:
+        q = buffer_karma(username, 1)
+    else:
+        query = 'UPDATE users SET karma = karma + 1 WHERE username = ? RETURNING karma'
+        args = (username,)
+        q = query_db(query, args, one=True, commit=True, return_=True)
 
-    query = 'UPDATE users SET karma = karma + 1 WHERE username = ?'
-    args = (username,)
-    q = query_db(query, args, commit=True)
-
-    if not q:
+    if q is False:
         return page_not_found(404)
+    if q is None:
+        return jsonify(get_response(status_code=404, message="Username not found")), 404
 
     return jsonify(get_response(status_code=200, message="Karma added")), 200
 
@@ -252,22 +422,41 @@ def remove_karma():
     if not username:
         return jsonify(get_response(status_code=409, message="Username is not provided")), 409
 
-    query = 'SELECT username FROM users WHERE username = ?'
-    args = (username,)
-
-    q = query_db(query, args)
+    if current_app.config['KARMA_WRITE_BEHIND']:
+        q = buffer_karma(username, -1)
+    else:
+        query = 'UPDATE users SET karma = karma - 1 WHERE username = ? RETURNING karma'
+        args = (username,)
+        q = query_db(query, args, one=True, commit=True, return_=True)
 
-    if not q:
+    if q is False:
+        return page_not_found(404)
+    if q is None:
         return jsonify(get_response(status_code=404, message="Username not found")), 404
 
-    query = 'UPDATE users SET karma = karma - 1 WHERE username = ?'
-    args = (username,)
-    q = query_db(query, args, commit=True)
+    return jsonify(get_response(status_code=200, message="Karma deducted")), 200
 
-    if not q:
-        return page_not_found(404)
+# Report a user's karma; in write-behind mode this worker's unflushed changes are added in
+@app.route('/karma', methods=['GET'])
+def get_karma():
+    params = request.args
+    username = params.get('username')
 
-    return jsonify(get_response(status_code=200, message="Karma deducted")), 200
+    if not username:
+        return jsonify(get_response(status_code=409, message="Username is not provided")), 409
+
+    query = 'SELECT username, karma FROM users WHERE username = ?'
+    if current_app.config['KARMA_WRITE_BEHIND']:
+        # read the row and the buffered changes together, so a flush committing meanwhile isn't counted twice
+        q, pending = get_karma_buffer().read(username, lambda: query_db(query, (username,), one=True))
+    else:
+        q, pending = query_db(query, (username,), one=True), 0
+    if q is False:
+        return page_not_found(404)
+    if q is None:
+        return jsonify(get_response(status_code=404, message="Username not found")), 404
+    q['karma'] += pending
+    return jsonify(q), 200
 
 @app.route('/delete', methods=['DELETE'])
 def delete():
@@ -277,19 +466,15 @@ def delete():
     if not username:
         return jsonify(get_response(status_code=409, message="Username is not provided")), 409
 
-    query = 'SELECT username FROM users WHERE username = ?'
-    args = (username,)
-    q = query_db(query, args)
-
-    if not q:
-        return jsonify(get_response(status_code=404, message="Username not found")), 404
-
-    query = 'DELETE FROM users WHERE username = ?'
+    query = 'DELETE FROM users WHERE username = ? RETURNING user_id'
     args = (username,)
 
-    q = query_db(query, args, commit=True)
-    if not q:
+    q = query_db(query, args, one=True, commit=True, return_=True)
+    if q is False:
         return page_not_found(404)
+    user_ids.invalidate(get_user_ids(), username)
+    if q is None:
+        return jsonify(get_response(status_code=404, message="Username not found")), 404
 
     return jsonify(get_response(status_code=200, message="User deleted")), 200
 
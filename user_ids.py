@@ -0,0 +1,83 @@
+import json
+import os
+import threading
+
+import cache_backends
+
+######################
+# username -> user_id cache shared by user_api and msg_api. msg_api resolves senders and recipients
+# through it; user_api replaces a user's entry on /register and drops it on /delete.
+#
+# With USER_ID_CACHE_BACKEND = 'file' (the default) every worker of both services shares one cache
+# directory on the host, so user_api's invalidations are seen everywhere at once. With 'memory'
+# each worker keeps its own LRU and user_api's remember/invalidate never reach msg_api; that mode
+# relies entirely on msg_api's insert re-checking each cached id against its username (a primary
+# key lookup) and refreshing on a mismatch, so a stale entry costs a retry, never a misdirected
+# message.
+#
+# App config keys (read by cache_for_app):
+#   USER_ID_CACHE_BACKEND  'memory', 'file' or None to disable
+#   USER_ID_CACHE_SIZE     most usernames kept
+#   USER_ID_CACHE_TTL      seconds an entry is trusted
+#   USER_ID_CACHE_DIR      directory of the file backend, relative to the app's root_path
+
+DEFAULT_SIZE = 10000
+DEFAULT_TTL = 300.0
+DEFAULT_DIR = 'user_id_cache'
+
+RESOLVE_QUERY = 'SELECT username, user_id FROM users WHERE username IN (SELECT value FROM json_each(?))'
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+# the cache described by a flask app config, None when USER_ID_CACHE_BACKEND is off; apps in one
+# process with the same settings share one instance
+def cache_for_app(config, root_path):
+    backend = config.get('USER_ID_CACHE_BACKEND')
+    if not backend:
+        return None
+    directory = os.path.join(root_path, config.get('USER_ID_CACHE_DIR', DEFAULT_DIR))
+    key = (os.getpid(), backend, directory)
+    cache = _caches.get(key)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(key)
+            if cache is None:
+                cache = cache_backends.make_cache(backend, config.get('USER_ID_CACHE_SIZE', DEFAULT_SIZE),
+                                                  config.get('USER_ID_CACHE_TTL', DEFAULT_TTL), directory)
+                _caches[key] = cache
+    return cache
+
+
+# {username: user_id} for the usernames that exist, False on error. Cached names cost nothing,
+# the rest are looked up with one query(sql, args) call and cached
+def resolve(cache, usernames, query):
+    ids = {}
+    missing = []
+    for username in usernames:
+        user_id = cache.get(username) if cache is not None else None
+        if user_id is None:
+            missing.append(username)
+        else:
+            ids[username] = user_id
+    if missing:
+        rows = query(RESOLVE_QUERY, (json.dumps(sorted(set(missing))),))
+        if rows is False:
+            return False
+        for row in rows:
+            ids[row['username']] = row['user_id']
+            if cache is not None:
+                cache.set(row['username'], row['user_id'])
+    return ids
+
+
+def remember(cache, username, user_id):
+    if cache is not None:
+        cache.set(username, user_id)
+
+
+def invalidate(cache, *usernames):
+    if cache is not None:
+        for username in usernames:
+            cache.delete(username)
@@ -1,6 +1,22 @@
 import flask
 from flask import request, jsonify, g, current_app
+import atexit
+import bisect
+import json
+import os
 import sqlite3
+import threading
+import time
+
+import db_migrate
+import db_pool
+import db_router
+import db_shards
+import db_split
+import db_writer
+import pagination
+import serialize
+import write_behind
 
 ######################
 # API USAGE
@@ -16,6 +32,11 @@ import sqlite3
 # Example request:
 # 	curl -i 'http://localhost:2015/votes/downvotes?vote_id=1';
 # --------------------
+# Apply many votes in one request (and one commit):
+# Example request:
+#   curl -i -X POST -H "Content-Type: application/json"
+#   -d '{"votes":[{"post_id":2,"direction":"up"},{"post_id":3,"direction":"down"}]}' 'http://localhost:2015/votes/batch';
+# --------------------
 # Report the number of upvotes and downvotes for a post:
 # Example request:
 #   curl -i 'http://localhost:2015/votes/get?vote_id=2';
@@ -23,6 +44,8 @@ import sqlite3
 # List the n top-scoring posts to any community:
 # Example request:
 # 	curl -i 'http://localhost:2015/votes/getTop?n=3';
+# Page through the ranking: pass cursor (empty for the first page) to get {"results": [...], "next_cursor": ...}
+# 	curl -i 'http://localhost:2015/votes/getTop?n=3&cursor=';
 # --------------------
 # Given a list of post identifiers, return the list sorted by score.:
 # Example request:
@@ -36,10 +59,36 @@ import sqlite3
 
 # config
 DATABASE = 'data.db'
+DB_SERVICE = 'votes'
+DB_SPLIT_DIR = None
 DEBUG = True
+POOL_SIZE = 5
+POOL_TIMEOUT = 5.0
+POOL_HEALTH_CHECK = 30.0
+DB_WRITER_SOCKET = None
+DB_READ_SNAPSHOT = None
+# directory of a sharded layout (see db_shards); getTop then merges the shards instead of using the leaderboard
+SHARD_DIR = None
+SHARD_LOCATION_CACHE = 65536
+# leaderboard cache for /getTop: how many top posts each worker keeps, how often it checks
+# PRAGMA data_version for other workers' writes (max staleness), and a hard reload age
+LEADERBOARD_SIZE = 100
+LEADERBOARD_POLL = 1.0
+LEADERBOARD_TTL = 60.0
+# optional write-behind mode for /upvotes and /downvotes: votes are summed per post in memory and
+# flushed in one transaction every VOTE_BUFFER_MAX_DELAY seconds (the most a crashed worker can
+# lose) or as soon as VOTE_BUFFER_MAX_VOTES are pending; graceful shutdown flushes what is left
+VOTE_WRITE_BEHIND = False
+VOTE_BUFFER_MAX_DELAY = 0.1
+VOTE_BUFFER_MAX_VOTES = 500
+# most vote operations accepted by one /batch request
+VOTE_BATCH_MAX = 1000
+# rows fetched (and sent) per chunk by streamed responses
+STREAM_CHUNK_SIZE = 500
 
 app = flask.Flask(__name__)
 app.config.from_object(__name__)
+serialize.install(app)
 
 
 ######################
@@ -59,14 +108,15 @@ app.config.from_object(__name__)
 # 	vote_id
 # 	upvotes
 #	downvotes
+#	score (upvotes - downvotes, maintained by /upvotes and /downvotes)
 
 # table3: community
 #	community_id
 #	name
 ######################
 
-def make_dicts(cursor, row):
-    return dict((cursor.description[idx][0], value) for idx, value in enumerate(row))
+# helper function used to convert each query result row into dictionary (see serialize)
+make_dicts = serialize.make_dicts
 
 
 # helper function to generate a response with status code and message
@@ -74,64 +124,315 @@ def get_response(status_code, message):
     return {"status_code": str(status_code), "message": str(message)}
 
 
+def get_db_pool():
+    return db_pool.pool_for_app(current_app.config, row_factory=make_dicts)
+
+
+# client of the single-writer daemon when DB_WRITER_SOCKET is set (see db_writer), else None
+def get_writer():
+    return db_writer.writer_for_app(current_app.config)
+
+
+# router over the shard files when SHARD_DIR is set (see db_shards), else None
+def get_shards():
+    return db_shards.router_for_app(current_app.config, row_factory=make_dicts)
+
+
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = make_dicts
+        g.db = get_db_pool().acquire()
     return g.db
 
 
-def query_db(query, args=(), one=False, commit=True):
+# pool for read-only handlers: query_only connections, on the snapshot when one is configured (see db_router)
+def get_read_pool():
+    return db_router.read_pool_for_app(current_app.config, row_factory=make_dicts)
+
+
+# read-only connection from flask g; returned to the pool it came from on teardown
+def get_read_db():
+    if 'read_db' not in g:
+        g.read_pool = get_read_pool()
+        g.read_db = g.read_pool.acquire()
+    return g.read_db
+
+
+def query_db(query, args=(), one=False, commit=True, return_=False, read_only=False):
     # one=True means return single record
     # commit = True for post and delete query
-    conn = get_db()
-    try:
+    # return_=True returns the rows of a committed query too (UPDATE ... RETURNING)
+    # read_only = True for read-only handlers (read connection, possibly a snapshot)
+    writer = get_writer() if commit else None
+    if writer is not None:
+        try:
+            rv = writer.execute([query], [args])[0]
+        except sqlite3.OperationalError as e:
+            print(e)
+            return False
+        if not return_:
+            return True
+        return (rv[0] if rv else None) if one else rv
+    if read_only and not commit:
+        conn = get_read_db()
+        pool = g.read_pool
+    else:
+        pool, conn = get_db_pool(), get_db()
+
+    def run():
         rv = conn.execute(query, args).fetchall()
         if commit:
             conn.commit()
+        return rv
+
+    try:
+        rv = pool.retry_busy(conn, run)
     except sqlite3.OperationalError as e:
         print(e)
-        return page_not_found(404)
-    close_db()
-    if not commit:
+        return False
+    if not commit or return_:
         return (rv[0] if rv else None) if one else rv
     return True
 
 
+# run a read query for streaming on the read connection: returns (cursor, first chunk of rows), or False on error
+def query_db_stream(query, args=()):
+    conn = get_read_db()
+    chunk_size = current_app.config['STREAM_CHUNK_SIZE']
+
+    def run():
+        cursor = conn.execute(query, args)
+        return cursor, cursor.fetchmany(chunk_size)
+
+    try:
+        return g.read_pool.retry_busy(conn, run)
+    except sqlite3.OperationalError as e:
+        print(e)
+        return False
+
+
+# shard mode: run a query about one post on the shard holding it; rows ([] if there's no such post),
+# or False on error
+def query_post_shard(shards, post_id, query, args, commit=False):
+    try:
+        return shards.find(int(post_id), query, args, commit)[1]
+    except (TypeError, ValueError, sqlite3.OperationalError) as e:
+        print(e)
+        return False
+
+
+# shard mode: a read run on every shard in parallel; the row lists in shard order, or False on error
+def query_all_shards(shards, query, args=()):
+    try:
+        return shards.scatter(query, args)
+    except sqlite3.OperationalError as e:
+        print(e)
+        return False
+
+
 def transaction_db(query, args):
-    conn = get_db()
     if len(query) != len(args):
         raise ValueError('arguments dont match queries')
-    try:
+    writer = get_writer()
+    if writer is not None:
+        try:
+            writer.execute(query, args)
+        except sqlite3.OperationalError as e:
+            print(e)
+        return 'Transaction Completed'
+    conn = get_db()
+
+    def run():
         conn.execute('BEGIN')
         for i in range(len(query)):
             conn.execute(query[i], args[i])
         conn.commit()
+
+    try:
+        get_db_pool().retry_busy(conn, run)
     except sqlite3.OperationalError as e:
-        conn.execute('rollback')
+        if conn.in_transaction:
+            conn.execute('rollback')
         print(e)
 
-    close_db()
     return 'Transaction Completed'
 
 
+# In-process cache of the top LEADERBOARD_SIZE posts by abs(score), in /getTop order.
+# Votes handled by this worker are applied in place as soon as they commit; writes by other
+# workers/services are picked up by polling PRAGMA data_version at most every LEADERBOARD_POLL
+# seconds and reloading (one walk of idx_votes_score).
+#
+# Invariant: every post not in the cache ranks at or below `boundary` (None = nothing left out),
+# so the cached entries are always an exact prefix of the real ranking.
+class Leaderboard:
+    LOAD_QUERY = 'SELECT posts.post_id, votes.vote_id, votes.score FROM votes ' \
+                 'INNER JOIN posts ON posts.vote_id = votes.vote_id ' \
+                 'ORDER BY abs(votes.score) DESC, votes.vote_id DESC LIMIT ?'
+
+    def __init__(self, database, size, poll, ttl, attach=()):
+        self.database = database
+        self.attach = attach
+        self.size = size
+        self.poll = poll
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._watch = None
+        self._entries = []      # [(rank key, post_id)] sorted by descending rank key
+        self._keys = {}         # post_id -> rank key
+        self._boundary = None
+        self._loaded = False
+        self._loaded_at = 0.0
+        self._polled_at = 0.0
+        self._version = None
+        self.stats = {'hits': 0, 'misses': 0, 'reloads': 0, 'invalidations': 0, 'updates': 0}
+
+    # getTop order is abs(score) DESC, vote_id DESC
+    @staticmethod
+    def rank(vote_id, score):
+        return abs(score), vote_id
+
+    def _data_version(self):
+        # data_version only moves for commits made by *other* connections, so it needs its own;
+        # in split mode the posts file (deletes) is watched along with votes
+        if self._watch is None:
+            self._watch = sqlite3.connect(self.database, check_same_thread=False)
+            for schema, path in self.attach:
+                self._watch.execute('ATTACH DATABASE ? AS {}'.format(schema), (path,))
+        schemas = ['main'] + [schema for schema, _ in self.attach]
+        return tuple(self._watch.execute('PRAGMA {}.data_version'.format(schema)).fetchone()[0]
+                     for schema in schemas)
+
+    def _stale(self):
+        now = time.monotonic()
+        if not self._loaded or now - self._loaded_at > self.ttl:
+            return True
+        if now - self._polled_at >= self.poll:
+            self._polled_at = now
+            if self._data_version() != self._version:
+                self.stats['invalidations'] += 1
+                return True
+        return False
+
+    def _load(self):
+        version = self._data_version()
+        rows = query_db(self.LOAD_QUERY, (self.size,), commit=False)
+        if rows is False:
+            return False
+        self._entries = [(self.rank(row['vote_id'], row['score']), row['post_id']) for row in rows]
+        self._entries.sort(reverse=True)
+        self._keys = dict((post_id, key) for key, post_id in self._entries)
+        self._boundary = self._entries[-1][0] if len(self._entries) == self.size else None
+        self._version = version
+        self._loaded = True
+        self._loaded_at = self._polled_at = time.monotonic()
+        self.stats['reloads'] += 1
+        return True
+
+    # top n post_ids, or None when n is deeper than the cache can answer
+    def top(self, n):
+        with self._lock:
+            if n <= 0 or n > self.size:
+                self.stats['misses'] += 1
+                return None
+            # entries that fell out after local votes shrink the cache; refill before it gets too short
+            if self._stale() or (n > len(self._entries) and self._boundary is not None):
+                if not self._load():
+                    return None
+            if n > len(self._entries) and self._boundary is not None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            return [{'post_id': post_id} for _, post_id in self._entries[:n]]
+
+    # apply a vote this worker just committed
+    def record_vote(self, post_id, vote_id, score):
+        with self._lock:
+            if not self._loaded:
+                return
+            self.stats['updates'] += 1
+            old = self._keys.pop(post_id, None)
+            if old is not None:
+                self._entries.remove((old, post_id))
+            key = self.rank(vote_id, score)
+            if self._boundary is not None and key <= self._boundary:
+                return
+            # bisect on negated keys to keep descending order
+            keys = [(-k[0], -k[1]) for k, _ in self._entries]
+            self._entries.insert(bisect.bisect(keys, (-key[0], -key[1])), (key, post_id))
+            self._keys[post_id] = key
+            if len(self._entries) > self.size:
+                dropped, dropped_id = self._entries.pop()
+                del self._keys[dropped_id]
+                self._boundary = dropped
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats.update({'size': self.size, 'cached': len(self._entries), 'pid': os.getpid()})
+        return stats
+
+
+_leaderboards = {}
+
+
+# one leaderboard per worker process
+def get_leaderboard():
+    database, attach = db_split.layout_for_app(current_app.config)
+    key = (os.getpid(), database)
+    if key not in _leaderboards:
+        _leaderboards[key] = Leaderboard(
+            database,
+            current_app.config['LEADERBOARD_SIZE'],
+            current_app.config['LEADERBOARD_POLL'],
+            current_app.config['LEADERBOARD_TTL'],
+            attach
+        )
+    return _leaderboards[key]
+
+
 @app.cli.command('init')
 def init_db():
     with app.app_context():
+        if app.config['DB_SPLIT_DIR']:
+            # split mode: build only this service's file (see db_split)
+            with app.open_resource('data.sql', mode='r') as f:
+                db_split.init_split(app.config, f.read())
+            return
         db = get_db()
+        # the pooled connection has already applied the WAL/pragma profile (see db_pool)
         with app.open_resource('data.sql', mode='r') as f:
             db.cursor().executescript(f.read())
         db.commit()
 
 
+# bring an existing db up to the current schema version in place
+# $flask migrate
+@app.cli.command('migrate')
+def migrate_db():
+    with app.app_context():
+        for name in db_migrate.migrate(get_db()):
+            print(f'Applied migration {name}')
+
+
+# re-derive votes.score from upvotes/downvotes (e.g. after votes were edited outside the API)
+# $flask rebuild_scores
+@app.cli.command('rebuild_scores')
+def rebuild_scores():
+    with app.app_context():
+        db = get_db()
+        cur = db.execute('UPDATE votes SET score = upvotes - downvotes WHERE score != upvotes - downvotes')
+        db.commit()
+        print(f'Rebuilt {cur.rowcount} scores')
+
+
 @app.teardown_appcontext
 def close_db(e=None):
     db = g.pop('db', None)
     if db is not None:
-        db.close()
+        get_db_pool().release(db)
+    read_db = g.pop('read_db', None)
+    if read_db is not None:
+        g.pop('read_pool').release(read_db)
 
 
 # home page
@@ -147,13 +448,159 @@ def page_not_found(status_code=404):
     return jsonify(error_json), status_code
 
 
+# database stayed locked past DB_BUSY_RETRIES (or no pooled connection freed up within POOL_TIMEOUT)
+@app.errorhandler(db_pool.DatabaseBusy)
+def database_busy(e):
+    print(e)
+    response = jsonify(get_response(status_code=503, message="Database busy, try again"))
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+# connection pool usage for this worker
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    stats = {'pool': get_db_pool().metrics(), 'read_pool': get_read_pool().metrics(),
+             'leaderboard': get_leaderboard().metrics()}
+    if current_app.config['VOTE_WRITE_BEHIND']:
+        stats['vote_buffer'] = get_vote_buffer().metrics()
+    if get_writer() is not None:
+        stats['writer'] = get_writer().metrics()
+    if get_shards() is not None:
+        stats['shards'] = get_shards().metrics()
+    return jsonify(stats), 200
+
+
 # function to retrieve all votes without any filters
+# streamed STREAM_CHUNK_SIZE rows at a time so memory stays flat however big the table is;
+# a JSON array by default, one row per line with Accept: application/x-ndjson
 # curl 'http://127.0.0.1:5000/all;
+# curl -H 'Accept: application/x-ndjson' 'http://127.0.0.1:5000/all;
 @app.route('/all', methods=['GET'])
 def get_posts_all():
     query = 'SELECT * FROM votes'
-    all_votes = query_db(query, commit=False)
-    return jsonify(all_votes), 200
+    shards = get_shards()
+    if shards is not None:
+        # shard mode: each shard's rows in turn, sent as one array
+        all_votes = query_all_shards(shards, query)
+        if all_votes is False:
+            return page_not_found(404)
+        return jsonify([row for rows in all_votes for row in rows]), 200
+    all_votes = query_db_stream(query)
+    if all_votes is False:
+        return page_not_found(404)
+    cursor, rows = all_votes
+    return serialize.stream_response(app, cursor, rows, serialize.wants_ndjson(request),
+                                     current_app.config['STREAM_CHUNK_SIZE'])
+
+
+# Per-worker write-behind buffer of vote deltas, only used when VOTE_WRITE_BEHIND is set.
+# A background thread flushes it; /get adds the unflushed deltas so a client reading from the
+# same worker sees its own votes.
+class VoteBuffer(write_behind.WriteBehindBuffer):
+    thread_name = 'vote-buffer'
+    unit = 'votes'
+    item = 'posts'
+    FLUSH_QUERY = 'UPDATE votes SET upvotes=upvotes + ?, downvotes=downvotes + ?, score=score + ? ' \
+                  'WHERE vote_id IN (SELECT vote_id FROM posts WHERE post_id = ?) RETURNING vote_id, score'
+
+    def __init__(self, config, leaderboard):
+        super().__init__(config['VOTE_BUFFER_MAX_DELAY'], config['VOTE_BUFFER_MAX_VOTES'])
+        self.config = config
+        self.leaderboard = leaderboard
+
+    # deltas are (upvotes, downvotes)
+    def combine(self, old, new):
+        return old[0] + new[0], old[1] + new[1]
+
+    def add(self, post_id, upvotes, downvotes):
+        super().add(post_id, (upvotes, downvotes), upvotes + downvotes)
+
+    # (upvotes, downvotes) accepted for post_id but not yet committed
+    def pending(self, post_id):
+        return super().pending(post_id, (0, 0))
+
+    def read(self, post_id, fetch):
+        return super().read(post_id, fetch, (0, 0))
+
+    # commit a batch; returns (post_id, row with vote_id and score) for the posts that still exist
+    def write(self, batch):
+        shards = db_shards.router_for_app(self.config, row_factory=make_dicts)
+        if shards is not None:
+            # one transaction per shard; posts no shard holds were deleted, drop their votes
+            by_shard = {}
+            for post_id, (up, down) in batch.items():
+                shard = shards.locate(post_id)
+                if shard is not None:
+                    by_shard.setdefault(shard, []).append((post_id, up, down))
+            rows = []
+            for shard, items in by_shard.items():
+                results = shards.transaction(shard, [self.FLUSH_QUERY] * len(items),
+                                             [(up, down, up - down, post_id) for post_id, up, down in items])
+                rows.extend((post_id, result[0]) for (post_id, _, _), result in zip(items, results) if result)
+            return rows
+        writer = db_writer.writer_for_app(self.config)
+        if writer is not None:
+            items = list(batch.items())
+            results = writer.execute([self.FLUSH_QUERY] * len(items),
+                                     [(up, down, up - down, post_id) for post_id, (up, down) in items])
+            return [(post_id, rows[0]) for (post_id, _), rows in zip(items, results) if rows]
+        pool = db_pool.pool_for_app(self.config, row_factory=make_dicts)
+        conn = pool.acquire()
+
+        def run():
+            rows = []
+            conn.execute('BEGIN')
+            for post_id, (up, down) in batch.items():
+                row = conn.execute(self.FLUSH_QUERY, (up, down, up - down, post_id)).fetchone()
+                if row is not None:
+                    rows.append((post_id, row))
+            conn.commit()
+            return rows
+
+        try:
+            return pool.retry_busy(conn, run)
+        finally:
+            pool.release(conn)
+
+    def flushed(self, batch, rows):
+        for post_id, row in rows:
+            self.leaderboard.record_vote(post_id, row['vote_id'], row['score'])
+
+
+_vote_buffers = {}
+
+
+# one buffer per worker process; flushed at interpreter exit (gunicorn's graceful worker shutdown)
+def get_vote_buffer():
+    key = (os.getpid(), current_app.config['DATABASE'])
+    if key not in _vote_buffers:
+        buffer = VoteBuffer(current_app.config, get_leaderboard())
+        atexit.register(buffer.flush)
+        _vote_buffers[key] = buffer
+    return _vote_buffers[key]
+
+
+# accept a vote into the write-behind buffer; False if post_id isn't a valid id
+def buffer_vote(post_id, upvotes, downvotes):
+    try:
+        post_id = int(post_id)
+    except (TypeError, ValueError):
+        return False
+    get_vote_buffer().add(post_id, upvotes, downvotes)
+    return True
+
+
+# push a committed vote (row from UPDATE ... RETURNING, None if no such post) into the leaderboard
+def record_vote(post_id, row):
+    if row is None:
+        return
+    try:
+        post_id = int(post_id)
+    except (TypeError, ValueError):
+        return
+    get_leaderboard().record_vote(post_id, row['vote_id'], row['score'])
 
 
 # Upvote a post
@@ -165,10 +612,23 @@ def get_upvotes():
     vote_id = params.get('vote_id')
     if not vote_id:
         return page_not_found(404)
-    query = 'UPDATE votes SET upvotes=upvotes + 1 WHERE vote_id IN (SELECT vote_id FROM posts WHERE post_id = ?)'
+    if current_app.config['VOTE_WRITE_BEHIND']:
+        if buffer_vote(vote_id, 1, 0):
+            return jsonify(True), 201
+        return page_not_found(404)
+    query = 'UPDATE votes SET upvotes=upvotes + 1, score=score + 1 WHERE vote_id IN (SELECT vote_id FROM posts WHERE post_id = ?) ' \
+            'RETURNING vote_id, score'
     args = (vote_id,)
-    update_upvotes = query_db(query, args, one=True)
-    if update_upvotes:
+    shards = get_shards()
+    if shards is not None:
+        update_upvotes = query_post_shard(shards, vote_id, query, args, commit=True)
+        if update_upvotes is not False:
+            update_upvotes = update_upvotes[0] if update_upvotes else None
+    else:
+        update_upvotes = query_db(query, args, one=True, return_=True)
+    if update_upvotes is not False:
+        record_vote(vote_id, update_upvotes)
+        update_upvotes = True
         # return jsonify(get_response(status_code=201, message=))
         return jsonify(update_upvotes), 201
     return page_not_found(404)
@@ -184,25 +644,163 @@ def get_downvotes():
     vote_id = params.get('vote_id')
     if not vote_id:
         return page_not_found(404)
-    query = 'UPDATE votes SET downvotes=downvotes+1 WHERE vote_id IN (SELECT vote_id FROM posts WHERE post_id = ?)'
+    if current_app.config['VOTE_WRITE_BEHIND']:
+        if buffer_vote(vote_id, 0, 1):
+            return jsonify(True), 201
+        return page_not_found(404)
+    query = 'UPDATE votes SET downvotes=downvotes+1, score=score-1 WHERE vote_id IN (SELECT vote_id FROM posts WHERE post_id = ?) ' \
+            'RETURNING vote_id, score'
     args = (vote_id,)
-    update_downvotes = query_db(query, args, one=True)
-    if update_downvotes:
+    shards = get_shards()
+    if shards is not None:
+        update_downvotes = query_post_shard(shards, vote_id, query, args, commit=True)
+        if update_downvotes is not False:
+            update_downvotes = update_downvotes[0] if update_downvotes else None
+    else:
+        update_downvotes = query_db(query, args, one=True, return_=True)
+    if update_downvotes is not False:
+        record_vote(vote_id, update_downvotes)
+        update_downvotes = True
         return jsonify(update_downvotes), 201
     return page_not_found(404)
 
 
+# Apply a list of votes in one transaction (one per shard in shard mode), returns one result per item
+# curl -i -X POST -H "Content-Type: application/json" -d '{"votes":[{"post_id":2,"direction":"up"}]}' 'http://127.0.0.1:5000/batch'
+@app.route('/batch', methods=['POST'])
+def vote_batch():
+    params = request.get_json()
+    votes = params.get('votes') if isinstance(params, dict) else None
+    if not votes or not isinstance(votes, list):
+        return jsonify(get_response(status_code=409, message="votes is not in request")), 409
+    batch_max = current_app.config['VOTE_BATCH_MAX']
+    if len(votes) > batch_max:
+        return jsonify(get_response(status_code=413, message=f"At most {batch_max} votes per batch")), 413
+
+    results = []
+    valid = []  # (index, post_id, upvotes, downvotes)
+    for i, vote in enumerate(votes):
+        vote = vote if isinstance(vote, dict) else {}
+        direction = vote.get('direction')
+        result = {'post_id': vote.get('post_id'), 'direction': direction}
+        results.append(result)
+        try:
+            post_id = int(vote.get('post_id'))
+        except (TypeError, ValueError):
+            result.update(get_response(status_code=400, message="Invalid post_id"))
+            continue
+        if direction not in ('up', 'down'):
+            result.update(get_response(status_code=400, message="direction must be up or down"))
+            continue
+        valid.append((i, post_id, 1 if direction == 'up' else 0, 1 if direction == 'down' else 0))
+
+    # resolve every post_id with one query
+    post_ids = sorted(set(post_id for _, post_id, _, _ in valid))
+    query = 'SELECT post_id, vote_id FROM posts WHERE post_id IN (SELECT value FROM json_each(?))'
+    shards = get_shards()
+    shard_of = {}
+    if shards is not None:
+        located = query_all_shards(shards, query, (json.dumps(post_ids),))
+        if located is False:
+            return page_not_found(404)
+        rows = []
+        for shard, shard_rows in zip(shards.shards, located):
+            rows.extend(shard_rows)
+            shard_of.update((row['post_id'], shard) for row in shard_rows)
+    else:
+        rows = query_db(query, (json.dumps(post_ids),), commit=False)
+    if rows is False:
+        return page_not_found(404)
+    vote_ids = dict((row['post_id'], row['vote_id']) for row in rows)
+
+    deltas = {}
+    for i, post_id, up, down in valid:
+        if post_id not in vote_ids:
+            results[i].update(get_response(status_code=404, message="Post not found"))
+            continue
+        delta = deltas.setdefault(post_id, [0, 0])
+        delta[0] += up
+        delta[1] += down
+        results[i].update(get_response(status_code=201, message="Vote recorded"))
+
+    if deltas and current_app.config['VOTE_WRITE_BEHIND']:
+        for post_id, (up, down) in deltas.items():
+            get_vote_buffer().add(post_id, up, down)
+    elif deltas:
+        update = 'UPDATE votes SET upvotes=upvotes + ?, downvotes=downvotes + ?, score=score + ? WHERE vote_id = ?'
+        update_args = [(up, down, up - down, vote_ids[post_id]) for post_id, (up, down) in deltas.items()]
+        scores_query = 'SELECT vote_id, score FROM votes WHERE vote_id IN (SELECT value FROM json_each(?))'
+        scores_args = (json.dumps([vote_ids[post_id] for post_id in deltas]),)
+        writer = get_writer()
+        conn = get_db() if writer is None and shards is None else None
+
+        def run():
+            if shards is not None:
+                by_shard = {}
+                for post_id, delta_args in zip(deltas, update_args):
+                    by_shard.setdefault(shard_of[post_id], []).append(delta_args)
+                scores = []
+                for shard, shard_args in by_shard.items():
+                    shard_scores = (json.dumps([delta_args[3] for delta_args in shard_args]),)
+                    queries = [update] * len(shard_args) + [scores_query]
+                    scores.extend(shards.transaction(shard, queries, shard_args + [shard_scores])[-1])
+                return scores
+            if writer is not None:
+                queries = [update] * len(update_args) + [scores_query]
+                return writer.execute(queries, update_args + [scores_args])[-1]
+            conn.execute('BEGIN')
+            conn.executemany(update, update_args)
+            scores = conn.execute(scores_query, scores_args).fetchall()
+            conn.commit()
+            return scores
+
+        try:
+            scores = run() if conn is None else get_db_pool().retry_busy(conn, run)
+        except sqlite3.OperationalError as e:
+            if conn is not None and conn.in_transaction:
+                conn.execute('rollback')
+            print(e)
+            return page_not_found(404)
+        post_ids_by_vote = dict((vote_id, post_id) for post_id, vote_id in vote_ids.items())
+        leaderboard = get_leaderboard()
+        for row in scores:
+            leaderboard.record_vote(post_ids_by_vote[row['vote_id']], row['vote_id'], row['score'])
+
+    return jsonify(results), 200
+
+
 # Report the number of upvotes and downvotes for a post
 # curl -i 'http://127.0.0.1:5000/get?vote_id=2';
+GET_VOTES_QUERY = 'SELECT upvotes,downvotes FROM votes INNER JOIN posts ON posts.vote_id = votes.vote_id WHERE post_id = ?'
+
+
 @app.route('/get', methods=['GET'])
 def get_retrievevotes():
     params = request.args
     vote_id = params.get('vote_id')
     if not vote_id:
         return page_not_found(404)
-    query = 'SELECT upvotes,downvotes FROM votes INNER JOIN posts ON posts.vote_id = votes.vote_id WHERE post_id = ?'
+    query = GET_VOTES_QUERY
     args = (vote_id,)
-    update_get = query_db(query, args, commit=False)
+    shards = get_shards()
+
+    def fetch():
+        if shards is not None:
+            return query_post_shard(shards, vote_id, query, args)
+        return query_db(query, args, commit=False, read_only=True)
+
+    try:
+        key = int(vote_id)
+    except ValueError:
+        key = None
+    if key is not None and current_app.config['VOTE_WRITE_BEHIND']:
+        # read the row and the buffered votes together, so a flush committing meanwhile isn't counted twice
+        update_get, (up, down) = get_vote_buffer().read(key, fetch)
+        for row in update_get or ():
+            row['upvotes'] += up
+            row['downvotes'] += down
+    else:
+        update_get = fetch()
     if update_get:
         return jsonify(update_get), 200
     return page_not_found(404)
@@ -216,14 +814,83 @@ def get_topvotes():
     n = params.get('n')
     if not n:
         return page_not_found(404)
-    query = 'SELECT posts.post_id FROM posts INNER JOIN votes on posts.vote_id = votes.vote_id ORDER BY abs(upvotes-downvotes) DESC LIMIT ?'
+    cursor = params.get('cursor')
+    if cursor is not None:
+        return get_topvotes_page(n, cursor)
+    if get_shards() is not None:
+        # the leaderboard watches one file; shards are merged per request instead
+        rows = query_top_shards(get_shards(), TOP_PAGE_QUERY + TOP_PAGE_ORDER, (n,), n)
+        if rows:
+            return jsonify([{'post_id': row['post_id']} for row in rows]), 200
+        return page_not_found(404)
+    try:
+        cached = get_leaderboard().top(int(n))
+    except ValueError:
+        cached = None
+    if cached:
+        return jsonify(cached), 200
     args = (n,)
-    update_getTop = query_db(query, args, commit=False)
+    update_getTop = query_db(TOP_QUERY, args, commit=False, read_only=True)
     if update_getTop:
         return jsonify(update_getTop), 200
     return page_not_found(404)
 
 
+# walks idx_votes_score instead of computing and sorting every post's score
+TOP_QUERY = 'SELECT posts.post_id FROM votes INNER JOIN posts ON posts.vote_id = votes.vote_id ' \
+            'ORDER BY abs(votes.score) DESC, votes.vote_id DESC LIMIT ?'
+TOP_PAGE_QUERY = 'SELECT posts.post_id, votes.vote_id, abs(votes.score) AS rank FROM votes ' \
+                 'INNER JOIN posts ON posts.vote_id = votes.vote_id'
+# continue after the (abs(score), vote_id) of the previous page's last post; spelled out rather than
+# as a row value so sqlite can range-scan the expression index
+TOP_PAGE_KEYSET = ' WHERE abs(votes.score) <= ? AND (abs(votes.score) < ? OR votes.vote_id < ?)'
+TOP_PAGE_ORDER = ' ORDER BY abs(votes.score) DESC, votes.vote_id DESC LIMIT ?'
+
+
+# shard mode: the top n of every shard, merged into the global (abs(score), vote_id) order
+def query_top_shards(shards, query, args, n):
+    try:
+        limit = int(n)
+        return shards.merge(shards.scatter(query, args), key=lambda row: (row['rank'], row['vote_id']),
+                            limit=limit if limit >= 0 else None)
+    except (ValueError, sqlite3.OperationalError) as e:
+        print(e)
+        return False
+
+
+# one page of /getTop, keyed on the (abs(score), vote_id) of the previous page's last post
+def get_topvotes_page(n, cursor):
+    query = TOP_PAGE_QUERY
+    args = []
+    if cursor:
+        try:
+            rank, vote_id = pagination.decode_cursor(cursor, int, int)
+        except pagination.InvalidCursor:
+            return jsonify(get_response(status_code=400, message="Invalid cursor")), 400
+        query += TOP_PAGE_KEYSET
+        args.extend([rank, rank, vote_id])
+    query += TOP_PAGE_ORDER
+    args.append(n)
+    shards = get_shards()
+    if shards is not None:
+        rows = query_top_shards(shards, query, tuple(args), n)
+    else:
+        rows = query_db(query, tuple(args), commit=False, read_only=True)
+    if rows is False:
+        return page_not_found(404)
+    next_cursor = None
+    if pagination.is_full(rows, n):
+        next_cursor = pagination.encode_cursor(rows[-1]['rank'], rows[-1]['vote_id'])
+    results = [{'post_id': row['post_id']} for row in rows]
+    return jsonify(pagination.page(results, next_cursor)), 200
+
+
+# the whole id list is bound as one JSON array, so the statement text never changes (stays prepared)
+# and there is no per-list limit on host parameters or IN-list expressions
+GET_LIST_QUERY = 'SELECT votes.vote_id,upvotes,downvotes FROM posts inner join votes on posts.vote_id = votes.vote_id ' \
+                 'WHERE posts.post_id IN (SELECT value FROM json_each(?)) ORDER BY score DESC'
+
+
 # Given a list of post identifiers, return the list sorted by score.
 # curl -i -X POST -H "Content-Type: application/json" -d '{"post_ids":["1","2","3"]}' 'http://127.0.0.1:5000/getList'
 @app.route('/getList', methods=['POST'])
@@ -235,13 +902,21 @@ def get_topList():
     if not post_ids:
         return page_not_found(404)
 
-    post_ids = list(map(int, post_ids))
-    t = tuple(post_ids)
-    query = 'SELECT votes.vote_id,upvotes,downvotes FROM posts inner join votes on posts.vote_id = votes.vote_id WHERE posts.post_id IN {} ORDER BY (upvotes-downvotes) DESC'.format(
-        t)
-    # print(query)
-    args = (post_ids,)
-    update_getList = query_db(query, commit=False)
+    try:
+        post_ids = list(map(int, post_ids))
+    except (TypeError, ValueError):
+        return jsonify(get_response(status_code=400, message="post_ids must be integers")), 400
+    query = GET_LIST_QUERY
+    args = (json.dumps(post_ids),)
+    shards = get_shards()
+    if shards is not None:
+        # every shard returns the posts it holds; score is upvotes - downvotes
+        update_getList = query_all_shards(shards, query, args)
+        if update_getList is not False:
+            update_getList = sorted((row for rows in update_getList for row in rows),
+                                    key=lambda row: row['upvotes'] - row['downvotes'], reverse=True)
+    else:
+        update_getList = query_db(query, args, commit=False, read_only=True)
     if update_getList:
         return jsonify(update_getList), 200
     return page_not_found(404)
@@ -0,0 +1,125 @@
+import threading
+
+######################
+# Per-worker write-behind buffer shared by vote_api (vote deltas) and user_api (karma changes).
+# add() coalesces changes per key; a background thread calls flush() every max_delay seconds, or
+# as soon as max_pending changes are waiting. pending(key) includes the batch being written, so a
+# read from the same worker sees its own changes until they are committed; read(key, fetch) pairs a
+# database read with pending(key) so that no change is counted twice or missed while a flush commits.
+#
+# Subclasses implement write(batch), which commits one batch and may return a result for
+# flushed(batch, result). A flush that raises anything puts its batch back for the next one, and
+# the flusher thread survives every error, so a failed flush never strands changes.
+#
+# Stats are named after the subclass's unit (changes counted by add) and item (keys):
+#   <unit>, flushed_<unit>, pending_<unit>, pending_<item>, flushes, flush_failures
+
+
+class WriteBehindBuffer:
+    thread_name = 'write-behind'
+    unit = 'changes'
+    item = 'keys'
+
+    def __init__(self, max_delay, max_pending):
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._deltas = {}       # key -> change
+        self._in_flight = {}    # changes being written by the current flush, still visible to pending()
+        self._settled = threading.Condition(self._lock)    # notified when _in_flight is emptied
+        self._started = 0       # flushes that have put a batch in flight
+        self._count = 0
+        self._wake = threading.Event()
+        self._thread = None
+        self.stats = {self.unit: 0, 'flushes': 0, 'flushed_' + self.unit: 0, 'flush_failures': 0}
+
+    # merge two changes to one key; numbers add, subclasses with other deltas override this
+    def combine(self, old, new):
+        return old + new
+
+    def add(self, key, delta, count=1):
+        with self._lock:
+            self._deltas[key] = self.combine(self._deltas[key], delta) if key in self._deltas else delta
+            self._count += count
+            self.stats[self.unit] += count
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+                self._thread.start()
+            full = self._count >= self.max_pending
+        if full:
+            self._wake.set()
+
+    # change accepted for key but not yet committed (zero if there is none)
+    def pending(self, key, zero=0):
+        with self._lock:
+            return self.combine(self._deltas.get(key, zero), self._in_flight.get(key, zero))
+
+    # (fetch(), change still pending for key): fetch() reads the committed value of key, and the pair
+    # counts every change exactly once. While key's batch is being written the database may or may
+    # not hold it yet, so the read waits for that flush; a flush that starts during fetch() may commit
+    # under it, so the read is retried.
+    def read(self, key, fetch, zero=0):
+        while True:
+            with self._lock:
+                while key in self._in_flight:
+                    self._settled.wait()
+                started = self._started
+            value = fetch()
+            with self._lock:
+                if self._started == started:
+                    return value, self._deltas.get(key, zero)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.max_delay)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # flush() already kept its batch if the write failed; this is a failure after the commit
+                print(f'{self.thread_name} flush error: {e!r}')
+
+    def write(self, batch):
+        raise NotImplementedError
+
+    def flushed(self, batch, result):
+        pass
+
+    # write everything pending: True when it is committed (or there was nothing), False when the
+    # batch was put back for the next flush
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._deltas:
+                    return True
+                batch, self._deltas, count, self._count = self._deltas, {}, self._count, 0
+                self._in_flight = batch
+                self._started += 1
+            try:
+                result = self.write(batch)
+            except Exception as e:
+                print(f'{self.thread_name} flush failed, keeping {len(batch)} {self.item} buffered: {e!r}')
+                # put the batch back so the next flush retries it
+                with self._lock:
+                    for key, delta in batch.items():
+                        self._deltas[key] = self.combine(delta, self._deltas[key]) if key in self._deltas else delta
+                    self._count += count
+                    self._in_flight = {}
+                    self._settled.notify_all()
+                    self.stats['flush_failures'] += 1
+                return False
+            with self._lock:
+                self._in_flight = {}
+                self._settled.notify_all()
+                self.stats['flushes'] += 1
+                self.stats['flushed_' + self.unit] += count
+            self.flushed(batch, result)
+            return True
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats.update({'pending_' + self.unit: self._count, 'pending_' + self.item: len(self._deltas),
+                          'max_delay': self.max_delay})
+        return stats